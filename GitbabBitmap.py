@@ -0,0 +1,309 @@
+import array
+import hashlib
+import os
+import struct
+import sys
+
+from GitBab.GitbabEwah import ewah_decode, ewah_encode, ewah_from_positions, ewah_positions
+from GitBab.GitbabGraph import commit_info
+from GitBab.GitbabObject import kvlm_parse, object_read_raw, tree_parse
+from GitBab.GitbabPack import pack_list
+
+# Reachability bitmaps, in git's .bitmap layout (version 1): for some
+# commits of a pack, an EWAH bitmap of every object reachable from them,
+# bit n standing for the nth object of the pack in pack order.  Four more
+# bitmaps give the type of each object, and an optional table holds the
+# name hash of each object for delta ordering.  The pack must hold
+# everything reachable from its objects.
+BITMAP_SIGNATURE = b'BITM'
+BITMAP_HEADER = struct.Struct(">4sHHI20s")
+BITMAP_ENTRY = struct.Struct(">IBB")
+BITMAP_VERSION = 1
+BITMAP_OPT_FULL_DAG = 0x1
+BITMAP_OPT_HASH_CACHE = 0x4
+BITMAP_TYPES = (b'commit', b'tree', b'blob', b'tag')
+
+# How many previous entries an entry may be stored as a XOR against.
+BITMAP_XOR_WINDOW = 10
+
+# Besides the tips, one commit out of this many down their first-parent
+# history gets a bitmap, so walks from commits without one stay short.
+BITMAP_INTERVAL = 100
+
+class GitPackBitmap(object):
+    # Without a path, an empty bitmap index for pack, to be filled in and
+    # written out.
+    def __init__(self, pack, path=None):
+        self.pack = pack
+        self.count = pack.index.count
+        self.reverse = pack.reverse_index()
+        self.position_of = None
+        self.types = dict()
+        self.hashes = None
+        self.entries = dict()
+        self.raw_entries = dict()
+        if path:
+            self.load(path)
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            raw = f.read()
+        if hashlib.sha1(raw[:-20]).digest() != raw[-20:]:
+            raise Exception("Bitmap {} is corrupt".format(path))
+
+        signature, version, flags, count, pack_sha = BITMAP_HEADER.unpack_from(raw)
+        if signature != BITMAP_SIGNATURE or version != BITMAP_VERSION or not flags & BITMAP_OPT_FULL_DAG:
+            raise Exception("Unsupported bitmap {}".format(path))
+        if pack_sha != self.pack.data[-20:]:
+            raise Exception("Bitmap {} does not match its pack".format(path))
+
+        idx = BITMAP_HEADER.size
+        for fmt in BITMAP_TYPES:
+            self.types[fmt], _, idx = ewah_decode(raw, idx)
+
+        # Entries are only decoded when asked for: (xor base, data offset).
+        order = list()
+        for i in range(count):
+            position, xor, entry_flags = BITMAP_ENTRY.unpack_from(raw, idx)
+            if xor > i:
+                raise Exception("Bitmap {} is corrupt".format(path))
+            sha = self.pack.index.sha_at(position).hex()
+            order.append(sha)
+            self.raw_entries[sha] = (order[i - xor] if xor else None, idx + BITMAP_ENTRY.size)
+            idx = ewah_decode(raw, idx + BITMAP_ENTRY.size)[2]
+        self.raw = raw
+
+        if flags & BITMAP_OPT_HASH_CACHE:
+            # Name hashes, in pack order.
+            self.hashes = array.array("I", raw[idx:idx + 4 * self.count])
+            if sys.byteorder == "little":
+                self.hashes.byteswap()
+
+    def position(self, sha):
+        i = self.pack.index.find(bytes.fromhex(sha))
+        if i is None:
+            return None
+        if self.position_of is None:
+            self.position_of = array.array("I", bytes(4 * self.count))
+            for (pos, i_) in enumerate(self.reverse):
+                self.position_of[i_] = pos
+        return self.position_of[i]
+
+    def sha_at(self, pos):
+        return self.pack.index.sha_at(self.reverse[pos]).hex()
+
+    def commit_bits(self, sha):
+        # The objects reachable from commit sha, or None if it has no bitmap.
+        if sha in self.entries:
+            return self.entries[sha]
+        if not sha in self.raw_entries:
+            return None
+
+        # XORed entries chain back to a plain one.
+        chain = list()
+        while sha is not None and not sha in self.entries:
+            chain.append(sha)
+            sha = self.raw_entries[sha][0]
+        bits = self.entries[sha] if sha is not None else 0
+        for sha in reversed(chain):
+            bits ^= ewah_decode(self.raw, self.raw_entries[sha][1])[0]
+            self.entries[sha] = bits
+        return bits
+
+class GitReachable(object):
+    # A set of objects: a bitmap over the positions of a bitmapped pack,
+    # plus sha -> type for the objects outside of it.
+    def __init__(self, bitmap, bits, extra):
+        self.bitmap = bitmap
+        self.bits = bits
+        self.extra = extra
+        self.marks = None
+
+    def __len__(self):
+        return self.bits.bit_count() + len(self.extra)
+
+    def __contains__(self, sha):
+        if sha in self.extra:
+            return True
+        pos = self.bitmap.position(sha) if self.bitmap else None
+        if pos is None:
+            return False
+        if self.marks is None:
+            self.marks = self.bits.to_bytes((self.bitmap.count + 7) // 8, "little")
+        return bool(self.marks[pos >> 3] & (1 << (pos & 7)))
+
+    def count(self, fmt):
+        ret = sum(1 for f in self.extra.values() if f == fmt)
+        if self.bitmap:
+            ret += (self.bits & self.bitmap.types.get(fmt, 0)).bit_count()
+        return ret
+
+    def items(self):
+        # (sha, fmt) of each object, those in the pack first, in pack order.
+        if self.bitmap:
+            for fmt in BITMAP_TYPES:
+                for pos in ewah_positions(self.bits & self.bitmap.types.get(fmt, 0)):
+                    yield self.bitmap.sha_at(pos), fmt
+        yield from self.extra.items()
+
+def bitmap_path(pack):
+    return pack.path[:-len(".pack")] + ".bitmap"
+
+def bitmap_read(repo):
+    # The bitmap index of the first pack that has one, or None.
+    if not repo.conf.getboolean("pack", "useBitmaps", fallback=True):
+        return None
+    for pack in pack_list(repo):
+        path = bitmap_path(pack)
+        if not os.path.exists(path):
+            continue
+        if pack.bitmap is None:
+            pack.bitmap = GitPackBitmap(pack, path)
+        return pack.bitmap
+    return None
+
+def bitmap_walk(repo, bitmap, tips, exclude=None, names=None):
+    # Marks every object reachable from tips, taking the whole closure of
+    # a commit from its bitmap when it has one, and not going into
+    # anything in exclude (a GitReachable).  tips are (sha, fmt) with fmt
+    # None when unknown.  names, a dict, collects sha -> path of the
+    # objects found below trees.
+    size = (bitmap.count + 7) // 8 if bitmap else 0
+    marks = bytearray(size)
+    extra = dict()
+
+    stack = list(tips)
+    while stack:
+        sha, fmt = stack.pop()
+        pos = bitmap.position(sha) if bitmap else None
+        if pos is not None:
+            if marks[pos >> 3] & (1 << (pos & 7)):
+                continue
+        elif sha in extra:
+            continue
+        if exclude is not None and sha in exclude:
+            continue
+
+        if fmt != b'blob' and bitmap and pos is not None:
+            bits = bitmap.commit_bits(sha)
+            if bits is not None:
+                marks = bytearray((int.from_bytes(marks, "little") | bits).to_bytes(size, "little"))
+                continue
+
+        if fmt is None or fmt == b'tag':
+            found = object_read_raw(repo, sha)
+            if found is None:
+                raise Exception("Missing object {}".format(sha))
+            fmt, data = found
+            if fmt == b'tag':
+                stack.append((kvlm_parse(data)[b'object'].decode("ascii"), None))
+
+        if pos is not None:
+            marks[pos >> 3] |= 1 << (pos & 7)
+        else:
+            extra[sha] = fmt
+
+        if fmt == b'commit':
+            # The commit-graph has the links without reading the commit.
+            parents, date, generation, tree = commit_info(repo, sha)
+            stack.extend((p, b'commit') for p in parents)
+            stack.append((tree, b'tree'))
+        elif fmt == b'tree':
+            for leaf in tree_parse(object_read_raw(repo, sha)[1]):
+                if leaf.mode == b'160000':
+                    # Submodule commits live in another repository.
+                    continue
+                if names is not None:
+                    names.setdefault(leaf.sha, leaf.path)
+                stack.append((leaf.sha, b'tree' if leaf.mode == b'040000' else b'blob'))
+
+    return GitReachable(bitmap, int.from_bytes(marks, "little"), extra)
+
+def reachable_objects(repo, tips, exclude=(), use_bitmap=True, names=None):
+    # Everything reachable from tips and not from exclude: the bitmaps of
+    # both sides ORed together, then the second removed from the first.
+    # Without bitmaps (or with use_bitmap False) this is a plain walk.
+    bitmap = bitmap_read(repo) if use_bitmap else None
+    haves = None
+    if exclude:
+        haves = bitmap_walk(repo, bitmap, [(sha, None) for sha in exclude])
+    wants = bitmap_walk(repo, bitmap, [(sha, None) for sha in tips], haves, names)
+    if haves is not None:
+        wants.bits &= ~haves.bits
+    return wants
+
+def bitmap_write(repo, pack, tips, hashes=None):
+    # Writes a bitmap for each commit of tips (refs or tags pointing at
+    # commits), which must all be in pack along with everything they
+    # reach.  hashes (sha -> name hash) fills the name-hash cache.
+    bitmap = GitPackBitmap(pack)
+
+    commits = list()
+    for sha in tips:
+        while sha and not sha in commits:
+            found = object_read_raw(repo, sha)
+            if found is None or found[0] == b'commit':
+                break
+            sha = kvlm_parse(found[1])[b'object'].decode("ascii") if found[0] == b'tag' else None
+        if sha and found and found[0] == b'commit' and not sha in commits:
+            commits.append(sha)
+
+    # Histories shared with a tip already done are skipped.
+    seen = set(commits)
+    for sha in list(commits):
+        depth = 0
+        while True:
+            parents = commit_info(repo, sha)[0]
+            if not parents or parents[0] in seen:
+                break
+            sha = parents[0]
+            seen.add(sha)
+            depth += 1
+            if depth % BITMAP_INTERVAL == 0:
+                commits.append(sha)
+
+    # Oldest first, so each walk stops at the bitmaps already computed.
+    commits.sort(key=lambda sha: commit_info(repo, sha)[1])
+    for sha in commits:
+        reach = bitmap_walk(repo, bitmap, [(sha, b'commit')])
+        if reach.extra:
+            raise Exception("Pack {} is missing objects reachable from {}".format(pack.path, sha))
+        bitmap.entries[sha] = reach.bits
+
+    types = dict()
+    positions = dict((fmt, list()) for fmt in BITMAP_TYPES)
+    for (pos, i) in enumerate(bitmap.reverse):
+        positions[pack.type_at(pack.index.offset_at(i), types)].append(pos)
+
+    flags = BITMAP_OPT_FULL_DAG
+    if hashes is not None:
+        flags |= BITMAP_OPT_HASH_CACHE
+    raw = bytearray(BITMAP_HEADER.pack(BITMAP_SIGNATURE, BITMAP_VERSION, flags, len(commits), pack.data[-20:]))
+    for fmt in BITMAP_TYPES:
+        raw += ewah_encode(ewah_from_positions(positions[fmt]), bitmap.count)
+
+    # Store each bitmap as is or XORed with one of the previous entries,
+    # whichever is smaller.
+    for (i, sha) in enumerate(commits):
+        bits = bitmap.entries[sha]
+        best = ewah_encode(bits, bitmap.count)
+        xor = 0
+        for j in range(max(0, i - BITMAP_XOR_WINDOW), i):
+            encoded = ewah_encode(bits ^ bitmap.entries[commits[j]], bitmap.count)
+            if len(encoded) < len(best):
+                best = encoded
+                xor = i - j
+        raw += BITMAP_ENTRY.pack(pack.index.find(bytes.fromhex(sha)), xor, 0)
+        raw += best
+
+    if hashes is not None:
+        raw += struct.pack(">{}I".format(bitmap.count),
+                           *[hashes.get(bitmap.sha_at(pos), 0) for pos in range(bitmap.count)])
+    raw += hashlib.sha1(raw).digest()
+
+    path = bitmap_path(pack)
+    with open(path + ".tmp", "wb") as f:
+        f.write(raw)
+    os.replace(path + ".tmp", path)
+    pack.bitmap = None
+    return path, len(commits)
@@ -0,0 +1,26 @@
+import hashlib
+import struct
+
+# The chunk table shared by the commit-graph and the multi-pack-index:
+# after the file header, (id, offset) pairs, one per chunk.
+CHUNK_ENTRY = struct.Struct(">4sQ")
+
+def chunk_table_parse(data, start, count):
+    # Table of (id, offset) pairs, closed by a zero id giving the end of
+    # the last chunk.  Returns id -> (start, end).
+    table = [CHUNK_ENTRY.unpack_from(data, start + CHUNK_ENTRY.size * i) for i in range(count + 1)]
+    return {table[i][0]: (table[i][1], table[i + 1][1]) for i in range(count)}
+
+def chunk_file_build(header, chunks):
+    # header is the file header, chunks a list of (id, data) pairs; the
+    # file ends with the SHA-1 of everything before it.
+    offset = len(header) + CHUNK_ENTRY.size * (len(chunks) + 1)
+    ret = bytearray(header)
+    for (id, data) in chunks:
+        ret += CHUNK_ENTRY.pack(id, offset)
+        offset += len(data)
+    ret += CHUNK_ENTRY.pack(b"\0\0\0\0", offset)
+    for (id, data) in chunks:
+        ret += data
+    ret += hashlib.sha1(ret).digest()
+    return ret
@@ -0,0 +1,94 @@
+import struct
+
+# EWAH compressed bitmaps, in git's on-disk layout: 32-bit bit count,
+# 32-bit word count, the 64-bit words, then the position of the last
+# marker word.  Marker words hold a running bit (bit 0), how many words
+# of that bit follow (bits 1-32) and how many literal words come after
+# them (bits 33-63).
+#
+# In memory a bitmap is just a Python int, bit n standing for position n,
+# so union, intersection and difference are |, & and & ~.
+
+EWAH_HEADER = struct.Struct(">II")
+EWAH_RUN_MAX = (1 << 32) - 1
+EWAH_LITERAL_MAX = (1 << 31) - 1
+EWAH_ONES = (1 << 64) - 1
+
+def ewah_decode(raw, idx=0):
+    # Returns the bitmap, its size in bits and the offset after it.
+    bit_size, count = EWAH_HEADER.unpack_from(raw, idx)
+    idx += EWAH_HEADER.size
+    end = idx + count * 8
+
+    bits = 0
+    pos = 0 # In words
+    while idx < end:
+        marker = struct.unpack_from(">Q", raw, idx)[0]
+        idx += 8
+        run = (marker >> 1) & EWAH_RUN_MAX
+        literals = marker >> 33
+
+        if marker & 1 and run:
+            bits |= ((1 << (64 * run)) - 1) << (64 * pos)
+        pos += run
+
+        if literals:
+            words = struct.unpack_from(">{}Q".format(literals), raw, idx)
+            idx += 8 * literals
+            bits |= int.from_bytes(struct.pack("<{}Q".format(literals), *words), "little") << (64 * pos)
+            pos += literals
+
+    # Skip the position of the last marker word.
+    return bits, bit_size, end + 4
+
+def ewah_encode(bits, bit_size=None):
+    if bit_size is None:
+        bit_size = bits.bit_length()
+    count = (bit_size + 63) // 64
+    words = struct.unpack("<{}Q".format(count), bits.to_bytes(count * 8, "little"))
+
+    out = list()
+    marker = 0
+    i = 0
+    while True:
+        # Clean words, all zeros or all ones, then literal words until the
+        # next clean one.
+        marker = len(out)
+        out.append(0)
+        running = 1 if i < count and words[i] == EWAH_ONES else 0
+        clean = EWAH_ONES if running else 0
+        run = 0
+        while i < count and words[i] == clean and run < EWAH_RUN_MAX:
+            run += 1
+            i += 1
+        start = i
+        while i < count and words[i] != 0 and words[i] != EWAH_ONES and i - start < EWAH_LITERAL_MAX:
+            i += 1
+        out[marker] = running | (run << 1) | ((i - start) << 33)
+        out.extend(words[start:i])
+        if i >= count:
+            break
+
+    return (EWAH_HEADER.pack(bit_size, len(out)) +
+            struct.pack(">{}Q".format(len(out)), *out) +
+            struct.pack(">I", marker))
+
+def ewah_positions(bits):
+    # Set positions, in increasing order.
+    ret = list()
+    raw = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for i, byte in enumerate(raw):
+        while byte:
+            low = byte & -byte
+            ret.append(8 * i + low.bit_length() - 1)
+            byte ^= low
+    return ret
+
+def ewah_from_positions(positions):
+    positions = list(positions)
+    if not positions:
+        return 0
+    raw = bytearray(max(positions) // 8 + 1)
+    for pos in positions:
+        raw[pos >> 3] |= 1 << (pos & 7)
+    return int.from_bytes(raw, "little")
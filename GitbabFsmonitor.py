@@ -0,0 +1,282 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import socket
+import struct
+import time
+
+from GitBab.GitbabRepo import repo_path
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_WORKTREE_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+FSMONITOR_SOCKET = "fsmonitor.sock"
+FSMONITOR_COOKIE_PREFIX = "fsmonitor-cookie-"
+FSMONITOR_TIMEOUT = 5
+
+class GitInotify(object):
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed: {}".format(path))
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        try:
+            raw = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return list()
+
+        ret = list()
+        idx = 0
+        while idx < len(raw):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(raw, idx)
+            idx += INOTIFY_EVENT.size
+            name = raw[idx:idx + length].rstrip(b'\x00')
+            idx += length
+            ret.append((wd, mask, os.fsdecode(name)))
+        return ret
+
+class GitFsmonitorDaemon(object):
+    # Watches every worktree directory with inotify and records, for each
+    # path that changed, the sequence number of its latest event.  Clients
+    # send the token they got last time and receive the paths changed
+    # since, or "*" when the token comes from another daemon instance (or
+    # events were lost, or some directory isn't watched), meaning they must
+    # scan everything.
+    def __init__(self, repo):
+        self.repo = repo
+        self.id = "{}.{}".format(os.getpid(), time.time_ns())
+        self.seq = 0
+        self.dirty = dict()
+        self.watches = dict()
+        self.unwatched = set()
+        self.cookies = 0
+        self.inotify = GitInotify()
+
+        self.watch_tree("")
+        self.gitdir_wd = self.inotify.add_watch(self.repo.gitdir, IN_CREATE)
+
+    def watch_tree(self, path):
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            full_path = os.path.join(self.repo.worktree, path)
+            try:
+                wd = self.inotify.add_watch(full_path, IN_WORKTREE_MASK)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            except OSError:
+                # Out of watches (ENOSPC) or no access: changes below path
+                # would go unseen until it can be watched.
+                self.unwatched.add(path)
+                continue
+            self.watches[wd] = path
+            try:
+                with os.scandir(full_path) as it:
+                    for e in it:
+                        rel_path = os.path.join(path, e.name)
+                        if rel_path != ".git" and e.is_dir(follow_symlinks=False):
+                            stack.append(rel_path)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            except OSError:
+                self.unwatched.add(path)
+
+    def rewatch(self):
+        # Retries the directories that couldn't be watched.  Once they all
+        # are, the tokens handed out meanwhile missed their changes.
+        paths = self.unwatched
+        self.unwatched = set()
+        for path in paths:
+            self.watch_tree(path)
+        if not self.unwatched:
+            self.reset()
+
+    def reset(self):
+        # Nobody's token can be trusted anymore.
+        self.id = "{}.{}".format(os.getpid(), time.time_ns())
+        self.dirty.clear()
+
+    def process(self):
+        # Returns the cookie names seen in this batch of events.
+        cookies = list()
+        for (wd, mask, name) in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped.
+                self.reset()
+                continue
+
+            if wd == self.gitdir_wd:
+                if name.startswith(FSMONITOR_COOKIE_PREFIX):
+                    cookies.append(name)
+                continue
+
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            dir_path = self.watches.get(wd)
+            if dir_path is None:
+                continue
+
+            path = os.path.join(dir_path, name) if name else dir_path
+            if path == ".git" or path.startswith(".git" + os.sep):
+                continue
+            self.seq += 1
+            self.dirty[path] = self.seq
+
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                # The watches follow the moved directory, under paths that
+                # are now wrong; the new location is picked up by MOVED_TO.
+                prefix = path + os.sep
+                for (sub_wd, sub_path) in list(self.watches.items()):
+                    if sub_path == path or sub_path.startswith(prefix):
+                        self.inotify.rm_watch(sub_wd)
+                        del self.watches[sub_wd]
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path)
+                # Files may have appeared before the watch was in place.
+                for (root, dirs, files) in os.walk(os.path.join(self.repo.worktree, path)):
+                    for f in files + dirs:
+                        self.seq += 1
+                        self.dirty[os.path.relpath(os.path.join(root, f), self.repo.worktree)] = self.seq
+        return cookies
+
+    def sync(self):
+        # Make sure every event that happened before the query has been
+        # read: create a cookie file and wait until its event shows up.
+        self.cookies += 1
+        name = "{}{}.{}".format(FSMONITOR_COOKIE_PREFIX, os.getpid(), self.cookies)
+        cookie = os.path.join(self.repo.gitdir, name)
+        with open(cookie, "w"):
+            pass
+        try:
+            deadline = time.time() + FSMONITOR_TIMEOUT
+            while time.time() < deadline:
+                select.select([self.inotify.fd], [], [], deadline - time.time())
+                if name in self.process():
+                    return True
+            return False
+        finally:
+            os.unlink(cookie)
+
+    def query(self, token):
+        synced = self.sync()
+        if self.unwatched:
+            self.rewatch()
+        new_token = "{}:{}".format(self.id, self.seq)
+
+        if not synced or self.unwatched or not token or not token.startswith(self.id + ":"):
+            return new_token, None
+
+        since = int(token[len(self.id) + 1:])
+        return new_token, sorted(path for (path, seq) in self.dirty.items() if seq > since)
+
+    def run(self):
+        path = repo_path(self.repo, FSMONITOR_SOCKET)
+        if os.path.exists(path):
+            os.unlink(path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(8)
+        try:
+            while True:
+                ready, _, _ = select.select([server, self.inotify.fd], [], [])
+                if self.inotify.fd in ready:
+                    self.process()
+                if server in ready:
+                    conn, _ = server.accept()
+                    with conn:
+                        if not self.serve(conn):
+                            return
+        finally:
+            server.close()
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def serve(self, conn):
+        conn.settimeout(FSMONITOR_TIMEOUT)
+        request = fsmonitor_recv_all(conn).decode("utf8").rstrip("\n")
+
+        if request == "stop":
+            conn.sendall(b"ok\n")
+            return False
+
+        if request.startswith("query "):
+            new_token, paths = self.query(request[len("query "):])
+            response = new_token + "\n"
+            if paths is None:
+                response += "*"
+            else:
+                response += "\0".join(paths)
+            conn.sendall(response.encode("utf8"))
+
+        return True
+
+def fsmonitor_request(repo, request):
+    path = repo_path(repo, FSMONITOR_SOCKET)
+    if not os.path.exists(path):
+        return None
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(FSMONITOR_TIMEOUT * 2)
+    try:
+        conn.connect(path)
+        conn.sendall(request.encode("utf8") + b"\n")
+        conn.shutdown(socket.SHUT_WR)
+        return fsmonitor_recv_all(conn)
+    except OSError:
+        return None
+    finally:
+        conn.close()
+
+def fsmonitor_recv_all(conn):
+    chunks = list()
+    while True:
+        chunk = conn.recv(64 * 1024)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+def fsmonitor_query(repo, token):
+    # Returns (new_token, changed paths), with paths None when everything
+    # must be scanned, or None when no daemon is running.
+    response = fsmonitor_request(repo, "query {}".format(token or ""))
+    if response is None or not b"\n" in response:
+        return None
+
+    new_token, paths = response.decode("utf8").split("\n", 1)
+    if paths == "*":
+        return new_token, None
+    return new_token, [p for p in paths.split("\0") if p]
+
+def fsmonitor_stop(repo):
+    return fsmonitor_request(repo, "stop") is not None
@@ -0,0 +1,538 @@
+import collections
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+
+from GitBab.GitbabChunk import chunk_file_build, chunk_table_parse
+from GitBab.GitbabObject import object_read, tree_diff, tree_lookup
+from GitBab.GitbabRepo import ref_list, ref_resolve, repo_directory, repo_path
+
+# git's commit-graph file (objects/info/commit-graph): for every commit
+# reachable from the refs, sorted by SHA, its root tree, the positions of
+# its parents, its commit date and its generation number, in fixed-width
+# columns that can be read straight out of an mmap.
+
+GRAPH_SIGNATURE = b"CGPH"
+GRAPH_HEADER = struct.Struct(">4sBBBB")
+GRAPH_DATA = struct.Struct(">20sIIII")
+
+GRAPH_CHUNK_FANOUT = b"OIDF"
+GRAPH_CHUNK_OIDS = b"OIDL"
+GRAPH_CHUNK_DATA = b"CDAT"
+GRAPH_CHUNK_EDGES = b"EDGE"
+GRAPH_CHUNK_BLOOM_INDEX = b"BIDX"
+GRAPH_CHUNK_BLOOM_DATA = b"BDAT"
+
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+
+# Generation of commits that aren't in the graph: larger than any real one,
+# so walks never stop early because of them.
+GENERATION_INFINITY = 0xFFFFFFFF
+GENERATION_MAX = 0x3FFFFFFF
+
+# Changed-path Bloom filters, with git's settings: for each commit, the
+# paths (and their leading directories) that differ from its first
+# parent, each setting 7 bits out of 10 per path.  Commits changing more
+# than 512 paths get a one-byte filter with every bit set.
+BLOOM_HEADER = struct.Struct(">III")
+BLOOM_HASH_VERSION = 1
+BLOOM_NUM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_MAX_CHANGES = 512
+BLOOM_SEEDS = (0x293ae76f, 0x7e646e2c)
+
+class GitCommitGraph(object):
+    path = None
+    count = 0
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, hash_version, chunks, bases = GRAPH_HEADER.unpack_from(self.data, 0)
+        if signature != GRAPH_SIGNATURE or version != 1 or hash_version != 1:
+            raise Exception("Unsupported commit-graph {}".format(path))
+
+        self.chunks = chunk_table_parse(self.data, GRAPH_HEADER.size, chunks)
+        for chunk in (GRAPH_CHUNK_FANOUT, GRAPH_CHUNK_OIDS, GRAPH_CHUNK_DATA):
+            if not chunk in self.chunks:
+                raise Exception("Commit-graph {} lacks chunk {}".format(path, chunk.decode("ascii")))
+
+        self.fanout = struct.unpack_from(">256I", self.data, self.chunks[GRAPH_CHUNK_FANOUT][0])
+        self.count = self.fanout[255]
+        self.oids = self.chunks[GRAPH_CHUNK_OIDS][0]
+        self.commits = self.chunks[GRAPH_CHUNK_DATA][0]
+        self.edges = self.chunks.get(GRAPH_CHUNK_EDGES, (None, None))[0]
+
+        self.bloom_index = self.bloom_data = None
+        if GRAPH_CHUNK_BLOOM_INDEX in self.chunks and GRAPH_CHUNK_BLOOM_DATA in self.chunks:
+            start = self.chunks[GRAPH_CHUNK_BLOOM_DATA][0]
+            version, hashes, bits = BLOOM_HEADER.unpack_from(self.data, start)
+            # Filters written with other settings can't be queried with ours.
+            if (version, hashes, bits) == (BLOOM_HASH_VERSION, BLOOM_NUM_HASHES, BLOOM_BITS_PER_ENTRY):
+                self.bloom_index = self.chunks[GRAPH_CHUNK_BLOOM_INDEX][0]
+                self.bloom_data = start + BLOOM_HEADER.size
+
+    def __len__(self):
+        return self.count
+
+    def sha_at(self, i):
+        start = self.oids + 20 * i
+        return self.data[start:start + 20]
+
+    def find(self, binsha):
+        lo = self.fanout[binsha[0] - 1] if binsha[0] else 0
+        hi = self.fanout[binsha[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self.sha_at(mid)
+            if found < binsha:
+                lo = mid + 1
+            elif found > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def commit_at(self, i):
+        # Returns (tree, parent positions, commit date, generation).
+        tree, first, second, high, low = GRAPH_DATA.unpack_from(self.data, self.commits + GRAPH_DATA.size * i)
+        parents = list()
+        if first != GRAPH_PARENT_NONE:
+            parents.append(first)
+            if second & GRAPH_EXTRA_EDGES:
+                # Octopus merge: the other parents are in the edge list.
+                edge = self.edges + 4 * (second & ~GRAPH_EXTRA_EDGES)
+                while True:
+                    pos = struct.unpack_from(">I", self.data, edge)[0]
+                    parents.append(pos & ~GRAPH_LAST_EDGE)
+                    if pos & GRAPH_LAST_EDGE:
+                        break
+                    edge += 4
+            elif second != GRAPH_PARENT_NONE:
+                parents.append(second)
+        return tree, parents, ((high & 0x3) << 32) | low, high >> 2
+
+    def bloom_at(self, i):
+        # The changed-path filter of commit i, or None.
+        if self.bloom_index is None:
+            return None
+        start = struct.unpack_from(">I", self.data, self.bloom_index + 4 * (i - 1))[0] if i else 0
+        end = struct.unpack_from(">I", self.data, self.bloom_index + 4 * i)[0]
+        return self.data[self.bloom_data + start:self.bloom_data + end]
+
+def commit_graph_path(repo):
+    return repo_path(repo, "objects", "info", "commit-graph")
+
+def commit_graph_read(repo):
+    # The graph is mapped once per repository, and again only when the
+    # file was rewritten.  Returns None without a graph, or when
+    # core.commitGraph is off.
+    if not repo.conf.getboolean("core", "commitGraph", fallback=True):
+        return None
+    path = commit_graph_path(repo)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    if repo.graph is not None and repo.graph_mtime == mtime:
+        return repo.graph
+
+    repo.graph = GitCommitGraph(path)
+    repo.graph_mtime = mtime
+    return repo.graph
+
+def commit_info(repo, sha):
+    # Returns (parents, commit date, generation, tree) for a commit, from
+    # the graph when it has it and from the object otherwise.
+    graph = commit_graph_read(repo)
+    if graph:
+        i = graph.find(bytes.fromhex(sha))
+        if i is not None:
+            tree, parents, date, generation = graph.commit_at(i)
+            return [graph.sha_at(p).hex() for p in parents], date, generation, tree.hex()
+
+    commit = object_read(repo, sha)
+    if commit is None or commit.fmt != b'commit':
+        raise Exception("Not a commit: {}".format(sha))
+    return commit.parents, commit_date(commit), GENERATION_INFINITY, commit.tree
+
+def commit_parents(repo, sha):
+    return commit_info(repo, sha)[0]
+
+def commit_walk(repo, tips, topo=False, since=None, simplify=None):
+    # Yields the commits reachable from tips, newest first, without ever
+    # holding more than the walk's frontier: a commit is only looked at
+    # once a child was output.  With since, stops once everything left is
+    # older.  topo only outputs a commit after all its children, which
+    # needs the whole reachable set first.  simplify(sha, info) returns
+    # whether to output a commit and which of its parents to follow.
+    if topo:
+        yield from commit_walk_topo(repo, tips, simplify)
+        return
+
+    heap = list()
+    info = dict()
+    seq = 0
+    for sha in tips:
+        if not sha in info:
+            info[sha] = commit_info(repo, sha)
+            heapq.heappush(heap, (-info[sha][1], seq, sha))
+            seq += 1
+
+    while heap:
+        date, _, sha = heapq.heappop(heap)
+        if since is not None and -date < since:
+            return
+        show, parents = simplify(sha, info[sha]) if simplify else (True, info[sha][0])
+        if show:
+            yield sha
+        for p in parents:
+            if not p in info:
+                info[p] = commit_info(repo, p)
+                heapq.heappush(heap, (-info[p][1], seq, p))
+                seq += 1
+
+def commit_walk_topo(repo, tips, simplify=None):
+    info = dict()
+    follow = dict()
+    indegree = dict()
+    stack = list(tips)
+    while stack:
+        sha = stack.pop()
+        if sha in info:
+            continue
+        info[sha] = commit_info(repo, sha)
+        show, parents = simplify(sha, info[sha]) if simplify else (True, info[sha][0])
+        follow[sha] = (show, parents)
+        for p in parents:
+            indegree[p] = indegree.get(p, 0) + 1
+            stack.append(p)
+
+    # Last in, first out: a merge's second parent line comes out before
+    # the first parent's, like git log --topo-order.
+    queue = list()
+    for sha in reversed(tips):
+        if not indegree.get(sha) and not sha in queue:
+            queue.append(sha)
+    while queue:
+        sha = queue.pop()
+        show, parents = follow[sha]
+        if show:
+            yield sha
+        for p in parents:
+            indegree[p] -= 1
+            if indegree[p] == 0:
+                queue.append(p)
+
+class GitPathFilter(object):
+    # History simplification for logbab -- <path>: a commit is shown when
+    # the paths differ from every parent; otherwise only the first parent
+    # they are the same in is followed, like git log does by default.
+    # Before comparing trees with the first parent, the commit's Bloom
+    # filter is asked whether the paths may have changed at all.
+    def __init__(self, repo, paths):
+        self.repo = repo
+        self.paths = paths
+        self.keys = list()
+        for path in paths:
+            # The path and each of its leading directories must be there.
+            parts = path.split("/")
+            self.keys.append([bloom_key("/".join(parts[:i])) for i in range(len(parts), 0, -1)])
+        self.stats = collections.OrderedDict(
+            [("no filter", 0), ("definitely not", 0), ("maybe", 0), ("false positive", 0)])
+
+    def simplify(self, sha, info):
+        parents, date, generation, tree = info
+        if not parents:
+            return self.changed(tree, None), parents
+
+        maybe = self.bloom_maybe(sha)
+        for i, p in enumerate(parents):
+            if i == 0 and maybe is False:
+                return False, [p]
+            if not self.changed(tree, commit_info(self.repo, p)[3]):
+                if i == 0 and maybe:
+                    self.stats["false positive"] += 1
+                return False, [p]
+        return True, parents
+
+    def bloom_maybe(self, sha):
+        # True or False when the commit has a filter, None otherwise.
+        graph = commit_graph_read(self.repo)
+        i = graph.find(bytes.fromhex(sha)) if graph else None
+        filter = graph.bloom_at(i) if i is not None else None
+        if filter is None:
+            self.stats["no filter"] += 1
+            return None
+        for keys in self.keys:
+            if all(bloom_filter_contains(filter, key) for key in keys):
+                self.stats["maybe"] += 1
+                return True
+        self.stats["definitely not"] += 1
+        return False
+
+    def changed(self, tree, parent_tree):
+        for path in self.paths:
+            a = tree_lookup(self.repo, tree, path) if tree else None
+            b = tree_lookup(self.repo, parent_tree, path) if parent_tree else None
+            if (a and a.raw_sha, a and a.mode) != (b and b.raw_sha, b and b.mode):
+                return True
+        return False
+
+    def false_positive_rate(self):
+        maybe = self.stats["maybe"]
+        return self.stats["false positive"] / maybe if maybe else 0.0
+
+def bloom_murmur3(seed, data):
+    # git's murmur3 for version 1 filters, which reads the path as signed
+    # chars: bytes over 0x7f are sign-extended.
+    mask = 0xFFFFFFFF
+    signed = [b - 256 if b & 0x80 else b for b in data]
+
+    def rotl(x, r):
+        return ((x << r) | (x >> (32 - r))) & mask
+
+    h = seed
+    blocks = len(data) // 4
+    for i in range(blocks):
+        k = (signed[4 * i] | (signed[4 * i + 1] << 8) | (signed[4 * i + 2] << 16) | (signed[4 * i + 3] << 24)) & mask
+        k = (k * 0xcc9e2d51) & mask
+        k = rotl(k, 15)
+        k = (k * 0x1b873593) & mask
+        h ^= k
+        h = rotl(h, 13)
+        h = (h * 5 + 0xe6546b64) & mask
+
+    tail = signed[4 * blocks:]
+    k = 0
+    if len(tail) == 3:
+        k ^= tail[2] << 16
+    if len(tail) >= 2:
+        k ^= tail[1] << 8
+    if tail:
+        k ^= tail[0]
+        k &= mask
+        k = (k * 0xcc9e2d51) & mask
+        k = rotl(k, 15)
+        k = (k * 0x1b873593) & mask
+        h ^= k
+
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & mask
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & mask
+    h ^= h >> 16
+    return h
+
+def bloom_key(path):
+    data = path.encode("utf8")
+    first = bloom_murmur3(BLOOM_SEEDS[0], data)
+    second = bloom_murmur3(BLOOM_SEEDS[1], data)
+    return [(first + i * second) & 0xFFFFFFFF for i in range(BLOOM_NUM_HASHES)]
+
+def bloom_filter_contains(filter, key):
+    bits = len(filter) * 8
+    for h in key:
+        pos = h % bits
+        if not filter[pos >> 3] & (1 << (pos & 7)):
+            return False
+    return True
+
+def bloom_filter_build(paths):
+    size = (len(paths) * BLOOM_BITS_PER_ENTRY + 7) // 8 or 1
+    filter = bytearray(size)
+    for path in paths:
+        for h in bloom_key(path):
+            pos = h % (size * 8)
+            filter[pos >> 3] |= 1 << (pos & 7)
+    return bytes(filter)
+
+def bloom_commit_filter(repo, tree, parent_tree):
+    # tree and parent_tree are hex SHAs, parent_tree None for a root commit.
+    paths = set()
+    changes = 0
+    for path in tree_diff(repo, parent_tree, tree):
+        changes += 1
+        if changes > BLOOM_MAX_CHANGES:
+            return b'\xff'
+        while path and not path in paths:
+            paths.add(path)
+            path = path.rpartition("/")[0]
+    return bloom_filter_build(paths)
+
+def commit_date(commit):
+    # Committer line: "Name <email> timestamp timezone".
+    return int(commit.kvlm[b'committer'].rsplit(b' ', 2)[1])
+
+def commit_graph_tips(repo):
+    tips = list()
+    stack = [ref_list(repo)]
+    while stack:
+        refs = stack.pop()
+        for v in refs.values():
+            if isinstance(v, dict):
+                stack.append(v)
+            elif v:
+                tips.append(v)
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        tips.append(head)
+    return tips
+
+def commit_graph_load(repo, tips):
+    # Every commit reachable from tips, as sha -> (tree, parents, date).
+    # Commits already in the current graph aren't read again.
+    graph = commit_graph_read(repo)
+    commits = dict()
+    stack = list(tips)
+    while stack:
+        sha = stack.pop()
+        if sha in commits:
+            continue
+
+        i = graph.find(bytes.fromhex(sha)) if graph else None
+        if i is not None:
+            tree, parents, date, generation = graph.commit_at(i)
+            commits[sha] = (tree, [graph.sha_at(p).hex() for p in parents], date)
+        else:
+            obj = object_read(repo, sha)
+            if obj is None:
+                raise Exception("Missing commit {}".format(sha))
+            # Refs can point to tags: the graph only holds commits.
+            while obj.fmt == b'tag':
+                sha = obj.kvlm[b'object'].decode("ascii")
+                obj = object_read(repo, sha)
+            if obj.fmt != b'commit' or sha in commits:
+                continue
+            commits[sha] = (bytes.fromhex(obj.tree), obj.parents, commit_date(obj))
+
+        stack.extend(commits[sha][1])
+    return commits
+
+def commit_graph_generations(commits):
+    # Topological levels: 1 for root commits, one more than the highest
+    # parent otherwise.  Iterative, so long histories don't recurse.
+    generations = dict()
+    for sha in commits:
+        stack = [sha]
+        while stack:
+            top = stack[-1]
+            if top in generations:
+                stack.pop()
+                continue
+            pending = [p for p in commits[top][1] if not p in generations]
+            if pending:
+                stack.extend(pending)
+                continue
+            generations[top] = min(GENERATION_MAX,
+                                   1 + max([generations[p] for p in commits[top][1]], default=0))
+            stack.pop()
+    return generations
+
+def commit_graph_write(repo, tips=None, changed_paths=None):
+    # changed_paths: whether to compute Bloom filters; by default, keep
+    # doing what the current graph does.  Filters already in the current
+    # graph are reused.
+    if tips is None:
+        tips = commit_graph_tips(repo)
+    old = commit_graph_read(repo)
+    if changed_paths is None:
+        changed_paths = bool(old and old.bloom_index is not None)
+    commits = commit_graph_load(repo, tips)
+    generations = commit_graph_generations(commits)
+
+    order = sorted(commits)
+    positions = {sha: i for (i, sha) in enumerate(order)}
+
+    fanout = [0] * 256
+    for sha in order:
+        fanout[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    data = bytearray()
+    edges = list()
+    for sha in order:
+        tree, parents, date = commits[sha]
+        parents = [positions[p] for p in parents]
+        first = parents[0] if parents else GRAPH_PARENT_NONE
+        if len(parents) > 2:
+            second = GRAPH_EXTRA_EDGES | len(edges)
+            edges.extend(parents[1:-1])
+            edges.append(GRAPH_LAST_EDGE | parents[-1])
+        else:
+            second = parents[1] if len(parents) == 2 else GRAPH_PARENT_NONE
+        data += GRAPH_DATA.pack(tree, first, second,
+                                (generations[sha] << 2) | ((date >> 32) & 0x3), date & 0xFFFFFFFF)
+
+    chunks = [(GRAPH_CHUNK_FANOUT, struct.pack(">256I", *fanout)),
+              (GRAPH_CHUNK_OIDS, b''.join(bytes.fromhex(sha) for sha in order)),
+              (GRAPH_CHUNK_DATA, bytes(data))]
+    if edges:
+        chunks.append((GRAPH_CHUNK_EDGES, struct.pack(">{}I".format(len(edges)), *edges)))
+
+    if changed_paths:
+        ends = list()
+        filters = bytearray(BLOOM_HEADER.pack(BLOOM_HASH_VERSION, BLOOM_NUM_HASHES, BLOOM_BITS_PER_ENTRY))
+        for sha in order:
+            i = old.find(bytes.fromhex(sha)) if old else None
+            filter = old.bloom_at(i) if i is not None else None
+            if filter is None:
+                tree, parents, date = commits[sha]
+                parent_tree = commits[parents[0]][0].hex() if parents else None
+                filter = bloom_commit_filter(repo, tree.hex(), parent_tree)
+            filters += filter
+            ends.append(len(filters) - BLOOM_HEADER.size)
+        chunks.append((GRAPH_CHUNK_BLOOM_INDEX, struct.pack(">{}I".format(len(ends)), *ends)))
+        chunks.append((GRAPH_CHUNK_BLOOM_DATA, bytes(filters)))
+
+    raw = chunk_file_build(GRAPH_HEADER.pack(GRAPH_SIGNATURE, 1, 1, len(chunks), 0), chunks)
+
+    repo_directory(repo, "objects", "info", mkdir=True)
+    path = commit_graph_path(repo)
+    with open(path + ".lock", "wb") as f:
+        f.write(raw)
+    os.replace(path + ".lock", path)
+    return path, len(order)
+
+def commit_graph_verify(repo):
+    # Returns a list of problems, empty when the graph matches the objects.
+    graph = commit_graph_read(repo)
+    if graph is None:
+        return ["no commit-graph"]
+
+    errors = list()
+    data = graph.data
+    if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+        errors.append("bad checksum")
+
+    previous = None
+    for i in range(len(graph)):
+        binsha = graph.sha_at(i)
+        sha = binsha.hex()
+        if previous is not None and previous >= binsha:
+            errors.append("{}: out of order".format(sha))
+        previous = binsha
+
+        tree, parents, date, generation = graph.commit_at(i)
+        obj = object_read(repo, sha)
+        if obj is None or obj.fmt != b'commit':
+            errors.append("{}: not a commit".format(sha))
+            continue
+        if tree.hex() != obj.tree:
+            errors.append("{}: wrong tree".format(sha))
+        if [graph.sha_at(p).hex() for p in parents] != obj.parents:
+            errors.append("{}: wrong parents".format(sha))
+        if date != commit_date(obj):
+            errors.append("{}: wrong commit date".format(sha))
+        expected = 1 + max([graph.commit_at(p)[3] for p in parents], default=0)
+        if generation != min(expected, GENERATION_MAX):
+            errors.append("{}: wrong generation".format(sha))
+    return errors
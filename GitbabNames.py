@@ -0,0 +1,213 @@
+import bisect
+import hashlib
+import os
+import struct
+import time
+
+from GitBab.GitbabPack import pack_indexes
+from GitBab.GitbabRepo import repo_directory, repo_file
+
+# Sorted names of the loose objects, kept per fan-out directory so that a
+# prefix lookup or an abbreviation only has to check (and, when its mtime
+# moved, relist) the directory of the name's first byte.  Pack indexes,
+# and the multi-pack-index, are already sorted and are searched in place.
+#
+# With core.objectNameCache the listings are saved to objects/info/names:
+# a header, then for each fan-out directory its mtime when listed and its
+# count, then the binary names of every directory in order, then a SHA-1
+# of all of it.  A directory whose mtime no longer matches is relisted.
+NAMES_FILE = "names"
+NAMES_SIGNATURE = b'GBON'
+NAMES_VERSION = 1
+NAMES_HEADER = struct.Struct(">4sI")
+NAMES_FANOUT = struct.Struct(">256q256I")
+
+# A directory listed this soon after it last changed may change again
+# within the same mtime tick, so its listing is not trusted later on.
+NAMES_RACY_NS = 1000000000
+
+# git's shortest default abbreviation, and the shortest one accepted.
+NAMES_ABBREV = 7
+NAMES_MIN_ABBREV = 4
+
+class GitObjectNames(object):
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = repo_directory(repo, "objects")
+        self.buckets = [None] * 256
+        self.mtimes = [None] * 256
+        self.stored = None
+        self.dirty = False
+        self.lists = 0
+
+    def load(self, path):
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return
+        if len(raw) < NAMES_HEADER.size + NAMES_FANOUT.size + 20 or hashlib.sha1(raw[:-20]).digest() != raw[-20:]:
+            return
+        signature, version = NAMES_HEADER.unpack_from(raw)
+        if signature != NAMES_SIGNATURE or version != NAMES_VERSION:
+            return
+
+        # Only decoded when the directory is asked for and still matches.
+        fanout = NAMES_FANOUT.unpack_from(raw, NAMES_HEADER.size)
+        idx = NAMES_HEADER.size + NAMES_FANOUT.size
+        self.stored = list()
+        for first in range(256):
+            count = fanout[256 + first]
+            self.stored.append((fanout[first], idx, count))
+            idx += 20 * count
+        self.raw = raw
+
+    def bucket(self, first):
+        # The sorted names of the loose objects starting with byte first.
+        if self.path is None:
+            return []
+        prefix = "{:02x}".format(first)
+        try:
+            mtime = os.stat(os.path.join(self.path, prefix)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = 0
+        if self.mtimes[first] == mtime:
+            return self.buckets[first]
+
+        if self.stored and self.stored[first][0] == mtime:
+            _, idx, count = self.stored[first]
+            names = [self.raw[i:i + 20].hex() for i in range(idx, idx + 20 * count, 20)]
+        elif mtime:
+            names = sorted(prefix + f for f in os.listdir(os.path.join(self.path, prefix)) if len(f) == 38)
+            self.lists += 1
+            self.dirty = True
+        else:
+            names = []
+
+        self.buckets[first] = names
+        self.mtimes[first] = mtime if time.time_ns() - mtime > NAMES_RACY_NS else None
+        return names
+
+    def loose(self, prefix):
+        names = self.bucket(int(prefix[:2], 16))
+        i = bisect.bisect_left(names, prefix)
+        ret = list()
+        while i < len(names) and names[i].startswith(prefix):
+            ret.append(names[i])
+            i += 1
+        return ret
+
+    def resolve(self, prefix):
+        # Every object whose name starts with prefix (at least two lowercase
+        # hex digits), sorted.
+        ret = set(self.loose(prefix))
+        for index in pack_indexes(self.repo):
+            ret.update(index.prefix(prefix))
+        return sorted(ret)
+
+    def neighbours(self, sha):
+        # The names right before and right after sha, in the loose objects
+        # and in each pack index: the only ones that can share a longer prefix.
+        names = self.bucket(int(sha[:2], 16))
+        i = bisect.bisect_left(names, sha)
+        if i:
+            yield names[i - 1]
+        if i < len(names) and names[i] == sha:
+            i += 1
+        if i < len(names):
+            yield names[i]
+
+        binsha = bytes.fromhex(sha)
+        for index in pack_indexes(self.repo):
+            i = index.bisect(binsha)
+            if i:
+                yield index.sha_at(i - 1).hex()
+            if i < index.count and index.sha_at(i) == binsha:
+                i += 1
+            if i < index.count:
+                yield index.sha_at(i).hex()
+
+    def abbrev(self, sha, length):
+        # The shortest prefix of sha, no shorter than length, that names
+        # no other object.
+        for other in self.neighbours(sha):
+            common = len(os.path.commonprefix([sha, other]))
+            if common >= length:
+                length = common + 1
+        return sha[:min(length, 40)]
+
+    def count(self):
+        # What git estimates the object count from: the packed objects.
+        return sum(index.count for index in pack_indexes(self.repo))
+
+    def serialize(self):
+        fanout = list()
+        counts = list()
+        names = list()
+        for first in range(256):
+            if self.buckets[first] is None and self.stored:
+                # Not looked at here: kept as loaded, checked on the next load.
+                mtime, idx, count = self.stored[first]
+                fanout.append(mtime)
+                counts.append(count)
+                names.append(self.raw[idx:idx + 20 * count])
+                continue
+            if self.mtimes[first] is None:
+                fanout.append(-1)
+                counts.append(0)
+                continue
+            fanout.append(self.mtimes[first])
+            counts.append(len(self.buckets[first]))
+            names.append(bytes.fromhex("".join(self.buckets[first])))
+        raw = NAMES_HEADER.pack(NAMES_SIGNATURE, NAMES_VERSION) + NAMES_FANOUT.pack(*fanout, *counts) + b''.join(names)
+        return raw + hashlib.sha1(raw).digest()
+
+def object_names_path(repo, mkdir=False):
+    return repo_file(repo, "objects", "info", NAMES_FILE, mkdir=mkdir)
+
+def object_names(repo):
+    if repo.names is None:
+        repo.names = GitObjectNames(repo)
+        if repo.conf.getboolean("core", "objectNameCache", fallback=False):
+            path = object_names_path(repo)
+            if path:
+                repo.names.load(path)
+    return repo.names
+
+def object_names_refresh(repo):
+    # Lists every fan-out directory, so that the saved index covers all of them.
+    names = object_names(repo)
+    for first in range(256):
+        names.bucket(first)
+    return names
+
+def object_names_write(repo):
+    # Saves the listings made so far, if core.objectNameCache asks for it
+    # and anything was listed.
+    names = repo.names
+    if names is None or not names.dirty or names.path is None:
+        return None
+    if not repo.conf.getboolean("core", "objectNameCache", fallback=False):
+        return None
+
+    path = object_names_path(repo, mkdir=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(names.serialize())
+    os.replace(path + ".tmp", path)
+    names.dirty = False
+    return path
+
+def object_abbrev_length(repo):
+    # core.abbrev, or git's "auto": enough hex digits for about one
+    # collision between two random names among the objects there are.
+    value = repo.conf.get("core", "abbrev", fallback="auto")
+    if value.lower() == "no":
+        return 40
+    if value.lower() != "auto":
+        return min(max(int(value), NAMES_MIN_ABBREV), 40)
+    return max(NAMES_ABBREV, (object_names(repo).count().bit_length() + 1) // 2)
+
+def object_abbrev(repo, sha, length=None):
+    if length is None:
+        length = object_abbrev_length(repo)
+    return object_names(repo).abbrev(sha, length)
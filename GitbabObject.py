@@ -1,11 +1,28 @@
+import array
+import bisect
 import collections
+import copy
 import hashlib
-from math import ceil
+import heapq
+import mmap
+import operator
 import os
 import re
+from stat import S_ISDIR, S_ISLNK
+import struct
+import tempfile
+import time
 import zlib
 
-from GitBab.GitbabRepo import ref_resolve, repo_directory, repo_file
+from GitBab.GitbabEwah import ewah_decode, ewah_encode, ewah_from_positions, ewah_positions
+from GitBab.GitbabNames import object_names
+from GitBab.GitbabPack import pack_find, pack_read, pack_stream
+from GitBab.GitbabRepo import config_size, ref_resolve, repo_directory, repo_file
+
+# Blobs at least this large (core.bigFileThreshold) are hashed and written
+# in chunks of OBJECT_STREAM_CHUNK instead of being read whole.
+OBJECT_STREAM_THRESHOLD = "16m"
+OBJECT_STREAM_CHUNK = 64 * 1024
 
 class GitbabObject(object):
     def __init__(self, data=None):
@@ -33,16 +50,50 @@ class GitBlob(GitbabObject):
         self.blobdata = data
 
 class GitCommit(GitbabObject):
+    # The headers are only parsed when kvlm is first used, and an object
+    # that wasn't modified serializes back to its original bytes.
     fmt=b'commit'
+    raw = None
+    parsed = None
 
     def deserialize(self, data):
-        self.kvlm = kvlm_parse(data)
+        self.raw = data
+        self.parsed = None
 
     def serialize(self):
+        if self.parsed is None and self.raw is not None:
+            return self.raw
         return kvlm_serialize(self.kvlm)
 
     def init(self):
-        self.kvlm = dict()
+        self.parsed = collections.OrderedDict()
+
+    @property
+    def kvlm(self):
+        if self.parsed is None:
+            self.parsed = kvlm_parse(self.raw)
+        return self.parsed
+
+    @kvlm.setter
+    def kvlm(self, kvlm):
+        self.parsed = kvlm
+
+    # History walks only need the tree and parents, which come first: read
+    # just those headers when the rest isn't parsed yet.
+    @property
+    def tree(self):
+        if self.parsed is None:
+            return kvlm_commit_links(self.raw)[0]
+        return self.parsed[b'tree'].decode("ascii")
+
+    @property
+    def parents(self):
+        if self.parsed is None:
+            return kvlm_commit_links(self.raw)[1]
+        parents = self.parsed.get(b'parent', [])
+        if type(parents) != list:
+            parents = [ parents ]
+        return [p.decode("ascii") for p in parents]
 
 class GitTree(GitbabObject):
     fmt=b'tree'
@@ -57,19 +108,37 @@ class GitTree(GitbabObject):
         self.items = list()
 
 class GitTreeLeaf (object):
-    def __init__(self, mode, path, sha):
+    # Trees can hold tens of thousands of leaves: no per-leaf dict, and the
+    # SHA is kept as the raw 20 bytes, only turned into hex when asked.
+    __slots__ = ("mode", "path", "raw_sha")
+
+    def __init__(self, mode, path, sha=None, raw_sha=None):
         self.mode = mode
         self.path = path
-        self.sha = sha
+        self.raw_sha = raw_sha if sha is None else bytes.fromhex(sha)
+
+    @property
+    def sha(self):
+        return self.raw_sha.hex()
+
+    @sha.setter
+    def sha(self, sha):
+        self.raw_sha = bytes.fromhex(sha)
 
 class GitTag(GitCommit):
     fmt = b'tag'
 
 class GitIndexEntry (object):
+    __slots__ = ("ctime", "mtime", "dev", "ino", "mode_type", "mode_perms",
+                 "uid", "gid", "fsize", "sha", "flag_assume_valid",
+                 "flag_stage", "flag_skip_worktree", "flag_intent_to_add",
+                 "name")
+
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
                  fsize=None, sha=None, flag_assume_valid=None,
-                 flag_stage=None, name=None):
+                 flag_stage=None, name=None, flag_skip_worktree=False,
+                 flag_intent_to_add=False):
 
       self.ctime = ctime
 
@@ -92,14 +161,54 @@ class GitIndexEntry (object):
       self.sha = sha
       self.flag_assume_valid = flag_assume_valid
       self.flag_stage = flag_stage
+      # Extended flags, only stored by index versions 3 and up.
+      self.flag_skip_worktree = flag_skip_worktree
+      self.flag_intent_to_add = flag_intent_to_add
 
       self.name = name
 
+def index_entry_set_stat(entry, stat):
+    entry.ctime = (int(stat.st_ctime), stat.st_ctime_ns % 10**9)
+    entry.mtime = (int(stat.st_mtime), stat.st_mtime_ns % 10**9)
+    entry.dev = stat.st_dev
+    entry.ino = stat.st_ino
+    entry.uid = stat.st_uid
+    entry.gid = stat.st_gid
+    entry.fsize = stat.st_size
+
+def index_entry_stat_matches(entry, stat):
+    # The index stores stat fields truncated to 32 bits, compare them
+    # the same way.
+    mask = 0xFFFFFFFF
+    if stat_mode_type(stat.st_mode) != entry.mode_type:
+        return False
+    return (entry.mtime[0] & mask == int(stat.st_mtime) & mask and
+            entry.mtime[1] == stat.st_mtime_ns % 10**9 and
+            entry.ctime[0] & mask == int(stat.st_ctime) & mask and
+            entry.ctime[1] == stat.st_ctime_ns % 10**9 and
+            entry.fsize & mask == stat.st_size & mask and
+            entry.ino & mask == stat.st_ino & mask and
+            entry.dev & mask == stat.st_dev & mask)
+
+def stat_mode_type(mode):
+    if S_ISLNK(mode):
+        return 0b1010
+    elif S_ISDIR(mode):
+        return 0b1110
+    return 0b1000
+
 class GitIndex (object):
+    # Entries are kept in git's order (by name, then stage), with a lazily
+    # rebuilt name -> position map, so lookups are O(1), a directory's
+    # entries are a contiguous range found by bisection, and bulk updates
+    # are a single merge instead of a scan per path.
     version = None
-    entries = []
     ext = None
     sha = None
+    positions = None
+    cache_tree = None
+    # Shared base this index was read from, if it is split.
+    split_base = None
 
     def __init__(self, version=2, entries=None):
         if not entries:
@@ -107,6 +216,381 @@ class GitIndex (object):
 
         self.version = version
         self.entries = entries
+        self.ext = collections.OrderedDict()
+
+    @property
+    def entries(self):
+        return self._entries
+
+    @entries.setter
+    def entries(self, entries):
+        # Already sorted input (e.g. read from disk) makes this O(n).
+        self._entries = sorted(entries, key=index_entry_key)
+        self.positions = None
+        self.cache_tree = None
+
+    def position(self, name):
+        if self.positions is None:
+            self.positions = dict()
+            for i, e in enumerate(self._entries):
+                self.positions.setdefault(e.name, i)
+        return self.positions.get(name)
+
+    def find(self, name):
+        i = self.position(name)
+        if i is None:
+            return None
+        return self._entries[i]
+
+    def __contains__(self, name):
+        return self.position(name) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, entry):
+        self.update([entry])
+
+    def update(self, entries):
+        # Insert or replace many entries at once: O(n + m log m).
+        new = collections.OrderedDict((e.name, e) for e in entries)
+        for e in new.values():
+            old = self.find(e.name)
+            if not old or old.sha != e.sha or old.mode_type != e.mode_type or old.mode_perms != e.mode_perms:
+                self.invalidate(e.name)
+        kept = [e for e in self._entries if not e.name in new]
+        self._entries = list(heapq.merge(kept,
+                                         sorted(new.values(), key=index_entry_key),
+                                         key=index_entry_key))
+        self.positions = None
+
+    def remove(self, names):
+        names = set(names)
+        for name in names:
+            self.invalidate(name)
+        self._entries = [e for e in self._entries if not e.name in names]
+        self.positions = None
+
+    def invalidate(self, name):
+        if self.cache_tree:
+            self.cache_tree.invalidate(name)
+
+    def directory(self, path):
+        # Entries under path/ are contiguous in index order; "0" is the
+        # character right after "/".
+        if not path:
+            return 0, len(self._entries)
+        lo = bisect.bisect_left(self._entries, (path + "/",), key=index_entry_key)
+        hi = bisect.bisect_left(self._entries, (path + "0",), key=index_entry_key)
+        return lo, hi
+
+    def directory_entries(self, path):
+        lo, hi = self.directory(path)
+        return self._entries[lo:hi]
+
+    def names(self):
+        return [e.name for e in self._entries]
+
+class GitLazyIndex(object):
+    # Read-only view of an mmapped index file.  Opening it only records
+    # where each entry starts; entries are decoded (and kept) when they
+    # are accessed, and names are binary searched straight in the mmap.
+    # The checksum isn't verified, since that would mean reading it all.
+    # Version 4 names only make sense relative to the previous entry's, so
+    # for those the names are all decoded up front.
+    version = None
+    sha = None
+    raw_names = None
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, self.version, count = INDEX_HEADER.unpack_from(self.data, 0)
+        assert signature == b"DIRC"
+        if not self.version in INDEX_VERSIONS:
+            raise Exception("Unsupported index file version {}".format(self.version))
+
+        self.offsets = array.array("Q")
+        self.decoded = dict()
+        if self.version == 4:
+            self.raw_names = list()
+        idx = INDEX_HEADER.size
+        name = b''
+        for i in range(count):
+            self.offsets.append(idx)
+            name, idx = index_entry_name(self.data, idx, self.version, name)
+            if self.raw_names is not None:
+                self.raw_names.append(name)
+
+        # A split index only holds part of the entries.
+        self.split = False
+        while idx + INDEX_EXT_HEADER.size <= len(self.data) - 20:
+            signature, size = INDEX_EXT_HEADER.unpack_from(self.data, idx)
+            if signature == INDEX_EXT_LINK:
+                self.split = True
+            idx += INDEX_EXT_HEADER.size + size
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if not i in self.decoded:
+            previous = self.raw_names[i - 1] if self.raw_names and i else b''
+            self.decoded[i] = index_entry_decode(self.data, self.offsets[i], self.version, previous)[0]
+        return self.decoded[i]
+
+    def __iter__(self):
+        for i in range(len(self.offsets)):
+            yield self[i]
+
+    def __contains__(self, name):
+        return self.position(name) is not None
+
+    @property
+    def entries(self):
+        return list(self)
+
+    def name_at(self, i):
+        if self.raw_names is not None:
+            return self.raw_names[i]
+        return index_entry_name(self.data, self.offsets[i], self.version)[0]
+
+    def names(self):
+        return [self.name_at(i).decode("utf8") for i in range(len(self.offsets))]
+
+    def bisect(self, name):
+        lo = 0
+        hi = len(self.offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name_at(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def position(self, name):
+        raw_name = name.encode("utf8")
+        i = self.bisect(raw_name)
+        if i < len(self.offsets) and self.name_at(i) == raw_name:
+            return i
+        return None
+
+    def find(self, name):
+        i = self.position(name)
+        if i is None:
+            return None
+        return self[i]
+
+    def directory(self, path):
+        if not path:
+            return 0, len(self.offsets)
+        return self.bisect((path + "/").encode("utf8")), self.bisect((path + "0").encode("utf8"))
+
+    def directory_entries(self, path):
+        lo, hi = self.directory(path)
+        return [self[i] for i in range(lo, hi)]
+
+class GitCacheTree(object):
+    # Node of the index's cache tree (git's TREE extension): the tree
+    # object for one directory, with the number of index entries below it,
+    # or entry_count -1 when a change below it invalidated the SHA.
+    entry_count = -1
+    sha = None
+    children = None
+
+    def __init__(self, data=None):
+        self.children = dict()
+        if data != None:
+            self.deserialize(data)
+
+    def deserialize(self, data):
+        # Pre-order list of nodes: path NUL, "entry_count subtree_count" LF,
+        # then the SHA if the node is valid.
+        stack = list()
+        pos = 0
+        first = True
+        while pos < len(data):
+            end = data.index(b'\x00', pos)
+            name = data[pos:end].decode("utf8")
+            nl = data.index(b'\n', end)
+            entry_count, subtrees = [int(x) for x in data[end + 1:nl].split(b' ')]
+            pos = nl + 1
+
+            if first:
+                node = self
+                first = False
+            else:
+                parent, remaining = stack[-1]
+                node = GitCacheTree()
+                parent.children[name] = node
+                stack[-1] = (parent, remaining - 1)
+
+            node.entry_count = entry_count
+            if entry_count >= 0:
+                node.sha = data[pos:pos + 20].hex()
+                pos += 20
+
+            while stack and stack[-1][1] == 0:
+                stack.pop()
+            if subtrees:
+                stack.append((node, subtrees))
+
+    def serialize(self):
+        ret = bytearray()
+        stack = [("", self)]
+        while stack:
+            name, node = stack.pop()
+            ret += name.encode("utf8") + b'\x00'
+            ret += "{} {}\n".format(node.entry_count, len(node.children)).encode("ascii")
+            if node.entry_count >= 0:
+                ret += bytes.fromhex(node.sha)
+            for child in sorted(node.children, reverse=True):
+                stack.append((child, node.children[child]))
+        return bytes(ret)
+
+    def invalidate(self, path):
+        node = self
+        parts = path.split("/")[:-1]
+        while node:
+            node.entry_count = -1
+            node.sha = None
+            if not parts:
+                break
+            node = node.children.get(parts.pop(0))
+
+class GitUntrackedCache(object):
+    # Directory listings of the worktree, keyed by path relative to the
+    # worktree ("" is the root), valid while the directory's mtime is
+    # unchanged.  A listing is (mtime_ns, files, subdirectories).  The
+    # whole cache is only valid for the ignore rules it was built with.
+    ignore_hash = None
+    scan_time_ns = 0
+    dirs = None
+
+    def __init__(self, data=None):
+        self.dirs = dict()
+        if data != None:
+            self.deserialize(data)
+
+    def deserialize(self, data):
+        self.ignore_hash = data[:20]
+        self.scan_time_ns, count = struct.unpack_from(">QI", data, 20)
+        idx = 32
+        for i in range(count):
+            mtime_ns, nfiles, ndirs = struct.unpack_from(">QII", data, idx)
+            idx += 16
+            names = list()
+            for j in range(1 + nfiles + ndirs):
+                end = data.index(b'\x00', idx)
+                names.append(data[idx:end].decode("utf8"))
+                idx = end + 1
+            self.dirs[names[0]] = (mtime_ns, names[1:1 + nfiles], names[1 + nfiles:])
+
+    def serialize(self):
+        ret = bytearray(self.ignore_hash)
+        ret += struct.pack(">QI", self.scan_time_ns, len(self.dirs))
+        for path in sorted(self.dirs):
+            (mtime_ns, files, dirs) = self.dirs[path]
+            ret += struct.pack(">QII", mtime_ns, len(files), len(dirs))
+            for name in [path] + files + dirs:
+                ret += name.encode("utf8") + b'\x00'
+        return bytes(ret)
+
+    def get(self, path, mtime_ns):
+        # A directory changed around the time it was scanned may have
+        # changed again after we listed it without its mtime moving, so
+        # only trust listings of directories last modified a full second
+        # (the coarsest common timestamp granularity) before the scan.
+        cached = self.dirs.get(path)
+        if cached and cached[0] == mtime_ns and mtime_ns < self.scan_time_ns - 10**9:
+            return cached
+        return None
+
+class GitFsmonitorState(object):
+    # The token the fsmonitor daemon handed out last time, and the paths
+    # that weren't known to be clean then.  Paths the daemon doesn't report
+    # as changed since the token, and that aren't listed here, are clean.
+    token = None
+    unclean = None
+
+    def __init__(self, data=None):
+        self.unclean = set()
+        if data != None:
+            self.deserialize(data)
+
+    def deserialize(self, data):
+        names = data.decode("utf8").split("\0")
+        self.token = names[0]
+        self.unclean = set(n for n in names[1:] if n)
+
+    def serialize(self):
+        return "\0".join([self.token] + sorted(self.unclean)).encode("utf8")
+
+def index_entry_key(entry):
+    return (entry.name, int(entry.flag_stage or 0))
+
+class GitObjectReader(object):
+    # File-like access to an object's body, produced in chunks of at most
+    # OBJECT_STREAM_CHUNK bytes.  When fmt/size aren't known up front (loose
+    # objects), only enough is inflated to parse the header.
+    fmt = None
+    size = None
+
+    def __init__(self, chunks, fmt=None, size=None):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+        if fmt is None:
+            while not b'\x00' in self.buffer:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    raise Exception("Malformed object: truncated header")
+                self.buffer += chunk
+            header, self.buffer = self.buffer.split(b'\x00', 1)
+            fmt, size = header.split(b' ')
+            size = int(size.decode("ascii"))
+
+        self.fmt = fmt
+        self.size = size
+        self.remaining = size - len(self.buffer)
+
+    def __iter__(self):
+        if self.buffer:
+            buffer, self.buffer = self.buffer, b''
+            yield buffer
+        for chunk in self.chunks:
+            self.remaining -= len(chunk)
+            yield chunk
+        if self.remaining != 0:
+            raise Exception("Malformed object: bad length")
+
+    def read(self, n=-1):
+        if n < 0:
+            return b''.join(self)
+
+        ret = list()
+        while n > 0:
+            if not self.buffer:
+                self.buffer = next(self.chunks, b'')
+                self.remaining -= len(self.buffer)
+                if not self.buffer:
+                    break
+            ret.append(self.buffer[:n])
+            n -= len(ret[-1])
+            self.buffer = self.buffer[len(ret[-1]):]
+        return b''.join(ret)
+
+    def close(self):
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 class GitIgnore(object):
     absolute = None
@@ -116,126 +600,144 @@ class GitIgnore(object):
         self.absolute = absolute
         self.scoped = scoped
 
-def tree_parse_one(raw, start=0):
-    x = raw.find(b' ', start)
-    assert x-start == 5 or x-start==6
+# One tree entry: mode, space, path, NUL and the raw SHA-1.
+TREE_ENTRY = re.compile(rb"([0-7]{5,6}) ([^\x00]*)\x00(.{20})", re.DOTALL)
 
-    mode = raw[start:x]
-    if len(mode) == 5:
-        mode = b" " + mode
-    y = raw.find(b'\x00', x)
-    path = raw[x+1:y]
-
-    raw_sha = int.from_bytes(raw[y+1:y+21], "big")
-    sha = format(raw_sha, "040x")
-    return y+21, GitTreeLeaf(mode, path.decode("utf8"), sha)
+# Trees store the mode of subtrees without padding.
+TREE_MODES = {b"40000": b"040000"}
 
 def tree_parse(raw):
-    pos = 0
-    max = len(raw)
-    ret = list()
-    while pos < max:
-        pos, data = tree_parse_one(raw, pos)
-        ret.append(data)
+    # raw can be bytes or a memoryview over the object data: the regex
+    # scans it in place and only copies out the fields.
+    items = TREE_ENTRY.findall(raw)
 
-    return ret
+    # findall skips anything that doesn't match, so make sure the entries
+    # cover the whole object.
+    if sum(len(mode) + len(path) for (mode, path, sha) in items) + 22 * len(items) != len(raw):
+        raise Exception("Malformed tree object")
+
+    modes = TREE_MODES
+    return [GitTreeLeaf(modes.get(mode, mode), path.decode("utf8"), raw_sha=sha)
+            for (mode, path, sha) in items]
 
 def tree_leaf_sort_key(leaf):
-    if leaf.mode.startswith(b"10"):
-        return leaf.path
-    else:
+    # Only subtrees sort as if their name ended in "/": symlinks and
+    # gitlinks sort like files.
+    if leaf.mode == b"040000":
         return leaf.path + "/"
+    else:
+        return leaf.path
 
 def tree_serialize(obj):
     obj.items.sort(key=tree_leaf_sort_key)
-    ret = b''
+    ret = list()
     for i in obj.items:
-        ret += i.mode
-        ret += b' '
-        ret += i.path.encode("utf8")
-        ret += b'\x00'
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder="big")
-    return ret
+        # Trees are stored as "40000", without the padding.
+        ret.append(b"%s %s\x00%s" % (i.mode.lstrip(b"0"), i.path.encode("utf8"), i.raw_sha))
+    return b''.join(ret)
+
+def tree_lookup(repo, sha, path):
+    # The leaf at path (a/b/c) below tree sha, or None.
+    leaf = None
+    for name in path.split("/"):
+        tree = object_read(repo, sha)
+        if tree is None or tree.fmt != b'tree':
+            return None
+        for leaf in tree.items:
+            if leaf.path == name:
+                break
+        else:
+            return None
+        sha = leaf.sha
+    return leaf
+
+def tree_diff(repo, old, new):
+    # Yields the paths of the files (non-tree entries) that differ between
+    # trees old and new, either of which can be None for an empty tree.
+    # Subtrees with the same SHA are skipped without being read.
+    stack = [(old, new, "")]
+    while stack:
+        old, new, prefix = stack.pop()
+        old_items = {l.path: l for l in object_read(repo, old).items} if old else dict()
+        new_items = {l.path: l for l in object_read(repo, new).items} if new else dict()
+
+        for name in sorted(old_items.keys() | new_items.keys()):
+            a = old_items.get(name)
+            b = new_items.get(name)
+            if a and b and a.raw_sha == b.raw_sha and a.mode == b.mode:
+                continue
+
+            path = prefix + name
+            a_tree = a.sha if a and a.mode == b"040000" else None
+            b_tree = b.sha if b and b.mode == b"040000" else None
+            if a_tree or b_tree:
+                stack.append((a_tree, b_tree, path + "/"))
+            if (a and not a_tree) or (b and not b_tree):
+                yield path
 
 def tree_checkout(repo, tree, path):
     for item in tree.items:
-        obj = object_read(repo, item.sha)
         dest = os.path.join(path, item.path)
 
-        if obj.fmt == b'tree':
-            os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
-            # @TODO Support symlinks (identified by mode 12****)
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
-
-def tree_from_index(repo, index):
-    contents = dict()
-    contents[""] = list()
-
-    # Enumerate entries, and turn them into a dictionary where keys
-    # are directories, and values are lists of directory contents.
-    for entry in index.entries:
-        dirname = os.path.dirname(entry.name)
-
-        # We create all dictonary entries up to root ("").  We need
-        # them *all*, because even if a directory holds no files it
-        # will contain at least a tree.
-        key = dirname
-        while key != "":
-            if not key in contents:
-                contents[key] = list()
-            key = os.path.dirname(key)
-
-        # For now, simply store the entry in the list.
-        contents[dirname].append(entry)
-
-    # Get keys (= directories) and sort them by length, descending.
-    # This means that we'll always encounter a given path before its
-    # parent, which is all we need, since for each directory D we'll
-    # need to modify its parent P to add D's tree.
-    sorted_paths = sorted(contents.keys(), key=len, reverse=True)
-
-    # This variable will store the current tree's SHA-1.  After we're
-    # done iterating over our dict, it will contain the hash for the
-    # root tree.
-    sha = None
-
-    # We ge through the sorted list of paths (dict keys)
-    for path in sorted_paths:
-        # Prepare a new, empty tree object
-        tree = GitTree()
-
-        # Add each entry to our new tree, in turn
-        for entry in contents[path]:
-            # An entry can be a normal GitIndexEntry read from the
-            # index, or a tree we've created.
-            if isinstance(entry, GitIndexEntry): # Regular entry (a file)
-
-                # We transcode the mode: the entry stores it as integers,
-                # we need an octal ASCII representation for the tree.
-                leaf_mode = "{:02o}{:04o}".format(entry.mode_type, entry.mode_perms).encode("ascii")
-                leaf = GitTreeLeaf(mode = leaf_mode, path=os.path.basename(entry.name), sha=entry.sha)
-            else: # Tree.  We've stored it as a pair: (basename, SHA)
-                leaf = GitTreeLeaf(mode = b"040000", path=entry[0], sha=entry[1])
-
-            tree.items.append(leaf)
+        if item.mode == b"120000":
+            # A symlink's blob holds its target.
+            os.symlink(os.fsdecode(object_read(repo, item.sha).blobdata), dest)
+            continue
 
-        # Write the new tree object to the store.
-        sha = object_write(tree, repo)
+        with object_stream(repo, item.sha) as stream:
+            if stream.fmt == b'tree':
+                os.mkdir(dest)
+                tree_checkout(repo, GitTree(stream.read()), dest)
+            elif stream.fmt == b'blob':
+                with open(dest, 'wb') as f:
+                    for chunk in stream:
+                        f.write(chunk)
 
-        # Add the new tree hash to the current dictionary's parent, as
-        # a pair (basename, SHA)
-        parent = os.path.dirname(path)
-        base = os.path.basename(path) # The name without the path, eg main.go for src/main.go
-        contents[parent].append((base, sha))
-
-    return sha
+def tree_from_index(repo, index):
+    # Directories whose cache tree node is still valid are reused as is;
+    # only trees along changed paths are rebuilt and written.
+    if index.cache_tree is None:
+        index.cache_tree = GitCacheTree()
+    return tree_from_index_range(repo, index, index.cache_tree, "", 0, len(index.entries))
+
+def tree_from_index_range(repo, index, node, path, lo, hi):
+    # entries[lo:hi] are exactly the index entries under path.
+    if node.entry_count >= 0 and node.sha:
+        return node.sha
+
+    entries = index.entries
+    prefix = path + "/" if path else ""
+    tree = GitTree()
+    children = dict()
+
+    i = lo
+    while i < hi:
+        entry = entries[i]
+        name = entry.name[len(prefix):]
+        slash = name.find("/")
+
+        if slash < 0: # Regular entry (a file)
+            # We transcode the mode: the entry stores it as integers,
+            # we need an octal ASCII representation for the tree.
+            leaf_mode = "{:02o}{:04o}".format(entry.mode_type, entry.mode_perms).encode("ascii")
+            tree.items.append(GitTreeLeaf(mode=leaf_mode, path=name, sha=entry.sha))
+            i += 1
+        else: # Subdirectory: its entries are the next contiguous range.
+            name = name[:slash]
+            sub_lo, sub_hi = index.directory(prefix + name)
+            child = node.children.get(name) or GitCacheTree()
+            sha = tree_from_index_range(repo, index, child, prefix + name, sub_lo, sub_hi)
+            children[name] = child
+            tree.items.append(GitTreeLeaf(mode=b"040000", path=name, sha=sha))
+            i = sub_hi
+
+    node.children = children
+    node.sha = object_write(tree, repo)
+    node.entry_count = hi - lo
+    return node.sha
 
 def kvlm_serialize(kvlm):
-    ret = b''
+    ret = list()
 
     for k in kvlm.keys():
         if k == None: continue
@@ -244,98 +746,223 @@ def kvlm_serialize(kvlm):
             val = [ val ]
 
         for v in val:
-            ret += k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
+            ret.append(k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n')
 
-    ret += b'\n' + kvlm[None] + b'\n'
+    ret.append(b'\n')
+    ret.append(kvlm[None])
 
-    return ret
-
-def kvlm_parse(raw, start=0, dct=None):
-    # Key-Value List with Message
-    if not dct:
-        dct = collections.OrderedDict()
-
-    spc = raw.find(b' ', start)  # space
-    nl = raw.find(b'\n', start)  # new line
-
-    # if space appers before newline, there is a keyword
-
-    # basecase
-    # if newline appers first (or there is no space at all, in which case return -1), there is a blank line. A blank line means the remainder of the data is message.
-    if spc < 0 or nl < spc:
-        assert(nl == start)
-        dct[b''] = raw[start+1:]  # '': message...
-        return dct
+    return b''.join(ret)
 
-    # read keyword
-    key = raw[start:spc]
+# One header: key, space, then the value up to the first newline that
+# isn't followed by a space (those start continuation lines).
+KVLM_HEADER = re.compile(rb"([^ \n]+) ([^\n]*(?:\n [^\n]*)*)\n")
 
-    # find the end of the value
-    end = start
+def kvlm_commit_links(raw):
+    # The tree and parents of a commit, from its leading headers.
+    tree = None
+    parents = list()
+    start = 0
+    match = KVLM_HEADER.match
     while True:
-        end = raw.find(b'\n', end + 1)
-        if raw[end + 1] != ord(' '):
+        m = match(raw, start)
+        if not m:
             break
+        key = m.group(1)
+        if key == b'parent':
+            parents.append(m.group(2).decode("ascii"))
+        elif key == b'tree':
+            tree = m.group(2).decode("ascii")
+        else:
+            break
+        start = m.end()
+    return tree, parents
+
+def kvlm_parse(raw):
+    # Key-Value List with Message: headers, then a blank line and the
+    # message.  The message (key None) is a memoryview over raw.
+    dct = collections.OrderedDict()
+    size = len(raw)
+    start = 0
+    match = KVLM_HEADER.match
+
+    while start < size and raw[start] != 0x0a:
+        m = match(raw, start)
+        if not m:
+            raise Exception("Malformed object header")
+        key, value = m.groups()
+        if b'\n ' in value:
+            value = value.replace(b'\n ', b'\n')
+
+        if key in dct:  # do not overwrite the existing data
+            if type(dct[key]) == list:
+                dct[key].append(value)
+            else:
+                dct[key] = [dct[key], value]
+        else:
+            dct[key] = value
 
-    # read value
-    value = raw[spc+1:end].replace(b'\n', b'\n')
+        start = m.end()
 
-    if key in dct:  # do not overwrite the existing data
-        if type(dct[key]) == list:
-            dct[key].append(value)
-        else:
-            dct[key] = [dct[key], value]
-    else:
-        dct[key] = value
+    dct[None] = memoryview(raw)[start+1:]
+    return dct
 
-    return kvlm_parse(raw, start=end+1, dct=dct)
+def object_read_raw(repo, sha):
+    found = repo.cache.get(sha)
+    if found:
+        return found
+
+    found = object_read_uncached(repo, sha)
+    if found:
+        repo.cache.put(sha, *found)
+    return found
+
+def object_read_uncached(repo, sha):
+    # Packs first: most objects of a long-lived repository live there.
+    found = pack_read(repo, sha)
+    if found:
+        return found
 
-def object_read(repo, sha):
     path = repo_file(repo, "objects", sha[:2], sha[2:])
 
-    if not os.path.isfile(path):
+    if not path or not os.path.isfile(path):
         return None
     with open (path, "rb") as f:
         raw = zlib.decompress(f.read())
-        x = raw.find(b' ')
-        fmt = raw[0:x]
-
-        y = raw.find(b'\x00', x)
-        size = int(raw[x:y].decode("ascii"))
-        if size != len(raw)-y-1:
-            raise Exception("Malformed object {0}: bad length".format(sha))
-        
-        if fmt == b'commit':
-            c = GitbabCommit
-        elif fmt == b'tree':
-            c = GitbabTree
-        elif fmt == b'tag':
-            c = GitbabTag
-        elif fmt == b'blob':
-            c = GitbabBlob
-        else:
-            raise Exception("Unknown type {} for object {}".format(
-                fmt.decode("ascii"), sha))
+    x = raw.find(b' ')
+    fmt = raw[0:x]
+
+    y = raw.find(b'\x00', x)
+    size = int(raw[x:y].decode("ascii"))
+    if size != len(raw)-y-1:
+        raise Exception("Malformed object {0}: bad length".format(sha))
+
+    return fmt, raw[y+1:]
+
+def object_read(repo, sha):
+    found = object_read_raw(repo, sha)
+    if not found:
+        return None
+    fmt, data = found
+
+    if fmt == b'commit':
+        c = GitCommit
+    elif fmt == b'tree':
+        c = GitTree
+    elif fmt == b'tag':
+        c = GitTag
+    elif fmt == b'blob':
+        c = GitBlob
+    else:
+        raise Exception("Unknown type {} for object {}".format(
+            fmt.decode("ascii"), sha))
+
+    return c(data)
 
-        return c(repo, raw[y+1:])
+def object_size(repo, sha):
+    # The size of an object's data, reading no more than its header (or
+    # the start of its delta), or None if there is no such object.
+    found = repo.cache.get(sha)
+    if found:
+        return len(found[1])
 
-def object_write(obj, repo=None): 
-    data = obj.serialize()
-    result = obj.fmt + b' ' + str(len(data)).encode() + b'\x00' + data
+    found = pack_find(repo, sha)
+    if found:
+        pack, offset = found
+        return pack.size_at(offset)
+
+    stream = object_stream(repo, sha)
+    if stream is None:
+        return None
+    with stream:
+        return stream.size
+
+def object_loose_list(repo):
+    path = repo_directory(repo, "objects")
+    ret = list()
+    if not path:
+        return ret
+    for prefix in sorted(os.listdir(path)):
+        if len(prefix) != 2 or not os.path.isdir(os.path.join(path, prefix)):
+            continue
+        for f in sorted(os.listdir(os.path.join(path, prefix))):
+            if len(f) == 38:
+                ret.append(prefix + f)
+    return ret
+
+def object_inflate_chunks(chunks):
+    d = zlib.decompressobj()
+    for chunk in chunks:
+        # Bound each output chunk, and keep draining until zlib has
+        # neither unconsumed input nor pending output.
+        while not d.eof:
+            data = d.decompress(chunk, OBJECT_STREAM_CHUNK)
+            if data:
+                yield data
+            chunk = d.unconsumed_tail
+            if not chunk and not data:
+                break
+        if d.eof:
+            return
+    raise Exception("Malformed object: truncated zlib stream")
+
+def object_file_chunks(path):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(OBJECT_STREAM_CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+def object_stream(repo, sha):
+    found = repo.cache.get(sha)
+    if found:
+        fmt, data = found
+        return GitObjectReader([data], fmt, len(data))
+
+    found = pack_stream(repo, sha)
+    if found:
+        fmt, size, chunks, compressed = found
+        if compressed:
+            chunks = object_inflate_chunks(chunks)
+        return GitObjectReader(chunks, fmt, size)
+
+    path = repo_file(repo, "objects", sha[:2], sha[2:])
+    if not path or not os.path.isfile(path):
+        return None
+    return GitObjectReader(object_inflate_chunks(object_file_chunks(path)))
+
+def object_write(obj, repo=None, mtime=None):
+    return object_write_raw(repo, obj.fmt, obj.serialize(), mtime=mtime)
+
+def object_write_raw(repo, fmt, data, mtime=None):
+    # Stores data as it is, where object_write would serialize it again:
+    # for objects copied out of a pack, whose bytes must not change.
+    result = fmt + b' ' + str(len(data)).encode() + b'\x00' + data
     sha = hashlib.sha1(result).hexdigest()
 
     if repo:
         path=repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
 
         if not os.path.exists(path):
-            with open(path, 'wb') as f:
+            # Written under a temporary name, so that a reader never sees
+            # half an object.  mtime backdates it (for gcbab's expiry).
+            fd, tmp = tempfile.mkstemp(prefix="tmp_obj_", dir=repo_directory(repo, "objects"))
+            with os.fdopen(fd, "wb") as f:
                 f.write(zlib.compress(result))
+            if mtime is not None:
+                os.utime(tmp, (mtime, mtime))
+            os.replace(tmp, path)
     return sha
 
 def object_find(repo, name, fmt=None, follow=True):
     return name
 
 def object_hash(f, fmt, repo=None):
+    if fmt == b'blob':
+        size = os.fstat(f.fileno()).st_size
+        if size >= object_stream_threshold(repo):
+            return object_hash_stream(f, size, fmt, repo)
+
     data = f.read()
 
     if fmt == b'commit':
@@ -351,6 +978,57 @@ def object_hash(f, fmt, repo=None):
 
     return object_write(obj, repo)
 
+def object_stream_threshold(repo=None):
+    if repo:
+        return config_size(repo.conf.get("core", "bigFileThreshold", fallback=OBJECT_STREAM_THRESHOLD))
+    return config_size(OBJECT_STREAM_THRESHOLD)
+
+def object_hash_stream(f, size, fmt, repo=None):
+    # The header only needs the size, so the data can be fed to SHA-1 and
+    # zlib chunk by chunk; peak memory is one chunk whatever the file size.
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+    hash = hashlib.sha1(header)
+
+    out = None
+    if repo:
+        fd, tmp = tempfile.mkstemp(prefix="tmp_obj_", dir=repo_directory(repo, "objects", mkdir=True))
+        out = os.fdopen(fd, "wb")
+        compress = zlib.compressobj()
+        out.write(compress.compress(header))
+
+    try:
+        remaining = size
+        while True:
+            chunk = f.read(OBJECT_STREAM_CHUNK)
+            if not chunk:
+                break
+            hash.update(chunk)
+            if out:
+                out.write(compress.compress(chunk))
+            remaining -= len(chunk)
+
+        if remaining != 0:
+            raise Exception("File changed size while being hashed")
+
+        sha = hash.hexdigest()
+        if out:
+            out.write(compress.flush())
+            out.close()
+            out = None
+            path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+            if os.path.exists(path):
+                os.unlink(tmp)
+            else:
+                os.replace(tmp, path)
+            tmp = None
+    finally:
+        if out:
+            out.close()
+        if repo and tmp:
+            os.unlink(tmp)
+
+    return sha
+
 def object_resolve(repo, name):
     candidates = list()
     hashRE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
@@ -363,14 +1041,7 @@ def object_resolve(repo, name):
 
 
     if hashRE.match(name):
-        name = name.lower()
-        prefix = name[0:2]
-        path = repo_directory(repo, "objects", prefix, mkdir=False)
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    candidates.append(prefix + f)
+        candidates.extend(object_names(repo).resolve(name.lower()))
 
     as_tag = ref_resolve(repo, "refs/tags/" + name)
     if as_tag: 
@@ -397,145 +1068,456 @@ def object_find(repo, name, fmt=None, follow=True):
           return sha
 
       while True:
-          obj = object_read(repo, sha)
+          # Only the header is needed to check the type, so don't inflate
+          # (possibly huge) blobs here.  Tags and commits are small: what
+          # is peeled is read once, from the same stream, and cached.
+          stream = object_stream(repo, sha)
+          if stream is None:
+              raise Exception("Missing object {0}.".format(sha))
+          with stream:
+              if stream.fmt == fmt:
+                  return sha
+              if not follow or not stream.fmt in (b'tag', b'commit'):
+                  return None
+              data = stream.read()
+          repo.cache.put(sha, stream.fmt, data)
+
+          if stream.fmt == b'tag':
+              sha = kvlm_parse(data)[b'object'].decode("ascii")
+          elif fmt == b'tree':
+              sha = kvlm_commit_links(data)[0]
+          else:
+              return None
 
-          if obj.fmt == fmt:
-              return sha
+# Fixed-size part of an index entry: ctime (s, ns), mtime (s, ns), dev,
+# ino, mode, uid, gid, size, SHA-1 and flags.
+INDEX_HEADER = struct.Struct(">4sII")
+INDEX_ENTRY = struct.Struct(">10I20sH")
+INDEX_EXT_HEADER = struct.Struct(">4sI")
+
+# Version 3 adds extended flags to some entries, version 4 drops the
+# entry padding and stores each name as a prefix of the previous one.
+INDEX_VERSIONS = (2, 3, 4)
+
+INDEX_FLAG_ASSUME_VALID = 0x8000
+INDEX_FLAG_EXTENDED = 0x4000
+INDEX_FLAG_STAGE = 0x3000
+INDEX_FLAG_NAME_LENGTH = 0x0FFF
+
+INDEX_EXTENDED_SKIP_WORKTREE = 0x4000
+INDEX_EXTENDED_INTENT_TO_ADD = 0x2000
+
+# git's cache tree extension, see GitCacheTree.
+INDEX_EXT_TREE = b"TREE"
+
+# Extension holding gitbab's untracked cache.  Signatures starting with an
+# uppercase letter are optional, so git itself just skips it.
+INDEX_EXT_UNTRACKED = b"GBUT"
+
+# Extension holding the fsmonitor token of the last status/add.
+INDEX_EXT_FSMONITOR = b"GBFM"
+
+# Split index: SHA-1 of the shared base index, then EWAH bitmaps of the
+# base entries deleted and replaced.
+INDEX_EXT_LINK = b"link"
+
+# Extensions gitbab understands; the others are only carried along.
+INDEX_EXTENSIONS = (INDEX_EXT_TREE, INDEX_EXT_UNTRACKED, INDEX_EXT_FSMONITOR, INDEX_EXT_LINK)
+
+# git extensions that refer to entries by position or to byte offsets in
+# the file: git's fsmonitor dirty bitmap, the end of index entry and the
+# index entry offset table.  They go stale as soon as the entries change,
+# so they are dropped on read rather than written back.  git rebuilds them.
+INDEX_EXT_POSITIONAL = (b"FSMN", b"EOIE", b"IEOT")
+
+# Shared base indexes of split indexes live in the gitdir as
+# sharedindex.<sha>, and are pruned two weeks after their last use.
+INDEX_SHARED_PREFIX = "sharedindex."
+INDEX_SHARED_EXPIRE = 14 * 24 * 3600
+
+# Default splitIndex.maxPercentChange: past this share of changed entries,
+# a new base is written.
+INDEX_SPLIT_MAX_PERCENT = 20
+
+def index_varint_decode(raw, idx):
+    # Same encoding as OFS_DELTA offsets in packs.
+    c = raw[idx]
+    idx += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = raw[idx]
+        idx += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, idx
+
+def index_varint_encode(value):
+    ret = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        value -= 1
+        ret.insert(0, 0x80 | (value & 0x7f))
+        value >>= 7
+    return ret
 
-          if not follow:
-              return None
+def index_entry_decode(raw, idx, version=2, previous=b''):
+    # Returns the entry and the offset of the next one.
+    (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode, uid, gid, fsize,
+     sha, flags) = INDEX_ENTRY.unpack_from(raw, idx)
+
+    assert mode >> 16 == 0
+    mode_type = mode >> 12
+    assert mode_type in [0b1000, 0b1010, 0b1110]
+    mode_perms = mode & 0b0000000111111111
+
+    flag_assume_valid = (flags & INDEX_FLAG_ASSUME_VALID) != 0
+    flag_stage =  flags & INDEX_FLAG_STAGE
+
+    extended = 0
+    if flags & INDEX_FLAG_EXTENDED:
+        if version < 3:
+            raise Exception("Extended flags in a version {} index".format(version))
+        extended = struct.unpack_from(">H", raw, idx + INDEX_ENTRY.size)[0]
+
+    name, next_idx = index_entry_name(raw, idx, version, previous)
+
+    entry = GitIndexEntry(ctime=(ctime_s, ctime_ns),
+                          mtime=(mtime_s,  mtime_ns),
+                          dev=dev,
+                          ino=ino,
+                          mode_type=mode_type,
+                          mode_perms=mode_perms,
+                          uid=uid,
+                          gid=gid,
+                          fsize=fsize,
+                          sha=sha.hex(),
+                          flag_assume_valid=flag_assume_valid,
+                          flag_stage=flag_stage,
+                          flag_skip_worktree=(extended & INDEX_EXTENDED_SKIP_WORKTREE) != 0,
+                          flag_intent_to_add=(extended & INDEX_EXTENDED_INTENT_TO_ADD) != 0,
+                          name=name.decode("utf8"))
+
+    return entry, next_idx
+
+def index_entry_name(raw, idx, version=2, previous=b''):
+    # Returns the raw name of the entry at idx and the offset of the next
+    # entry.  previous is the name of the preceding entry (version 4).
+    flags = struct.unpack_from(">H", raw, idx + INDEX_ENTRY.size - 2)[0]
+    start = idx + INDEX_ENTRY.size
+    if flags & INDEX_FLAG_EXTENDED:
+        start += 2
+
+    if version == 4:
+        # Number of bytes to drop from the end of the previous name, then
+        # the NUL-terminated suffix to append.
+        strip, start = index_varint_decode(raw, start)
+        end = raw.find(b'\x00', start)
+        return previous[:len(previous) - strip] + raw[start:end], end + 1
+
+    name_length = flags & INDEX_FLAG_NAME_LENGTH
+    if name_length < INDEX_FLAG_NAME_LENGTH:
+        end = start + name_length
+        assert raw[end] == 0x00
+    else:
+        end = raw.find(b'\x00', start + INDEX_FLAG_NAME_LENGTH)
 
-          if obj.fmt == b'tag':
-                sha = obj.kvlm[b'object'].decode("ascii")
-          elif obj.fmt == b'commit' and fmt == b'tree':
-                sha = obj.kvlm[b'tree'].decode("ascii")
-          else:
-              return None
-          
-def index_read(repo):
+    # Entries are NUL-padded to a multiple of 8 bytes.
+    return raw[start:end], idx + ((end - idx + 8) & ~7)
+
+def index_read(repo, lazy=False):
     index_file = repo_file(repo, "index")
 
     if not os.path.exists(index_file):
         return GitIndex()
 
+    if lazy:
+        index = GitLazyIndex(index_file)
+        if not index.split:
+            return index
+        index.data.close()
+
     with open(index_file, 'rb') as f:
         raw = f.read()
 
-    header = raw[:12]
-    signature = header[:4]
-    assert signature == b"DIRC" 
-    version = int.from_bytes(header[4:8], "big")
-    assert version == 2, "gitbab only supports index file version 2"
-    count = int.from_bytes(header[8:12], "big")
-
-    entries = list()
-
-    content = raw[12:]
-    idx = 0
-    for i in range(0, count):
-
-        ctime_s =  int.from_bytes(content[idx: idx+4], "big")
-
-        ctime_ns = int.from_bytes(content[idx+4: idx+8], "big")
-        mtime_s = int.from_bytes(content[idx+8: idx+12], "big")
-        mtime_ns = int.from_bytes(content[idx+12: idx+16], "big")
-        dev = int.from_bytes(content[idx+16: idx+20], "big")
-        ino = int.from_bytes(content[idx+20: idx+24], "big")
-        unused = int.from_bytes(content[idx+24: idx+26], "big")
-        assert 0 == unused
-        mode = int.from_bytes(content[idx+26: idx+28], "big")
-        mode_type = mode >> 12
-        assert mode_type in [0b1000, 0b1010, 0b1110]
-        mode_perms = mode & 0b0000000111111111
-        uid = int.from_bytes(content[idx+28: idx+32], "big")
-        gid = int.from_bytes(content[idx+32: idx+36], "big")
-        fsize = int.from_bytes(content[idx+36: idx+40], "big")
-        sha = format(int.from_bytes(content[idx+40: idx+60], "big"), "040x")
-
-        flags = int.from_bytes(content[idx+60: idx+62], "big")
-
-        flag_assume_valid = (flags & 0b1000000000000000) != 0
-        flag_extended = (flags & 0b0100000000000000) != 0
-        assert not flag_extended
-        flag_stage =  flags & 0b0011000000000000
-
-        name_length = flags & 0b0000111111111111
-        idx += 62
-
-        if name_length < 0xFFF:
-            assert content[idx + name_length] == 0x00
-            raw_name = content[idx:idx+name_length]
-            idx += name_length + 1
-        else:
-            print("Notice: Name is 0x{:X} bytes long.".format(name_length))
-
-            null_idx = content.find(b'\x00', idx + 0xFFF)
-            raw_name = content[idx: null_idx]
-            idx = null_idx + 1
-
-        name = raw_name.decode("utf8")
-
-        idx = 8 * ceil(idx / 8)
+    return index_parse(raw, index_file)
 
-        entries.append(GitIndexEntry(ctime=(ctime_s, ctime_ns),
-                                     mtime=(mtime_s,  mtime_ns),
-                                     dev=dev,
-                                     ino=ino,
-                                     mode_type=mode_type,
-                                     mode_perms=mode_perms,
-                                     uid=uid,
-                                     gid=gid,
-                                     fsize=fsize,
-                                     sha=sha,
-                                     flag_assume_valid=flag_assume_valid,
-                                     flag_stage=flag_stage,
-                                     name=name))
+def index_parse(raw, index_file="index"):
+    signature, version, count = INDEX_HEADER.unpack_from(raw, 0)
+    assert signature == b"DIRC"
+    if not version in INDEX_VERSIONS:
+        raise Exception("Unsupported index file version {}".format(version))
 
-    return GitIndex(version=version, entries=entries)
-
-def index_write(repo, index):
-    with open(repo_file(repo, "index"), "wb") as f:
-
-
-        f.write(b"DIRC")
-        f.write(index.version.to_bytes(4, "big"))
-        f.write(len(index.entries).to_bytes(4, "big"))
-
-        idx = 0
-        for e in index.entries:
-            f.write(e.ctime[0].to_bytes(4, "big"))
-            f.write(e.ctime[1].to_bytes(4, "big"))
-            f.write(e.mtime[0].to_bytes(4, "big"))
-            f.write(e.mtime[1].to_bytes(4, "big"))
-            f.write(e.dev.to_bytes(4, "big"))
-            f.write(e.ino.to_bytes(4, "big"))
-
-            mode = (e.mode_type << 12) | e.mode_perms
-            f.write(mode.to_bytes(4, "big"))
+    entries = list()
+    idx = INDEX_HEADER.size
+    if version == 4:
+        name = b''
+        for i in range(0, count):
+            entry, next_idx = index_entry_decode(raw, idx, version, name)
+            name = entry.name.encode("utf8")
+            idx = next_idx
+            entries.append(entry)
+    else:
+        for i in range(0, count):
+            entry, idx = index_entry_decode(raw, idx, version)
+            entries.append(entry)
 
-            f.write(e.uid.to_bytes(4, "big"))
-            f.write(e.gid.to_bytes(4, "big"))
+    ext = collections.OrderedDict()
+    sha = None
 
-            f.write(e.fsize.to_bytes(4, "big"))
-            f.write(int(e.sha, 16).to_bytes(20, "big"))
+    # Indexes written by older gitbab versions end right after the
+    # entries, without a checksum.
+    if len(raw) - idx >= 20:
+        sha = raw[-20:]
+        if hashlib.sha1(memoryview(raw)[:-20]).digest() != sha:
+            raise Exception("Index file {} is corrupt: bad checksum".format(index_file))
+
+        # Extensions: 4-byte signature, 32-bit size, then the data.  They
+        # are kept as is, so the ones gitbab doesn't know about are written
+        # back unchanged, except for the mandatory ones (lowercase first
+        # letter) which we can't ignore, and the positional ones.
+        while idx + INDEX_EXT_HEADER.size <= len(raw) - 20:
+            signature, size = INDEX_EXT_HEADER.unpack_from(raw, idx)
+            idx += INDEX_EXT_HEADER.size
+            if not (b"A" <= signature[0:1] <= b"Z") and not signature in INDEX_EXTENSIONS:
+                raise Exception("Index file {} uses unsupported extension {}".format(
+                    index_file, signature.decode("ascii", "replace")))
+            if not signature in INDEX_EXT_POSITIONAL:
+                ext[signature] = raw[idx:idx + size]
+            idx += size
+
+    base = None
+    if INDEX_EXT_LINK in ext:
+        base, entries = index_split_merge(index_file, ext.pop(INDEX_EXT_LINK), entries)
+
+    index = GitIndex(version=version, entries=entries)
+    index.sha = sha
+    index.ext = ext
+    index.split_base = base
+    if INDEX_EXT_TREE in ext:
+        index.cache_tree = GitCacheTree(ext.pop(INDEX_EXT_TREE))
+
+    return index
+
+def index_split_merge(index_file, link, entries):
+    # A split index only holds the entries that differ from its shared
+    # base index: first the ones replacing base entries (without their
+    # names, which come from the base), then new ones.  Returns the base
+    # and the merged entries.
+    base_sha = link[:20].hex()
+    path = os.path.join(os.path.dirname(index_file), INDEX_SHARED_PREFIX + base_sha)
+    if not os.path.exists(path):
+        raise Exception("Index file {} refers to missing shared index {}".format(index_file, path))
+    with open(path, "rb") as f:
+        base = index_parse(f.read(), path)
+    if base.sha.hex() != base_sha:
+        raise Exception("Shared index {} is corrupt: bad checksum".format(path))
+
+    deleted = replaced = 0
+    if len(link) > 20:
+        deleted, _, idx = ewah_decode(link, 20)
+        replaced, _, idx = ewah_decode(link, idx)
+
+    merged = [copy.copy(e) for e in base.entries]
+    replaced = ewah_positions(replaced)
+    for i, pos in enumerate(replaced):
+        if entries[i].name:
+            raise Exception("Index file {} is corrupt: replaced entry {} has a name".format(index_file, i))
+        entries[i].name = merged[pos].name
+        merged[pos] = entries[i]
+
+    if deleted:
+        deleted = set(ewah_positions(deleted))
+        merged = [e for i, e in enumerate(merged) if not i in deleted]
+
+    return base, merged + entries[len(replaced):]
+
+def index_split_delta(base, index):
+    # Walks the base and the index side by side (both are sorted) and
+    # returns the base positions to delete, the (position, entry) pairs to
+    # replace and the added entries.
+    fields = operator.attrgetter(*GitIndexEntry.__slots__)
+    old = base.entries
+    new = index.entries
+    deleted = list()
+    replaced = list()
+    added = list()
+
+    i = j = 0
+    while i < len(old) or j < len(new):
+        if j >= len(new):
+            deleted.append(i)
+            i += 1
+            continue
+        if i >= len(old):
+            added.append(new[j])
+            j += 1
+            continue
+
+        old_key = index_entry_key(old[i])
+        new_key = index_entry_key(new[j])
+        if old_key < new_key:
+            deleted.append(i)
+            i += 1
+        elif new_key < old_key:
+            added.append(new[j])
+            j += 1
+        else:
+            if fields(old[i]) != fields(new[j]):
+                replaced.append((i, new[j]))
+            i += 1
+            j += 1
+
+    return deleted, replaced, added
+
+def index_split_serialize(repo, index):
+    # Writes a new shared base when there is none yet, or when the delta
+    # against the current one grew past splitIndex.maxPercentChange.
+    base = index.split_base
+    max_percent = repo.conf.getint("splitIndex", "maxPercentChange", fallback=INDEX_SPLIT_MAX_PERCENT)
+
+    if base is not None:
+        deleted, replaced, added = index_split_delta(base, index)
+        changes = len(deleted) + len(replaced) + len(added)
+        if base.version != index.version or changes * 100 > max_percent * len(base.entries):
+            base = None
+
+    if base is None:
+        base = GitIndex(version=index.version, entries=[copy.copy(e) for e in index.entries])
+        data = index_serialize(base)
+        path = repo_file(repo, INDEX_SHARED_PREFIX + base.sha.hex())
+        with open(path + ".lock", "wb") as f:
+            f.write(data)
+        os.replace(path + ".lock", path)
+        index.split_base = base
+        deleted, replaced, added = list(), list(), list()
+    else:
+        # Keep the base we use from being pruned.
+        os.utime(repo_file(repo, INDEX_SHARED_PREFIX + base.sha.hex()))
 
-            flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
+    index_shared_prune(repo, base.sha.hex())
 
-            name_bytes = e.name.encode("utf8")
-            bytes_len = len(name_bytes)
-            if bytes_len >= 0xFFF:
-                name_length = 0xFFF
+    entries = list()
+    for (pos, entry) in replaced:
+        entry = copy.copy(entry)
+        entry.name = ""
+        entries.append(entry)
+    entries.extend(added)
+
+    link = (base.sha +
+            ewah_encode(ewah_from_positions(deleted)) +
+            ewah_encode(ewah_from_positions(pos for (pos, entry) in replaced)))
+    return index_serialize(index, entries=entries, link=link)
+
+def index_shared_prune(repo, keep):
+    # Another process may still be reading through an older base, so only
+    # remove those that haven't been used for a while.
+    expire = time.time() - INDEX_SHARED_EXPIRE
+    for name in os.listdir(repo.gitdir):
+        if not name.startswith(INDEX_SHARED_PREFIX) or name.endswith(keep) or name.endswith(".lock"):
+            continue
+        path = os.path.join(repo.gitdir, name)
+        try:
+            if os.path.getmtime(path) < expire:
+                os.unlink(path)
+        except OSError:
+            pass
+
+def index_serialize(index, version=None, entries=None, link=None):
+    # entries and link are used to write the delta part of a split index.
+    if version is None:
+        version = index.version
+    if entries is None:
+        entries = index.entries
+    if version == 2 and any(e.flag_skip_worktree or e.flag_intent_to_add for e in entries):
+        # Extended flags need at least version 3.
+        version = 3
+
+    pack = INDEX_ENTRY.pack
+    ret = bytearray(INDEX_HEADER.pack(b"DIRC", version, len(entries)))
+
+    previous = b''
+    for e in entries:
+        name_bytes = e.name.encode("utf8")
+        name_length = min(len(name_bytes), INDEX_FLAG_NAME_LENGTH)
+        flags = e.flag_stage | name_length
+        if e.flag_assume_valid:
+            flags |= INDEX_FLAG_ASSUME_VALID
+        extended = 0
+        if e.flag_skip_worktree:
+            extended |= INDEX_EXTENDED_SKIP_WORKTREE
+        if e.flag_intent_to_add:
+            extended |= INDEX_EXTENDED_INTENT_TO_ADD
+        if extended:
+            flags |= INDEX_FLAG_EXTENDED
+
+        start = len(ret)
+        # Like git, stat fields are truncated to 32 bits.
+        ret += pack(e.ctime[0] & 0xFFFFFFFF, e.ctime[1], e.mtime[0] & 0xFFFFFFFF, e.mtime[1],
+                    e.dev & 0xFFFFFFFF, e.ino & 0xFFFFFFFF,
+                    (e.mode_type << 12) | e.mode_perms,
+                    e.uid & 0xFFFFFFFF, e.gid & 0xFFFFFFFF, e.fsize & 0xFFFFFFFF,
+                    bytes.fromhex(e.sha),
+                    flags)
+        if extended:
+            ret += struct.pack(">H", extended)
+
+        if version == 4:
+            # Length of the common prefix, from the first differing bit.
+            n = min(len(previous), len(name_bytes))
+            diff = int.from_bytes(previous[:n], "big") ^ int.from_bytes(name_bytes[:n], "big")
+            common = n - (diff.bit_length() + 7) // 8
+            strip = len(previous) - common
+            if strip < 0x80:
+                ret.append(strip)
             else:
-                name_length = bytes_len
-
-            f.write((flag_assume_valid | e.flag_stage | name_length).to_bytes(2, "big"))
+                ret += index_varint_encode(strip)
+            ret += name_bytes[common:]
+            ret += b'\x00'
+            previous = name_bytes
+        else:
+            ret += name_bytes
+            ret += bytes(8 - (len(ret) - start) % 8)
+
+    ext = collections.OrderedDict()
+    if link:
+        ext[INDEX_EXT_LINK] = link
+    if index.cache_tree:
+        ext[INDEX_EXT_TREE] = index.cache_tree.serialize()
+    ext.update(index.ext)
+
+    for signature, data in ext.items():
+        ret += INDEX_EXT_HEADER.pack(signature, len(data))
+        ret += data
+
+    index.sha = hashlib.sha1(ret).digest()
+    ret += index.sha
+    return ret
 
-            f.write(name_bytes)
-            f.write((0).to_bytes(1, "big"))
+def index_config_version(repo):
+    version = repo.conf.get("index", "version", fallback=None)
+    if version is None:
+        return None
+    version = int(version)
+    if not version in INDEX_VERSIONS:
+        raise Exception("Unsupported index.version {}".format(version))
+    return version
 
-            idx += 62 + len(name_bytes) + 1
+def index_write(repo, index):
+    # Build the whole file in memory and write it with a single call, via a
+    # lock file so readers never see a half-written index.
+    path = repo_file(repo, "index")
+    version = index_config_version(repo)
+    if version:
+        index.version = version
+
+    split = repo.conf.getboolean("core", "splitIndex", fallback=None)
+    if split is None:
+        split = index.split_base is not None
+    if split:
+        data = index_split_serialize(repo, index)
+    else:
+        index.split_base = None
+        data = index_serialize(index)
 
-            if idx % 8 != 0:
-                pad = 8 - (idx % 8)
-                f.write((0).to_bytes(pad, "big"))
-                idx += pad
\ No newline at end of file
+    with open(path + ".lock", "wb") as f:
+        f.write(data)
+    os.replace(path + ".lock", path)
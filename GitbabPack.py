@@ -0,0 +1,828 @@
+import array
+import collections
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from GitBab.GitbabChunk import chunk_file_build, chunk_table_parse
+from GitBab.GitbabRepo import repo_directory, repo_file
+
+PACK_OBJ_COMMIT = 1
+PACK_OBJ_TREE = 2
+PACK_OBJ_BLOB = 3
+PACK_OBJ_TAG = 4
+PACK_OBJ_OFS_DELTA = 6
+PACK_OBJ_REF_DELTA = 7
+
+PACK_TYPE_FMT = {
+    PACK_OBJ_COMMIT: b'commit',
+    PACK_OBJ_TREE: b'tree',
+    PACK_OBJ_BLOB: b'blob',
+    PACK_OBJ_TAG: b'tag',
+}
+
+PACK_FMT_TYPE = {v: k for k, v in PACK_TYPE_FMT.items()}
+
+# Upper bound on the compressed bytes handed to zlib in one go when
+# inflating out of the mmapped pack.
+PACK_INFLATE_CHUNK = 64 * 1024
+
+# A .rev file lists the index positions of a pack's objects in pack
+# order, so pack positions (what bitmaps count in) don't need a sort of
+# every offset.
+PACK_REV_SIGNATURE = b'RIDX'
+PACK_REV_HEADER = struct.Struct(">4sII")
+
+# git's multi-pack-index (objects/pack/multi-pack-index), version 1: the
+# names of every pack of the directory, then one fanout and sorted SHA
+# table over all of their objects, each with the number of its pack
+# (in name order) and its offset there.  Offsets past 31 bits are kept
+# in a separate table of 64-bit ones.
+MIDX_FILE = "multi-pack-index"
+MIDX_SIGNATURE = b'MIDX'
+MIDX_HEADER = struct.Struct(">4sBBBBI")
+MIDX_OBJECT = struct.Struct(">II")
+MIDX_CHUNK_NAMES = b"PNAM"
+MIDX_CHUNK_FANOUT = b"OIDF"
+MIDX_CHUNK_OIDS = b"OIDL"
+MIDX_CHUNK_OFFSETS = b"OOFF"
+MIDX_CHUNK_LARGE_OFFSETS = b"LOFF"
+MIDX_LARGE_OFFSET = 0x80000000
+
+class GitPackIndex(object):
+    path = None
+    count = 0
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:4] != b'\377tOc':
+            raise Exception("Unsupported pack index {}".format(path))
+        version = struct.unpack_from(">I", self.data, 4)[0]
+        if version != 2:
+            raise Exception("gitbab only supports pack index version 2: {}".format(path))
+
+        self.fanout = struct.unpack_from(">256I", self.data, 8)
+        self.count = self.fanout[255]
+
+        # Table layout of a v2 .idx: fanout, sorted SHAs, CRC32s, 31-bit
+        # offsets, then 64-bit offsets for packs larger than 2 GiB.
+        self.sha_base = 8 + 256 * 4
+        self.crc_base = self.sha_base + 20 * self.count
+        self.offset_base = self.crc_base + 4 * self.count
+        self.large_base = self.offset_base + 4 * self.count
+
+    def sha_at(self, i):
+        start = self.sha_base + 20 * i
+        return self.data[start:start + 20]
+
+    def crc_at(self, i):
+        return struct.unpack_from(">I", self.data, self.crc_base + 4 * i)[0]
+
+    def offset_at(self, i):
+        offset = struct.unpack_from(">I", self.data, self.offset_base + 4 * i)[0]
+        if offset & 0x80000000:
+            large = self.large_base + 8 * (offset & 0x7fffffff)
+            offset = struct.unpack_from(">Q", self.data, large)[0]
+        return offset
+
+    def offsets(self):
+        # Every offset, in index order.
+        ret = array.array("I", self.data[self.offset_base:self.offset_base + 4 * self.count])
+        if sys.byteorder == "little":
+            ret.byteswap()
+        if any(offset & 0x80000000 for offset in ret):
+            return [self.offset_at(i) for i in range(self.count)]
+        return ret
+
+    def bisect(self, binsha):
+        # The fanout table gives us the bucket of SHAs sharing the first
+        # byte; binary search only has to cover that bucket.
+        first = binsha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha_at(mid) < binsha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, binsha):
+        i = self.bisect(binsha)
+        if i < self.count and self.sha_at(i) == binsha:
+            return i
+        return None
+
+    def prefix(self, prefix):
+        i = self.bisect(bytes.fromhex((prefix + "0" * 40)[:40]))
+        ret = list()
+        while i < self.count:
+            sha = self.sha_at(i).hex()
+            if not sha.startswith(prefix):
+                break
+            ret.append(sha)
+            i += 1
+        return ret
+
+class GitMultiPackIndex(GitPackIndex):
+    # Laid out like a pack index where it matters for lookups (a fanout,
+    # then the sorted SHAs), so bisect, find and prefix carry over.
+    # offset_at(i) is an offset in pack pack_at(i).
+    packs = None
+    others = None
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, hash_version, chunks, bases, count = MIDX_HEADER.unpack_from(self.data, 0)
+        if signature != MIDX_SIGNATURE or version != 1 or hash_version != 1 or bases != 0:
+            raise Exception("Unsupported multi-pack-index {}".format(path))
+
+        self.chunks = chunk_table_parse(self.data, MIDX_HEADER.size, chunks)
+        for chunk in (MIDX_CHUNK_NAMES, MIDX_CHUNK_FANOUT, MIDX_CHUNK_OIDS, MIDX_CHUNK_OFFSETS):
+            if not chunk in self.chunks:
+                raise Exception("Multi-pack-index {} lacks chunk {}".format(path, chunk.decode("ascii")))
+
+        start, end = self.chunks[MIDX_CHUNK_NAMES]
+        self.names = [name.decode("utf8") for name in self.data[start:end].split(b'\0') if name][:count]
+        if len(self.names) != count:
+            raise Exception("Multi-pack-index {} is corrupt".format(path))
+
+        self.fanout = struct.unpack_from(">256I", self.data, self.chunks[MIDX_CHUNK_FANOUT][0])
+        self.count = self.fanout[255]
+        self.sha_base = self.chunks[MIDX_CHUNK_OIDS][0]
+        self.offset_base = self.chunks[MIDX_CHUNK_OFFSETS][0]
+        self.large_base = self.chunks.get(MIDX_CHUNK_LARGE_OFFSETS, (None, None))[0]
+
+    def pack_at(self, i):
+        return MIDX_OBJECT.unpack_from(self.data, self.offset_base + MIDX_OBJECT.size * i)[0]
+
+    def offset_at(self, i):
+        offset = MIDX_OBJECT.unpack_from(self.data, self.offset_base + MIDX_OBJECT.size * i)[1]
+        if offset & MIDX_LARGE_OFFSET and self.large_base is not None:
+            offset = struct.unpack_from(">Q", self.data, self.large_base + 8 * (offset & 0x7fffffff))[0]
+        return offset
+
+class GitPack(object):
+    path = None
+    index = None
+    reverse = None
+    bitmap = None
+
+    def __init__(self, path):
+        self.path = path
+        self.index = GitPackIndex(path[:-len(".pack")] + ".idx")
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.data)
+
+        if self.data[:4] != b'PACK':
+            raise Exception("Not a pack file {}".format(path))
+        version, count = struct.unpack_from(">II", self.data, 4)
+        if version not in (2, 3):
+            raise Exception("Unsupported pack version {} in {}".format(version, path))
+        if count != self.index.count:
+            raise Exception("Pack {} does not match its index".format(path))
+
+    def entry_header(self, offset):
+        c = self.data[offset]
+        offset += 1
+        type = (c >> 4) & 0b111
+        size = c & 0b1111
+        shift = 4
+        while c & 0x80:
+            c = self.data[offset]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return type, size, offset
+
+    def inflate(self, offset, size):
+        d = zlib.decompressobj()
+        out = list()
+        step = min(size + 64, PACK_INFLATE_CHUNK)
+        while not d.eof:
+            chunk = self.view[offset:offset + step]
+            if not chunk:
+                raise Exception("Truncated object in pack {}".format(self.path))
+            out.append(d.decompress(chunk))
+            offset += len(chunk)
+            step = PACK_INFLATE_CHUNK
+        data = b''.join(out)
+
+        if len(data) != size:
+            raise Exception("Malformed object in pack {}: bad length".format(self.path))
+        return data
+
+    def read_at(self, offset):
+        # Walk the delta chain down to its base, remembering each delta,
+        # then replay the deltas on the way back up.  Iterative so deep
+        # chains don't hit the recursion limit.
+        deltas = list()
+        while True:
+            type, size, pos = self.entry_header(offset)
+
+            if type == PACK_OBJ_OFS_DELTA:
+                c = self.data[pos]
+                pos += 1
+                distance = c & 0x7f
+                while c & 0x80:
+                    c = self.data[pos]
+                    pos += 1
+                    distance = ((distance + 1) << 7) | (c & 0x7f)
+                deltas.append(self.inflate(pos, size))
+                offset -= distance
+            elif type == PACK_OBJ_REF_DELTA:
+                base = self.data[pos:pos + 20]
+                deltas.append(self.inflate(pos + 20, size))
+                i = self.index.find(base)
+                if i is None:
+                    raise Exception("Delta base {} missing from pack {}".format(base.hex(), self.path))
+                offset = self.index.offset_at(i)
+            elif type in PACK_TYPE_FMT:
+                data = self.inflate(pos, size)
+                break
+            else:
+                raise Exception("Unknown object type {} in pack {}".format(type, self.path))
+
+        for delta in reversed(deltas):
+            data = delta_apply(data, delta)
+
+        return PACK_TYPE_FMT[type], data
+
+    def size_at(self, offset):
+        # The size of the object at offset: from its entry header, or for
+        # a delta from the result size at the start of the delta, so only
+        # a few bytes are inflated.
+        type, size, pos = self.entry_header(offset)
+        if type in PACK_TYPE_FMT:
+            return size
+        if type == PACK_OBJ_OFS_DELTA:
+            while self.data[pos] & 0x80:
+                pos += 1
+            pos += 1
+        elif type == PACK_OBJ_REF_DELTA:
+            pos += 20
+        else:
+            raise Exception("Unknown object type {} in pack {}".format(type, self.path))
+        head = zlib.decompressobj().decompress(self.view[pos:pos + 128], 32)
+        base_size, i = delta_varint(head, 0)
+        return delta_varint(head, i)[0]
+
+    def stream_at(self, offset):
+        # Undeltified entries can be inflated straight from the mmap in
+        # chunks; deltas need their base in memory, so return None and
+        # let the caller fall back to read_at.
+        type, size, pos = self.entry_header(offset)
+        if not type in PACK_TYPE_FMT:
+            return None
+        return PACK_TYPE_FMT[type], size, self.compressed_chunks(pos)
+
+    def reverse_index(self):
+        # Index positions in pack order.
+        if self.reverse is not None:
+            return self.reverse
+
+        path = self.path[:-len(".pack")] + ".rev"
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                raw = f.read()
+            signature, version, hash_id = PACK_REV_HEADER.unpack_from(raw)
+            end = PACK_REV_HEADER.size + 4 * self.index.count
+            if signature != PACK_REV_SIGNATURE or version != 1 or len(raw) != end + 40:
+                raise Exception("Malformed reverse index {}".format(path))
+            if raw[end:end + 20] != self.data[-20:]:
+                raise Exception("Reverse index {} does not match its pack".format(path))
+            self.reverse = array.array("I", raw[PACK_REV_HEADER.size:end])
+            if sys.byteorder == "little":
+                self.reverse.byteswap()
+        else:
+            offsets = self.index.offsets()
+            self.reverse = array.array("I", sorted(range(self.index.count), key=offsets.__getitem__))
+        return self.reverse
+
+    def type_at(self, offset, types=None):
+        # The type of the object at offset, following deltas to their base
+        # through the entry headers only.  types caches offset -> type
+        # across calls.
+        chain = list()
+        while True:
+            if types is not None and offset in types:
+                type = types[offset]
+                break
+            chain.append(offset)
+            type, size, pos = self.entry_header(offset)
+            if type == PACK_OBJ_OFS_DELTA:
+                c = self.data[pos]
+                pos += 1
+                distance = c & 0x7f
+                while c & 0x80:
+                    c = self.data[pos]
+                    pos += 1
+                    distance = ((distance + 1) << 7) | (c & 0x7f)
+                offset -= distance
+            elif type == PACK_OBJ_REF_DELTA:
+                i = self.index.find(self.data[pos:pos + 20])
+                if i is None:
+                    raise Exception("Delta base {} missing from pack {}".format(self.data[pos:pos + 20].hex(), self.path))
+                offset = self.index.offset_at(i)
+            else:
+                break
+
+        if types is not None:
+            for offset in chain:
+                types[offset] = type
+        return PACK_TYPE_FMT[type]
+
+    def compressed_chunks(self, offset):
+        while offset < len(self.data):
+            yield self.view[offset:offset + PACK_INFLATE_CHUNK]
+            offset += PACK_INFLATE_CHUNK
+
+def delta_varint(delta, pos):
+    ret = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        ret |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return ret, pos
+
+def delta_apply(base, delta):
+    base_size, pos = delta_varint(delta, 0)
+    if base_size != len(base):
+        raise Exception("Delta does not apply: base size mismatch")
+    result_size, pos = delta_varint(delta, pos)
+
+    ret = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy from base: the low 4 bits select offset bytes, the
+            # next 3 bits select size bytes.
+            offset = 0
+            size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            ret += base[offset:offset + size]
+        elif op:
+            # Insert the next op bytes literally.
+            ret += delta[pos:pos + op]
+            pos += op
+        else:
+            raise Exception("Delta does not apply: invalid opcode 0")
+
+    if len(ret) != result_size:
+        raise Exception("Delta does not apply: result size mismatch")
+    return bytes(ret)
+
+def pack_list(repo):
+    path = repo_directory(repo, "objects", "pack")
+    if not path:
+        return list()
+
+    # Only rescan the pack directory when it changed.
+    mtime = os.stat(path).st_mtime_ns
+    if repo.packs is not None and repo.packs_mtime == mtime:
+        return repo.packs
+
+    packs = list()
+    for f in sorted(os.listdir(path)):
+        if f.endswith(".pack") and os.path.exists(os.path.join(path, f[:-len(".pack")] + ".idx")):
+            packs.append(GitPack(os.path.join(path, f)))
+
+    repo.packs = packs
+    repo.packs_mtime = mtime
+    repo.midx = pack_midx_read(repo, packs)
+    return packs
+
+def pack_midx_path(repo):
+    return repo_file(repo, "objects", "pack", MIDX_FILE)
+
+def pack_midx_read(repo, packs):
+    # The multi-pack-index over packs, or None without one, with
+    # core.multiPackIndex off, or when one of its packs is gone.
+    if not repo.conf.getboolean("core", "multiPackIndex", fallback=True):
+        return None
+    path = pack_midx_path(repo)
+    if not path or not os.path.exists(path):
+        return None
+
+    midx = GitMultiPackIndex(path)
+    by_name = dict((os.path.basename(pack.index.path), pack) for pack in packs)
+    if not all(name in by_name for name in midx.names):
+        return None
+    midx.packs = [by_name[name] for name in midx.names]
+    midx.others = [pack for pack in packs if not os.path.basename(pack.index.path) in midx.names]
+    return midx
+
+def pack_indexes(repo):
+    # The sorted SHA tables to search: the multi-pack-index and the packs
+    # it doesn't cover, or the index of every pack.
+    packs = pack_list(repo)
+    if repo.midx is None:
+        return [pack.index for pack in packs]
+    return [repo.midx] + [pack.index for pack in repo.midx.others]
+
+def pack_find(repo, sha):
+    try:
+        binsha = bytes.fromhex(sha)
+    except ValueError:
+        return None
+    if len(binsha) != 20:
+        return None
+
+    # With a multi-pack-index, one search covers all the packs it lists.
+    packs = pack_list(repo)
+    if repo.midx is not None:
+        i = repo.midx.find(binsha)
+        if i is not None:
+            return repo.midx.packs[repo.midx.pack_at(i)], repo.midx.offset_at(i)
+        packs = repo.midx.others
+
+    for pack in packs:
+        i = pack.index.find(binsha)
+        if i is not None:
+            return pack, pack.index.offset_at(i)
+    return None
+
+def pack_read(repo, sha):
+    found = pack_find(repo, sha)
+    if not found:
+        return None
+    pack, offset = found
+    return pack.read_at(offset)
+
+def pack_stream(repo, sha):
+    found = pack_find(repo, sha)
+    if not found:
+        return None
+    pack, offset = found
+    # Returns (fmt, size, chunks, compressed).
+    stream = pack.stream_at(offset)
+    if stream:
+        return stream + (True,)
+    fmt, data = pack.read_at(offset)
+    return fmt, len(data), [data], False
+
+# Blocks of the delta base indexed by delta_create, and the size above
+# which objects are stored whole rather than deltified.
+DELTA_BLOCK = 16
+DELTA_MAX_SIZE = 16 * 1024 * 1024
+
+def delta_encode_varint(n):
+    ret = bytearray()
+    while True:
+        c = n & 0x7f
+        n >>= 7
+        if n:
+            ret.append(c | 0x80)
+        else:
+            ret.append(c)
+            return ret
+
+def delta_index(base):
+    index = dict()
+    for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(base[i:i + DELTA_BLOCK], i)
+    return index
+
+def delta_create(base, target, index=None, max_size=None):
+    if index is None:
+        index = delta_index(base)
+
+    ret = delta_encode_varint(len(base)) + delta_encode_varint(len(target))
+    insert = bytearray()
+
+    def flush():
+        if insert:
+            ret.append(len(insert))
+            ret.extend(insert)
+            insert.clear()
+
+    pos = 0
+    end = len(target)
+    while pos < end:
+        offset = index.get(target[pos:pos + DELTA_BLOCK]) if pos + DELTA_BLOCK <= end else None
+
+        if offset is None:
+            insert.append(target[pos])
+            pos += 1
+            if len(insert) == 0x7f:
+                flush()
+        else:
+            size = DELTA_BLOCK
+            while (pos + size + DELTA_BLOCK <= end and
+                   target[pos + size:pos + size + DELTA_BLOCK] == base[offset + size:offset + size + DELTA_BLOCK]):
+                size += DELTA_BLOCK
+            while (pos + size < end and offset + size < len(base) and
+                   target[pos + size] == base[offset + size]):
+                size += 1
+
+            flush()
+            pos += size
+            while size:
+                chunk = min(size, 0x10000)
+                op = 0x80
+                args = bytearray()
+                for i in range(4):
+                    byte = (offset >> (8 * i)) & 0xff
+                    if byte:
+                        op |= 1 << i
+                        args.append(byte)
+                # A copy of exactly 0x10000 bytes is encoded with no size bytes.
+                for i in range(3):
+                    byte = (chunk >> (8 * i)) & 0xff
+                    if byte:
+                        op |= 0x10 << i
+                        args.append(byte)
+                ret.append(op)
+                ret.extend(args)
+                offset += chunk
+                size -= chunk
+
+        if max_size is not None and len(ret) + len(insert) > max_size:
+            return None
+
+    flush()
+    return bytes(ret)
+
+def pack_name_hash(name):
+    # Same as git's pack_name_hash: the last characters of the path carry
+    # the most weight, so files with the same name/extension sort together.
+    hash = 0
+    if not name:
+        return hash
+    for c in name.encode("utf8"):
+        if c in b" \t\n\r":
+            continue
+        hash = ((hash >> 2) + (c << 24)) & 0xffffffff
+    return hash
+
+def pack_entry_header(type, size):
+    ret = bytearray()
+    c = (type << 4) | (size & 0b1111)
+    size >>= 4
+    while size:
+        ret.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret.append(c)
+    return ret
+
+def pack_encode_distance(distance):
+    ret = bytearray([distance & 0x7f])
+    distance >>= 7
+    while distance:
+        distance -= 1
+        ret.insert(0, 0x80 | (distance & 0x7f))
+        distance >>= 7
+    return ret
+
+def pack_write_index(path, shas, offsets, crcs, pack_sha):
+    order = sorted(range(len(shas)), key=lambda i: shas[i])
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[sha[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    small = list()
+    large = list()
+    for i in order:
+        if offsets[i] < 0x80000000:
+            small.append(offsets[i])
+        else:
+            small.append(0x80000000 | len(large))
+            large.append(offsets[i])
+
+    raw = bytearray(b'\377tOc')
+    raw += struct.pack(">I", 2)
+    raw += struct.pack(">256I", *fanout)
+    raw += b''.join(shas[i] for i in order)
+    raw += struct.pack(">{}I".format(len(order)), *[crcs[i] for i in order])
+    raw += struct.pack(">{}I".format(len(small)), *small)
+    raw += struct.pack(">{}Q".format(len(large)), *large)
+    raw += pack_sha
+    raw += hashlib.sha1(raw).digest()
+
+    with open(path, "wb") as f:
+        f.write(raw)
+
+def pack_write_reverse_index(path, shas, offsets, pack_sha):
+    by_sha = sorted(range(len(shas)), key=lambda i: shas[i])
+    position = [0] * len(shas)
+    for (pos, i) in enumerate(by_sha):
+        position[i] = pos
+    order = sorted(range(len(shas)), key=lambda i: offsets[i])
+
+    raw = bytearray(PACK_REV_HEADER.pack(PACK_REV_SIGNATURE, 1, 1))
+    raw += struct.pack(">{}I".format(len(order)), *[position[i] for i in order])
+    raw += pack_sha
+    raw += hashlib.sha1(raw).digest()
+
+    with open(path, "wb") as f:
+        f.write(raw)
+
+def pack_write(repo, objects, read, window=10, depth=50):
+    # objects is a list of (sha, fmt, size, name hash) tuples, read(sha)
+    # returns the object's data.  Objects are ordered like git does
+    # (type, name hash, size descending) so that good delta bases sit
+    # next to each other, then each object is deltified against the best
+    # of the previous `window` objects whose chain is shallower than
+    # `depth`.
+    if not objects:
+        return None
+
+    path = repo_directory(repo, "objects", "pack", mkdir=True)
+    objects = sorted(objects, key=lambda o: (o[1], o[3], -o[2]))
+
+    tmp_pack = os.path.join(path, "tmp_pack_{}".format(os.getpid()))
+    shas = list()
+    offsets = list()
+    crcs = list()
+    deltas = 0
+
+    # Entries of the sliding window: [position, fmt, data, index, depth].
+    candidates = collections.deque(maxlen=window)
+    hash = hashlib.sha1()
+    with open(tmp_pack, "wb") as f:
+        def out(data):
+            hash.update(data)
+            f.write(data)
+
+        out(b'PACK' + struct.pack(">II", 2, len(objects)))
+        offset = 12
+
+        for (sha, fmt, size, name) in objects:
+            data = read(sha)
+            base = None
+            best = None
+            chain = 0
+
+            if window and len(data) <= DELTA_MAX_SIZE:
+                for candidate in candidates:
+                    (c_pos, c_fmt, c_data, c_index, c_depth) = candidate
+                    if c_fmt != fmt or c_depth >= depth:
+                        continue
+                    limit = (len(best) if best else len(data) // 2) - 1
+                    if len(data) - len(c_data) > limit:
+                        continue
+                    if c_index is None:
+                        c_index = candidate[3] = delta_index(c_data)
+                    delta = delta_create(c_data, data, c_index, limit)
+                    if delta is not None and len(delta) <= limit:
+                        best = delta
+                        base = c_pos
+                        chain = c_depth + 1
+
+            if best is not None:
+                entry = pack_entry_header(PACK_OBJ_OFS_DELTA, len(best))
+                entry += pack_encode_distance(offset - offsets[base])
+                entry += zlib.compress(best)
+                deltas += 1
+            else:
+                entry = pack_entry_header(PACK_FMT_TYPE[fmt], len(data))
+                entry += zlib.compress(data)
+
+            shas.append(bytes.fromhex(sha))
+            offsets.append(offset)
+            crcs.append(zlib.crc32(entry))
+            out(entry)
+            offset += len(entry)
+
+            if window and len(data) <= DELTA_MAX_SIZE:
+                candidates.append([len(shas) - 1, fmt, data, None, chain])
+
+        pack_sha = hash.digest()
+        f.write(pack_sha)
+
+    name = os.path.join(path, "pack-{}".format(pack_sha.hex()))
+    os.replace(tmp_pack, name + ".pack")
+
+    pack_write_reverse_index(name + ".rev.tmp", shas, offsets, pack_sha)
+    os.replace(name + ".rev.tmp", name + ".rev")
+
+    # The .idx goes last: readers only pick up packs that have one.
+    pack_write_index(name + ".idx.tmp", shas, offsets, crcs, pack_sha)
+    os.replace(name + ".idx.tmp", name + ".idx")
+
+    return name + ".pack", len(objects), deltas
+
+def pack_midx_write(repo):
+    # Writes a multi-pack-index over every pack.  An object in several
+    # packs is taken from the most recently modified one, as git does.
+    packs = pack_list(repo)
+    if not packs:
+        return None, 0, 0
+    names = [os.path.basename(pack.index.path) for pack in packs]
+    order = sorted(range(len(packs)), key=names.__getitem__)
+
+    def entries(pack_id):
+        pack = packs[order[pack_id]]
+        mtime = -int(os.path.getmtime(pack.path))
+        for i in range(pack.index.count):
+            yield pack.index.sha_at(i), mtime, pack_id, i
+
+    fanout = [0] * 256
+    oids = list()
+    offsets = list()
+    large = list()
+    all_offsets = [packs[i].index.offsets() for i in order]
+    previous = None
+    for (binsha, mtime, pack_id, i) in heapq.merge(*[entries(pack_id) for pack_id in range(len(order))]):
+        if binsha == previous:
+            continue
+        previous = binsha
+        fanout[binsha[0]] += 1
+        oids.append(binsha)
+        offset = all_offsets[pack_id][i]
+        if offset & MIDX_LARGE_OFFSET:
+            offsets.append(MIDX_OBJECT.pack(pack_id, MIDX_LARGE_OFFSET | len(large)))
+            large.append(struct.pack(">Q", offset))
+        else:
+            offsets.append(MIDX_OBJECT.pack(pack_id, offset))
+
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    # Pack names are NUL-terminated and padded to a multiple of 4 bytes.
+    pack_names = b''.join(names[i].encode("utf8") + b'\0' for i in order)
+    pack_names += b'\0' * (-len(pack_names) % 4)
+    chunks = [(MIDX_CHUNK_NAMES, pack_names),
+              (MIDX_CHUNK_FANOUT, struct.pack(">256I", *fanout)),
+              (MIDX_CHUNK_OIDS, b''.join(oids)),
+              (MIDX_CHUNK_OFFSETS, b''.join(offsets))]
+    if large:
+        chunks.append((MIDX_CHUNK_LARGE_OFFSETS, b''.join(large)))
+    raw = chunk_file_build(MIDX_HEADER.pack(MIDX_SIGNATURE, 1, 1, len(chunks), 0, len(packs)), chunks)
+
+    path = pack_midx_path(repo)
+    with open(path + ".tmp", "wb") as f:
+        f.write(raw)
+    os.replace(path + ".tmp", path)
+    return path, len(oids), len(packs)
+
+def pack_midx_verify(repo):
+    # Returns a list of problems, empty when the multi-pack-index matches
+    # the packs it lists.
+    pack_list(repo)
+    midx = repo.midx
+    if midx is None:
+        path = pack_midx_path(repo)
+        if path and os.path.exists(path) and repo.conf.getboolean("core", "multiPackIndex", fallback=True):
+            return ["multi-pack-index lists packs that are gone"]
+        return ["no multi-pack-index"]
+
+    errors = list()
+    data = midx.data
+    if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+        errors.append("bad checksum")
+    if midx.names != sorted(midx.names):
+        errors.append("pack names out of order")
+    for first in range(1, 256):
+        if midx.fanout[first] < midx.fanout[first - 1]:
+            errors.append("bad fanout at {:02x}".format(first))
+
+    previous = None
+    for i in range(midx.count):
+        binsha = midx.sha_at(i)
+        sha = binsha.hex()
+        if previous is not None and previous >= binsha:
+            errors.append("{}: out of order".format(sha))
+        previous = binsha
+
+        pack_id = midx.pack_at(i)
+        if pack_id >= len(midx.packs):
+            errors.append("{}: bad pack {}".format(sha, pack_id))
+            continue
+        index = midx.packs[pack_id].index
+        j = index.find(binsha)
+        if j is None:
+            errors.append("{}: missing from {}".format(sha, midx.names[pack_id]))
+        elif index.offset_at(j) != midx.offset_at(i):
+            errors.append("{}: wrong offset".format(sha))
+    return errors
@@ -0,0 +1,395 @@
+import heapq
+import mmap
+import os
+import struct
+import zlib
+
+# A reftable-style ref store: a stack of immutable tables, each holding
+# refs sorted by name.  An update appends a new table with just the refs
+# it changes; lookups go through the tables newest first.  Small tables
+# get merged into their older neighbours as they pile up, keeping the
+# stack logarithmic in the number of updates.
+#
+# A table is a header, ref blocks, an index block when there is more than
+# one ref block, and a footer.  Blocks are a type byte, a 24-bit length,
+# the records, the offsets of the restart records (24 bits each) and
+# their count (16 bits).  A record shares a prefix with the previous key:
+#
+#   varint prefix length, varint (suffix length << 3 | value type), suffix
+#
+# then its value.  Restart records store their whole key, so a block is
+# searched by bisecting its restarts and reading at most
+# REFTABLE_RESTART_INTERVAL records; the index block, keyed by the last
+# ref of each block, does the same across blocks.
+#
+# Ref records go on with a varint update index (relative to the table's
+# minimum) and, depending on the value type: nothing for a deletion, a
+# SHA, a SHA and the object it peels to, or a varint length and the
+# target of a symbolic ref.  Index records hold a varint block offset.
+
+# Close to git's reftable format but not the same (the footer, for one),
+# so it goes by its own names: git refuses a repository whose
+# extensions.refStorage it doesn't know, rather than reading these tables
+# as corrupt ones of its own.
+REFTABLE_EXTENSION = "gitbab-reftable"
+REFTABLE_DIRECTORY = "gitbab-reftable"
+REFTABLE_MAGIC = b'GBRT'
+REFTABLE_VERSION = 1
+REFTABLE_HEADER = struct.Struct(">4sB3sQQ")
+REFTABLE_FOOTER = struct.Struct(">24sQI")
+REFTABLE_BLOCK = struct.Struct(">c3s")
+
+REFTABLE_BLOCK_SIZE = 4096
+REFTABLE_RESTART_INTERVAL = 16
+REFTABLE_BLOCK_REF = b'r'
+REFTABLE_BLOCK_INDEX = b'i'
+
+REFTABLE_VALUE_DELETION = 0
+REFTABLE_VALUE_SHA = 1
+REFTABLE_VALUE_PEELED = 2
+REFTABLE_VALUE_SYMREF = 3
+
+REFTABLE_LIST = "stack.list"
+# A table is merged with the newer ones when it isn't at least this many
+# times bigger than all of them together.
+REFTABLE_COMPACTION_FACTOR = 2
+
+class GitReftable(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        footer = len(self.data) - REFTABLE_FOOTER.size
+        header, self.index_offset, crc = REFTABLE_FOOTER.unpack_from(self.data, footer)
+        if zlib.crc32(self.data[footer:footer + REFTABLE_FOOTER.size - 4]) != crc:
+            raise Exception("Corrupt reftable {}".format(path))
+        magic, version, block_size, self.min_index, self.max_index = REFTABLE_HEADER.unpack(header)
+        if magic != REFTABLE_MAGIC or version != REFTABLE_VERSION or self.data[:REFTABLE_HEADER.size] != header:
+            raise Exception("Not a reftable {}".format(path))
+        self.ref_end = self.index_offset or footer
+
+    def block(self, offset):
+        # Returns (type, end of the block, offset of its restart table,
+        # restart count).
+        kind, length = REFTABLE_BLOCK.unpack_from(self.data, offset)
+        end = offset + int.from_bytes(length, "big")
+        count = struct.unpack_from(">H", self.data, end - 2)[0]
+        return kind, end, end - 2 - 3 * count, count
+
+    def record(self, pos, prev, kind):
+        # Returns (key, value type, value, next record offset).
+        prefix, pos = reftable_varint_decode(self.data, pos)
+        length, pos = reftable_varint_decode(self.data, pos)
+        value_type = length & 0x7
+        key = prev[:prefix] + self.data[pos:pos + (length >> 3)]
+        pos += length >> 3
+
+        if kind == REFTABLE_BLOCK_INDEX:
+            value, pos = reftable_varint_decode(self.data, pos)
+            return key, value_type, value, pos
+
+        delta, pos = reftable_varint_decode(self.data, pos)
+        if value_type == REFTABLE_VALUE_SHA:
+            value = (self.data[pos:pos + 20].hex(), None)
+            pos += 20
+        elif value_type == REFTABLE_VALUE_PEELED:
+            value = (self.data[pos:pos + 20].hex(), self.data[pos + 20:pos + 40].hex())
+            pos += 40
+        elif value_type == REFTABLE_VALUE_SYMREF:
+            size, pos = reftable_varint_decode(self.data, pos)
+            value = ("ref: " + self.data[pos:pos + size].decode("utf8"), None)
+            pos += size
+        else:
+            value = None
+        return key, self.min_index + delta, value, pos
+
+    def block_seek(self, offset, key):
+        # The offset and previous key of the first record of the block at
+        # offset whose key is not below key.
+        kind, end, restarts, count = self.block(offset)
+        lo, hi = 0, count
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            pos = offset + int.from_bytes(self.data[restarts + 3 * mid:restarts + 3 * mid + 3], "big")
+            if self.record(pos, b'', kind)[0] <= key:
+                lo = mid
+            else:
+                hi = mid
+
+        pos = offset + int.from_bytes(self.data[restarts + 3 * lo:restarts + 3 * lo + 3], "big")
+        prev = b''
+        while pos < restarts:
+            found, _, _, next_pos = self.record(pos, prev, kind)
+            if found >= key:
+                break
+            prev = found
+            pos = next_pos
+        return pos, prev
+
+    def seek(self, key):
+        # Block and record offsets of the first ref not below key.
+        offset = REFTABLE_HEADER.size
+        if self.index_offset:
+            pos, prev = self.block_seek(self.index_offset, key)
+            kind, end, restarts, count = self.block(self.index_offset)
+            if pos >= restarts:
+                return None
+            offset = self.record(pos, prev, REFTABLE_BLOCK_INDEX)[2]
+        if offset >= self.ref_end:
+            return None
+        return offset, self.block_seek(offset, key)
+
+    def scan(self, start=b''):
+        # Yields (name, update index, value) from the first ref not below
+        # start to the end of the table, value None for deletions.
+        found = self.seek(start)
+        if found is None:
+            return
+        offset, (pos, prev) = found
+        while offset < self.ref_end:
+            kind, end, restarts, count = self.block(offset)
+            while pos < restarts:
+                key, update_index, value, pos = self.record(pos, prev, kind)
+                prev = key
+                yield key, update_index, value
+            offset = end
+            pos = offset + REFTABLE_BLOCK.size
+            prev = b''
+
+    def lookup(self, name):
+        # (update index, value) of name, or None if the table lacks it.
+        for key, update_index, value in self.scan(name):
+            if key == name:
+                return update_index, value
+            return None
+        return None
+
+class GitReftableStack(object):
+    format = "reftable"
+
+    def __init__(self, path):
+        self.path = path
+        self.tables = list()
+        self.stamp = reftable_stamp(path)
+        try:
+            with open(os.path.join(path, REFTABLE_LIST), "r") as f:
+                names = f.read().split()
+        except FileNotFoundError:
+            names = list()
+        for name in names:
+            self.tables.append(GitReftable(os.path.join(path, name)))
+
+    def read(self, ref):
+        # The SHA or "ref: <target>" of ref, or None.
+        found = self.lookup(ref)
+        return found[0] if found else None
+
+    def peel(self, ref):
+        found = self.lookup(ref)
+        return found[1] if found else None
+
+    def lookup(self, ref):
+        name = ref.encode("utf8")
+        for table in reversed(self.tables):
+            found = table.lookup(name)
+            if found is not None:
+                return found[1]
+        return None
+
+    def iterate(self, prefix=""):
+        # Yields (name, value) for the refs starting with prefix, in order.
+        for name, update_index, value in self.merged(prefix.encode("utf8"), self.tables):
+            if value is not None:
+                yield name.decode("utf8"), value[0]
+
+    def merged(self, prefix, tables):
+        # The newest record of each name starting with prefix across
+        # tables, deletions included.
+        scans = [reftable_scan_prefix(table, prefix, -i) for (i, table) in enumerate(tables)]
+        prev = None
+        for key, _, update_index, value in heapq.merge(*scans):
+            if key != prev:
+                prev = key
+                yield key, update_index, value
+
+    def update(self, changes):
+        # changes maps ref names to (value, peeled), or None to delete.
+        # The new table is only visible once tables.list is renamed over.
+        with GitReftableLock(self.path):
+            self.__init__(self.path)
+            update_index = self.tables[-1].max_index + 1 if self.tables else 1
+            records = [(name.encode("utf8"), update_index, changes[name]) for name in changes]
+            records.sort(key=lambda r: r[0])
+            name = reftable_write(self.path, records, update_index, update_index)
+            self.tables.append(GitReftable(os.path.join(self.path, name)))
+            self.compact()
+
+    def pack(self):
+        # Merges every table into one; returns how many there were.
+        with GitReftableLock(self.path):
+            self.__init__(self.path)
+            return self.compact(full=True)
+
+    def compact(self, full=False):
+        # Must be called with tables.list locked.  Merges the newest
+        # tables whose sizes aren't geometric, or all of them with full.
+        sizes = [len(t.data) for t in self.tables]
+        start = len(self.tables) - 1
+        total = sizes[-1] if sizes else 0
+        while start > 0 and (full or sizes[start - 1] < REFTABLE_COMPACTION_FACTOR * total):
+            start -= 1
+            total += sizes[start]
+
+        segment = self.tables[start:]
+        if len(segment) > 1:
+            # Deletions only matter while an older table may hold the ref.
+            records = [(key, update_index, value)
+                       for (key, update_index, value) in self.merged(b'', segment)
+                       if value is not None or start > 0]
+            name = reftable_write(self.path, records, segment[0].min_index, segment[-1].max_index)
+            self.tables[start:] = [GitReftable(os.path.join(self.path, name))]
+
+        names = [os.path.basename(t.path) for t in self.tables]
+        with open(os.path.join(self.path, REFTABLE_LIST + ".lock"), "w") as f:
+            f.write("".join(name + "\n" for name in names))
+        os.replace(os.path.join(self.path, REFTABLE_LIST + ".lock"), os.path.join(self.path, REFTABLE_LIST))
+        self.stamp = reftable_stamp(self.path)
+
+        if len(segment) < 2:
+            return 0
+        # Open readers keep their mmap of the dropped tables.
+        for table in segment:
+            os.unlink(table.path)
+        return len(segment)
+
+class GitReftableLock(object):
+    # tables.list.lock, created exclusively; the stack rewrites it with
+    # the new list and renames it over tables.list.
+    def __init__(self, path):
+        self.path = os.path.join(path, REFTABLE_LIST + ".lock")
+
+    def __enter__(self):
+        try:
+            os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            raise Exception("Unable to lock {}: is another gitbab running?".format(self.path))
+
+    def __exit__(self, *args):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def reftable_scan_prefix(table, prefix, order):
+    for key, update_index, value in table.scan(prefix):
+        if not key.startswith(prefix):
+            return
+        yield key, order, update_index, value
+
+def reftable_stamp(path):
+    try:
+        st = os.stat(os.path.join(path, REFTABLE_LIST))
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def reftable_varint_decode(raw, idx):
+    # Same encoding as OFS_DELTA offsets in packs.
+    c = raw[idx]
+    idx += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = raw[idx]
+        idx += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, idx
+
+def reftable_varint_encode(value):
+    ret = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        value -= 1
+        ret.insert(0, 0x80 | (value & 0x7f))
+        value >>= 7
+    return ret
+
+def reftable_record(key, prev, value_type, value):
+    prefix = 0
+    limit = min(len(key), len(prev))
+    while prefix < limit and key[prefix] == prev[prefix]:
+        prefix += 1
+    return (reftable_varint_encode(prefix) +
+            reftable_varint_encode(((len(key) - prefix) << 3) | value_type) +
+            key[prefix:] + value)
+
+def reftable_ref_value(update_index, min_index, value):
+    # Returns (value type, encoded value).
+    delta = reftable_varint_encode(update_index - min_index)
+    if value is None:
+        return REFTABLE_VALUE_DELETION, delta
+    sha, peeled = value
+    if sha.startswith("ref: "):
+        target = sha[5:].encode("utf8")
+        return REFTABLE_VALUE_SYMREF, delta + reftable_varint_encode(len(target)) + target
+    if peeled:
+        return REFTABLE_VALUE_PEELED, delta + bytes.fromhex(sha) + bytes.fromhex(peeled)
+    return REFTABLE_VALUE_SHA, delta + bytes.fromhex(sha)
+
+def reftable_blocks(kind, records, block_size):
+    # records are (key, value type, encoded value), sorted.  Yields each
+    # block and its last key.
+    def finish():
+        return (REFTABLE_BLOCK.pack(kind, (len(buf) + 3 * len(restarts) + 2 + REFTABLE_BLOCK.size).to_bytes(3, "big")) +
+                buf + b''.join(r.to_bytes(3, "big") for r in restarts) + struct.pack(">H", len(restarts)))
+
+    buf = bytearray()
+    restarts = list()
+    count = 0
+    prev = b''
+    for key, value_type, value in records:
+        restart = count % REFTABLE_RESTART_INTERVAL == 0
+        record = reftable_record(key, b'' if restart else prev, value_type, value)
+        if buf and REFTABLE_BLOCK.size + len(buf) + len(record) + 3 * (len(restarts) + 1) + 2 > block_size:
+            yield finish(), prev
+            buf = bytearray()
+            restarts = list()
+            count = 0
+            restart = True
+            record = reftable_record(key, b'', value_type, value)
+        if restart:
+            restarts.append(REFTABLE_BLOCK.size + len(buf))
+        buf += record
+        count += 1
+        prev = key
+    if buf:
+        yield finish(), prev
+
+def reftable_write(path, records, min_index, max_index, block_size=REFTABLE_BLOCK_SIZE):
+    # records are (name, update index, value) sorted by name, value being
+    # (sha or "ref: <target>", peeled) or None for a deletion.  Returns
+    # the name of the new table in directory path.
+    header = REFTABLE_HEADER.pack(REFTABLE_MAGIC, REFTABLE_VERSION, block_size.to_bytes(3, "big"),
+                                  min_index, max_index)
+    raw = bytearray(header)
+
+    index = list()
+    encoded = [(key,) + reftable_ref_value(update_index, min_index, value)
+               for (key, update_index, value) in records]
+    for block, last in reftable_blocks(REFTABLE_BLOCK_REF, encoded, block_size):
+        index.append((last, 0, reftable_varint_encode(len(raw))))
+        raw += block
+
+    index_offset = 0
+    if len(index) > 1:
+        index_offset = len(raw)
+        # One index block, however big: it is bisected like any other.
+        for block, last in reftable_blocks(REFTABLE_BLOCK_INDEX, index, 1 << 24):
+            raw += block
+
+    footer = header + struct.pack(">Q", index_offset)
+    raw += footer + struct.pack(">I", zlib.crc32(footer))
+
+    name = "0x{:012x}-0x{:012x}-{}.table".format(min_index, max_index, os.urandom(4).hex())
+    with open(os.path.join(path, name + ".tmp"), "wb") as f:
+        f.write(raw)
+    os.replace(os.path.join(path, name + ".tmp"), os.path.join(path, name))
+    return name
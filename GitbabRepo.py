@@ -10,10 +10,20 @@ import sys
 import re
 import zlib
 
+from GitBab.GitbabReftable import REFTABLE_DIRECTORY, REFTABLE_EXTENSION, GitReftableStack, reftable_stamp
+
 class GitbabRepository(object):
     worktree = None
     gitdir = None
     conf = None
+    packs = None
+    packs_mtime = None
+    midx = None
+    graph = None
+    graph_mtime = None
+    cache = None
+    refs = None
+    names = None
 
     def __init__(self, path, force=False):
         self.worktree = path
@@ -29,12 +39,136 @@ class GitbabRepository(object):
             self.conf.read([cf])
         elif not force:
             raise Exception("Config file missing")
-        
+
+        self.cache = GitObjectCache(config_size(
+            self.conf.get("core", "objectCacheSize", fallback="32m")))
+
+class GitObjectCache(object):
+    # LRU cache of decoded (fmt, data) pairs keyed by SHA, bounded by the
+    # total size of the cached data.  Commits, trees and tags live in
+    # their own pool so that a few big blobs can't push out the small
+    # objects history and tree walks keep coming back to.
+    size = 0
+    used = 0
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    def __init__(self, size):
+        self.size = size
+        self.blob_size = size // 2
+        self.blob_max = size // 16
+        self.small = collections.OrderedDict()
+        self.blobs = collections.OrderedDict()
+        self.blobs_used = 0
+
+    def get(self, sha):
+        for pool in (self.small, self.blobs):
+            if sha in pool:
+                pool.move_to_end(sha)
+                self.hits += 1
+                return pool[sha]
+        self.misses += 1
+        return None
+
+    def put(self, sha, fmt, data):
+        if fmt == b'blob':
+            if len(data) > self.blob_max or sha in self.blobs:
+                return
+            self.blobs[sha] = (fmt, data)
+            self.blobs_used += len(data)
+        else:
+            if len(data) > self.size or sha in self.small:
+                return
+            self.small[sha] = (fmt, data)
+        self.used += len(data)
+
+        while self.blobs_used > self.blob_size:
+            self.evict(self.blobs)
+        while self.used > self.size:
+            self.evict(self.blobs if self.blobs else self.small)
+
+    def evict(self, pool):
+        _, (fmt, data) = pool.popitem(last=False)
+        self.used -= len(data)
+        if pool is self.blobs:
+            self.blobs_used -= len(data)
+        self.evictions += 1
+
+    def clear(self):
+        self.small.clear()
+        self.blobs.clear()
+        self.used = 0
+        self.blobs_used = 0
+
+class GitRefSnapshot(object):
+    # Every ref of a "files" repository, read once: the packed-refs file
+    # with the loose refs on top of it.  refs maps names (HEAD,
+    # refs/heads/...) to a SHA or "ref: <name>", peeled the packed tags to
+    # what they point at, loose the names that have a file of their own.
+    #
+    # The snapshot stays valid while packed-refs, HEAD and the directories
+    # under refs/ keep their mtime: refs are updated by renaming a lock
+    # file over them, which changes the directory.
+    format = "files"
+
+    def __init__(self, repo):
+        self.refs = dict()
+        self.packed = dict()
+        self.peeled = dict()
+        self.loose = set()
+        self.dirs = list()
+
+        stack = ["refs"]
+        while stack:
+            name = stack.pop()
+            try:
+                with os.scandir(repo_path(repo, name)) as it:
+                    entries = list(it)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            self.dirs.append(name)
+            for e in entries:
+                if e.is_dir():
+                    stack.append(name + "/" + e.name)
+                elif not e.name.endswith(".lock"):
+                    self.loose.add(name + "/" + e.name)
+        self.stamp = ref_stamp(repo, self.dirs)
+
+        path = repo_path(repo, REF_PACKED)
+        if os.path.isfile(path):
+            self.packed, self.peeled = packed_refs_read(path)
+        self.refs.update(self.packed)
+
+        for name in ["HEAD"] + sorted(self.loose):
+            data = ref_read_loose(repo, name)
+            if data is not None:
+                self.refs[name] = data
+            else:
+                self.loose.discard(name)
+
+    def read(self, ref):
+        return self.refs.get(ref)
+
+    def peel(self, ref):
+        return self.peeled.get(ref)
+
+    def iterate(self, prefix=""):
+        for name in sorted(n for n in self.refs if n.startswith(prefix)):
+            yield name, self.refs[name]
+
+def config_size(value):
+    value = value.strip().lower()
+    units = { "k": 1024, "m": 1024**2, "g": 1024**3 }
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
 def repo_path(repo, *path):
     return os.path.join(repo.gitdir, *path)
     
 def repo_file(repo, *path, mkdir=False):
-    if repo_directory(repo, *path, mkdir=False):
+    if repo_directory(repo, *path[:-1], mkdir=mkdir):
         return repo_path(repo, *path)
     
 def repo_directory(repo, *path, mkdir=False):
@@ -47,12 +181,12 @@ def repo_directory(repo, *path, mkdir=False):
             raise Exception(f"Not a directory {path}")
         
     if mkdir:
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
         return path
     else:
         return None
     
-def repo_create(path):
+def repo_create(path, ref_format="files"):
     repo = GitbabRepository(path, True)
     if os.path.exists(repo.worktree):
         if not os.path.isdir(repo.worktree):
@@ -64,22 +198,29 @@ def repo_create(path):
 
     assert repo_directory(repo, "branches", mkdir=True)
     assert repo_directory(repo, "objects", mkdir=True)
-    assert repo_directory(repo, "refs", "tags", mkdir=True)
-    assert repo_directory(repo, "refs", "heads", mkdir=True)
-
     with open(repo_file(repo, "description"), "w") as f:
         f.write("Unnamed repository; edit this file 'description' to name the repository.\n")
 
-    with open(repo_file(repo, "HEAD"), "w") as f:
-        f.write("ref: refs/heads/master\n")
+    if ref_format == "reftable":
+        # HEAD lives in the tables; the file only keeps the directory
+        # recognizable as a repository.
+        stack = GitReftableStack(repo_directory(repo, REFTABLE_DIRECTORY, mkdir=True))
+        stack.update({"HEAD": ("ref: refs/heads/master", None)})
+        with open(repo_file(repo, "HEAD"), "w") as f:
+            f.write("ref: refs/heads/.invalid\n")
+    else:
+        assert repo_directory(repo, "refs", "tags", mkdir=True)
+        assert repo_directory(repo, "refs", "heads", mkdir=True)
+        with open(repo_file(repo, "HEAD"), "w") as f:
+            f.write("ref: refs/heads/master\n")
 
     with open(repo_file(repo, "config"), "w") as f:
-        config = repo_default_config()
+        config = repo_default_config(ref_format)
         config.write(f)
 
     return repo
 
-def repo_default_config():
+def repo_default_config(ref_format="files"):
     ret = configparser.ConfigParser()
 
     ret.add_section("core")
@@ -87,6 +228,13 @@ def repo_default_config():
     ret.set("core", "filemode", "false")
     ret.set("core", "bare", "false")
 
+    # Like git, a ref backend other than loose files and packed-refs is
+    # a repository extension.
+    if ref_format == "reftable":
+        ret.set("core", "repositoryformatversion", "1")
+        ret.add_section("extensions")
+        ret.set("extensions", "refStorage", REFTABLE_EXTENSION)
+
     return ret        
     
 def repo_find(path=".", required=True):
@@ -104,28 +252,134 @@ def repo_find(path=".", required=True):
 
     return repo_find(parent, required)
 
-def ref_resolve(repo, ref):
-    path = repo_file(repo, ref)
+REF_PACKED = "packed-refs"
+REF_PACKED_HEADER = "# pack-refs with: peeled fully-peeled sorted \n"
+# Longest chain of symbolic refs followed, as in git.
+REF_MAX_DEPTH = 5
+
+def ref_stamp(repo, dirs):
+    ret = list()
+    for name in [REF_PACKED, "HEAD"] + dirs:
+        try:
+            st = os.stat(repo_path(repo, name))
+            ret.append((st.st_mtime_ns, st.st_size, st.st_ino))
+        except FileNotFoundError:
+            ret.append(None)
+    return ret
+
+def repo_ref_format(repo):
+    value = repo.conf.get("extensions", "refStorage", fallback="files")
+    if value == REFTABLE_EXTENSION:
+        return "reftable"
+    if value != "files":
+        # git's own reftables among them: they aren't ours.
+        raise Exception("Unsupported ref storage: {}".format(value))
+    return value
 
-    if not os.path.isfile(path):
+def ref_store(repo):
+    # The repository's refs: a GitRefSnapshot or a GitReftableStack, both
+    # offering read, peel and iterate, reloaded when they changed on disk.
+    store = repo.refs
+    if repo_ref_format(repo) == "reftable":
+        path = repo_path(repo, REFTABLE_DIRECTORY)
+        if store is None or store.stamp != reftable_stamp(path):
+            store = repo.refs = GitReftableStack(path)
+    elif store is None or store.stamp != ref_stamp(repo, store.dirs):
+        store = repo.refs = GitRefSnapshot(repo)
+    return store
+
+def ref_read_loose(repo, name):
+    try:
+        with open(repo_path(repo, name), 'r') as fp:
+            return fp.read().rstrip("\n")
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
         return None
-    
-    with open(path, 'r') as fp:
-        data = fp.read()[:-1]
-    if data.startswith("ref: "):
-        return ref_resolve(repo, data[5:])
-    else:
-        return data
-    
-def ref_list(repo, path=None):
-    if not path:
-        path = repo_dir(repo, "refs")
+
+def ref_read(repo, ref, store=None):
+    # The SHA or "ref: <name>" stored in ref, without following it.
+    store = store or ref_store(repo)
+    data = store.read(ref)
+    if data is None and not ref.startswith("refs/") and store.format == "files":
+        # Pseudo refs (ORIG_HEAD...) aren't part of the snapshot.
+        data = ref_read_loose(repo, ref)
+    return data
+
+def ref_resolve(repo, ref, store=None):
+    store = store or ref_store(repo)
+    for i in range(REF_MAX_DEPTH):
+        data = ref_read(repo, ref, store)
+        if data is None or not data.startswith("ref: "):
+            return data
+        ref = data[5:]
+    return None
+
+def ref_peeled(repo, ref):
+    # What a packed tag points to, or None when unknown.
+    return ref_store(repo).peel(ref)
+
+def ref_iterate(repo, prefix="refs/"):
+    # (name, SHA) of the refs starting with prefix, sorted by name.
+    store = ref_store(repo)
+    for name, data in store.iterate(prefix):
+        yield name, ref_resolve(repo, data[5:], store) if data.startswith("ref: ") else data
+
+def ref_list(repo, prefix="refs"):
+    # The refs below prefix, as nested dicts keyed by path component.
     ret = collections.OrderedDict()
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can)
-        else:
-            ret[f] = ref_resolve(repo, can)
+    for name, sha in ref_iterate(repo, prefix + "/"):
+        node = ret
+        parts = name[len(prefix) + 1:].split("/")
+        for part in parts[:-1]:
+            node = node.setdefault(part, collections.OrderedDict())
+        node[parts[-1]] = sha
+
+    return ret
+
+def ref_update(repo, ref, sha, peeled=None):
+    # peeled, what an annotated tag ends at, is kept by reftables.
+    if repo_ref_format(repo) == "reftable":
+        ref_store(repo).update({ref: (sha, peeled)})
+        return
+
+    # Write to a lock file and rename it over the ref, so readers never
+    # see half a ref and snapshots notice the change.
+    path = repo_file(repo, *ref.split("/"), mkdir=True)
+    with open(path + ".lock", "w") as fp:
+        fp.write(sha + "\n")
+    os.replace(path + ".lock", path)
+    repo.refs = None
+
+def packed_refs_read(path):
+    # Returns (name -> SHA, name -> peeled SHA).
+    refs = dict()
+    peeled = dict()
+    name = None
+    with open(path, "r") as fp:
+        for line in fp:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("^"):
+                if name is None:
+                    raise Exception("Malformed packed-refs: {}".format(line))
+                peeled[name] = line[1:]
+                continue
+            sha, _, name = line.partition(" ")
+            refs[name] = sha
+    return refs, peeled
+
+def packed_refs_write(repo, refs, peeled):
+    # refs maps names to SHAs, peeled the names of annotated tags to the
+    # object they end at.
+    path = repo_path(repo, REF_PACKED)
+    lines = [REF_PACKED_HEADER]
+    # Sorted bytewise, like git expects.
+    for name in sorted(refs, key=lambda n: n.encode("utf8")):
+        lines.append("{} {}\n".format(refs[name], name))
+        if name in peeled:
+            lines.append("^{}\n".format(peeled[name]))
 
-    return ret
\ No newline at end of file
+    with open(path + ".lock", "w") as fp:
+        fp.write("".join(lines))
+    os.replace(path + ".lock", path)
+    repo.refs = None
\ No newline at end of file
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+# Compares reachable-object queries answered from the reachability bitmaps
+# with the plain history walk, on an existing repository.  Run
+# "gitbab repackbab -a -d" there first to get a bitmapped pack.
+#
+#   python3 benchmarks/bench_bitmap.py [repository]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from GitBab.GitbabBitmap import bitmap_read, reachable_objects
+from GitBab.GitbabGraph import commit_graph_tips, commit_parents
+from GitBab.GitbabRepo import repo_find
+
+def timed(f):
+    start = time.perf_counter()
+    ret = f()
+    return ret, time.perf_counter() - start
+
+def bench(repo, name, tips, exclude=()):
+    # Each walk starts from a cold object cache.
+    repo.cache.clear()
+    hits, misses = repo.cache.hits, repo.cache.misses
+    walk, walk_time = timed(lambda: reachable_objects(repo, tips, exclude, use_bitmap=False))
+    hits, misses = repo.cache.hits - hits, repo.cache.misses - misses
+    bitmap, bitmap_time = timed(lambda: reachable_objects(repo, tips, exclude))
+    assert sorted(walk.items()) == sorted(bitmap.items())
+    print("{:<24} {:>9} objects  walk {:>8.3f}s  bitmap {:>8.3f}s  {:>7.1f}x  walk cache {:>7} hits {:>7} misses".format(
+        name, len(bitmap), walk_time, bitmap_time, walk_time / bitmap_time if bitmap_time else 0, hits, misses))
+
+if __name__ == "__main__":
+    repo = repo_find(sys.argv[1] if len(sys.argv) > 1 else ".")
+    if bitmap_read(repo) is None:
+        print("No reachability bitmap: only the walk will be measured.")
+
+    tips = commit_graph_tips(repo)
+    bench(repo, "all refs", tips)
+    bench(repo, "HEAD", tips[-1:])
+
+    # What a fetch from HEAD's parent would need: an AND-NOT of two sets.
+    parents = commit_parents(repo, tips[-1])
+    if parents:
+        bench(repo, "HEAD ^HEAD~1", tips[-1:], parents[:1])
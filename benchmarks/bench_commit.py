@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Measures commit header parsing and serialization on synthetic commits.
+#
+#   python3 benchmarks/bench_commit.py [count ...]
+
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from GitBab.GitbabObject import GitCommit, kvlm_parse, kvlm_serialize
+
+SIGNATURE = b"-----BEGIN PGP SIGNATURE-----\n" + b"\n".join([b"A" * 64] * 12) + b"\n-----END PGP SIGNATURE-----"
+
+def make_commit(i, parents=1):
+    commit = GitCommit()
+    commit.kvlm[b"tree"] = hashlib.sha1(b"tree%d" % i).hexdigest().encode("ascii")
+    commit.kvlm[b"parent"] = [hashlib.sha1(b"parent%d.%d" % (i, p)).hexdigest().encode("ascii")
+                              for p in range(parents)]
+    commit.kvlm[b"author"] = b"A U Thor <author@example.com> 1700000000 +0000"
+    commit.kvlm[b"committer"] = b"C O Mitter <committer@example.com> 1700000000 +0000"
+    commit.kvlm[b"gpgsig"] = SIGNATURE
+    commit.kvlm[None] = b"Commit %d\n\n" % i + b"Some longer description.\n" * 20
+    return commit.serialize()
+
+def bench(count):
+    raws = [make_commit(i) for i in range(count)]
+
+    start = time.perf_counter()
+    for raw in raws:
+        kvlm_parse(raw)
+    parse = time.perf_counter() - start
+
+    # A history walk only needs the parents.
+    start = time.perf_counter()
+    for raw in raws:
+        GitCommit(raw).parents
+    walk = time.perf_counter() - start
+
+    kvlms = [kvlm_parse(raw) for raw in raws]
+    start = time.perf_counter()
+    for kvlm in kvlms:
+        kvlm_serialize(kvlm)
+    serialize = time.perf_counter() - start
+
+    print("{:>8} commits  parse {:>7.3f}s {:>9,.0f}/s  walk {:>7.3f}s {:>9,.0f}/s  serialize {:>7.3f}s {:>9,.0f}/s".format(
+        count, parse, count / parse, walk, count / walk, serialize, count / serialize))
+
+    # An octopus merge with more parents than the recursion limit.
+    raw = make_commit(0, parents=sys.getrecursionlimit() * 2)
+    assert kvlm_serialize(kvlm_parse(raw)) == raw
+
+if __name__ == "__main__":
+    for count in [int(n) for n in sys.argv[1:]] or [10000, 100000]:
+        bench(count)
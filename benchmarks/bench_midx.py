@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+# Compares object lookups through each pack index in turn with lookups
+# through the multi-pack-index, on an existing repository with several
+# packs.  Run "gitbab multi-pack-indexbab write" there first.
+#
+#   python3 benchmarks/bench_midx.py [repository]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from GitBab.GitbabPack import pack_find, pack_list
+from GitBab.GitbabRepo import repo_find
+
+def bench(repo, name, shas):
+    start = time.perf_counter()
+    found = [pack_find(repo, sha) for sha in shas]
+    elapsed = time.perf_counter() - start
+    print("{:<20} {:>8} lookups  {:>8.3f}s {:>10,.0f}/s".format(name, len(shas), elapsed, len(shas) / elapsed))
+    return [(pack.path, offset) if pack else None for (pack, offset) in (f or (None, None) for f in found)]
+
+if __name__ == "__main__":
+    repo = repo_find(sys.argv[1] if len(sys.argv) > 1 else ".")
+    packs = pack_list(repo)
+    if repo.midx is None:
+        print("No multi-pack-index: only the per-pack lookups will be measured.")
+
+    # Objects of every pack, and as many names that are in none of them:
+    # the worst case without a multi-pack-index, which probes every .idx.
+    shas = [pack.index.sha_at(i).hex() for pack in packs for i in range(pack.index.count)]
+    shas = random.sample(shas, min(len(shas), 20000))
+    missing = ["{:040x}".format(random.getrandbits(160)) for _ in shas]
+    print("{} packs, {} objects".format(len(packs), sum(pack.index.count for pack in packs)))
+
+    midx = repo.midx
+    with_midx = bench(repo, "present, midx", shas)
+    bench(repo, "missing, midx", missing)
+    repo.midx = None
+    without = bench(repo, "present, per pack", shas)
+    bench(repo, "missing, per pack", missing)
+    repo.midx = midx
+
+    # Duplicated objects may come from another pack, but the same data.
+    assert all((a is None) == (b is None) for (a, b) in zip(with_midx, without))
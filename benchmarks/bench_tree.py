@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+# Measures tree_parse/tree_serialize throughput on synthetic large trees.
+#
+#   python3 benchmarks/bench_tree.py [count ...]
+
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from GitBab.GitbabObject import GitTree, GitTreeLeaf, tree_parse, tree_serialize
+
+def make_tree(count):
+    tree = GitTree()
+    for i in range(count):
+        mode = b"040000" if i % 10 == 0 else b"100644"
+        tree.items.append(GitTreeLeaf(mode, "entry{:07d}.py".format(i),
+                                      raw_sha=hashlib.sha1(str(i).encode("ascii")).digest()))
+    return tree
+
+def bench(count, rounds=5):
+    raw = tree_serialize(make_tree(count))
+
+    start = time.perf_counter()
+    for i in range(rounds):
+        items = tree_parse(raw)
+    parse = (time.perf_counter() - start) / rounds
+
+    tree = GitTree()
+    tree.items = items
+    start = time.perf_counter()
+    for i in range(rounds):
+        out = tree_serialize(tree)
+    serialize = (time.perf_counter() - start) / rounds
+    assert out == raw
+
+    # What ls-treebab pays on top of parsing: a hex SHA per leaf.
+    start = time.perf_counter()
+    for leaf in items:
+        leaf.sha
+    hexes = time.perf_counter() - start
+
+    print("{:>9} entries  {:>6.1f} MB  parse {:>7.4f}s {:>11,.0f} entries/s  serialize {:>7.4f}s {:>11,.0f} entries/s  hex {:>7.4f}s".format(
+        count, len(raw) / 1e6, parse, count / parse, serialize, count / serialize, hexes))
+
+if __name__ == "__main__":
+    for count in [int(n) for n in sys.argv[1:]] or [1000, 50000, 500000]:
+        bench(count)
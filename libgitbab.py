@@ -1,13 +1,24 @@
 import argparse
 import collections
+import concurrent.futures
 import configparser
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from fnmatch import fnmatch
+import glob
 import grp
+import hashlib
 import os
 import pwd
+import re
+from stat import S_ISLNK
 import sys
-from GitBab.GitbabObject import GitCommit, GitIgnore, GitIndexEntry, GitTag, index_read, index_write, object_find, object_hash, object_read, object_write, tree_checkout, tree_from_index
+import time
+from GitBab.GitbabObject import INDEX_EXT_FSMONITOR, INDEX_EXT_UNTRACKED, INDEX_VERSIONS, GitCommit, GitFsmonitorState, GitIgnore, GitIndexEntry, GitTag, GitBlob, GitUntrackedCache, index_entry_set_stat, index_entry_stat_matches, index_read, index_serialize, index_write, kvlm_parse, object_find, object_hash, object_loose_list, object_read, object_read_raw, object_size, object_stream, object_write, object_write_raw, stat_mode_type, tree_checkout, tree_from_index, tree_parse
+from GitBab.GitbabBitmap import bitmap_write, reachable_objects
+from GitBab.GitbabGraph import GitPathFilter, commit_date, commit_graph_tips, commit_graph_verify, commit_graph_write, commit_walk
+from GitBab.GitbabNames import object_abbrev_length, object_names, object_names_refresh, object_names_write
+from GitBab.GitbabFsmonitor import GitFsmonitorDaemon, fsmonitor_query, fsmonitor_request, fsmonitor_stop
+from GitBab.GitbabPack import pack_find, pack_list, pack_midx_path, pack_midx_verify, pack_midx_write, pack_name_hash, pack_write
 import GitbabRepo
         
 parser = argparse.ArgumentParser(description="gitbab: git by Arbab")
@@ -15,6 +26,8 @@ subargparse = parser.add_subparsers(title="Args", dest="command")
 subargparse.required = True
 argsp = subargparse.add_parser("initbab", help="Initialize a new, empty gitbab repository.")
 argsp.add_argument("path", metavar="directory", nargs="?", default=".", help="Where to create the repository.")
+argsp.add_argument("--ref-format", dest="ref_format", choices=["files", "reftable"], default="files",
+                   help="Store refs as loose files and packed-refs, or in binary sorted tables.")
 argsp = subargparse.add_parser("cat-file",
                                  help="Provide content of repository objects")
 
@@ -65,6 +78,21 @@ argsp.add_argument("path",
 
 argsp = subargparse.add_parser("show-refbab", help="List references.")
 
+argsp.add_argument("pattern",
+                   nargs="*",
+                   help="Only show refs matching these patterns (refs/tags/v2.*)")
+
+argsp = subargparse.add_parser("pack-refsbab", help="Move refs into the packed-refs file.")
+
+argsp.add_argument("--all",
+                   action="store_true",
+                   help="Pack all refs, not only tags and refs already packed")
+
+argsp.add_argument("--no-prune",
+                   dest="prune",
+                   action="store_false",
+                   help="Keep the loose ref files")
+
 argsp = subargparse.add_parser(
     "tagbab",
     help="List and create tags")
@@ -99,17 +127,36 @@ argsp.add_argument("name",
 
 argsp = subargparse.add_parser("ls-filebab", help = "List all the stage files")
 argsp.add_argument("--verbose", action="store_true", help="Show everything.")
+argsp.add_argument("--stat",
+                   action="store_true",
+                   help="Only report the index size on disk, and what it would be in each version.")
+argsp.add_argument("path", nargs="*", help="Only list these files or directories")
 
 argsp = subargparse.add_parser("check-ignorebab", help = "Check path(s) against ignore rules.")
 argsp.add_argument("path", nargs="+", help="Paths to check")
 
 argsp = subargparse.add_parser("statusbab", help = "Show the working tree status.")
+argsp.add_argument("-j",
+                   metavar="jobs",
+                   dest="jobs",
+                   type=int,
+                   default=None,
+                   help="Number of threads for lstat and rehashing")
+argsp.add_argument("--refresh",
+                   action="store_true",
+                   help="Update the index's stat data for unchanged files")
 
 argsp = subargparse.add_parser("rmbab", help="Remove files from the working tree and the index.")
 argsp.add_argument("path", nargs="+", help="Files to remove")
 
 argsp = subargparse.add_parser("addbab", help = "Add files contents to the index.")
-argsp.add_argument("path", nargs="+", help="Files to add")
+argsp.add_argument("-j",
+                   metavar="jobs",
+                   dest="jobs",
+                   type=int,
+                   default=None,
+                   help="Number of processes hashing files (default: one per CPU)")
+argsp.add_argument("path", nargs="+", help="Files, directories or glob pathspecs to add")
 
 argsp = subargparse.add_parser("commitbab", help="Record changes to the repository.")
 
@@ -118,16 +165,156 @@ argsp.add_argument("-m",
                    dest="message",
                    help="Message to associate with this commit.")
 
+argsp = subargparse.add_parser("logbab", help="Display history of a given commit.")
+
+argsp.add_argument("-n", "--max-count",
+                   metavar="number",
+                   dest="max_count",
+                   type=int,
+                   default=None,
+                   help="Limit the number of commits to output")
+
+argsp.add_argument("--since",
+                   metavar="date",
+                   default=None,
+                   help="Only show commits more recent than a date (timestamp, ISO date or \"2 weeks ago\")")
+
+argsp.add_argument("--until",
+                   metavar="date",
+                   default=None,
+                   help="Only show commits older than a date")
+
+argsp.add_argument("--oneline",
+                   action="store_true",
+                   help="Show each commit as its short hash and subject")
+
+argsp.add_argument("--format",
+                   metavar="format",
+                   default=None,
+                   help="Pretty-print commits with placeholders: %%H %%h %%T %%P %%an %%ae %%ad %%cn %%ce %%cd %%s %%b %%n %%%%")
+
+argsp.add_argument("--topo-order",
+                   dest="topo_order",
+                   action="store_true",
+                   help="Show no parents before all of their children")
+
+argsp.add_argument("--graphviz",
+                   action="store_true",
+                   help="Output the history as a graphviz graph")
+
+argsp.add_argument("--bloom-stats",
+                   dest="bloom_stats",
+                   action="store_true",
+                   help="With paths, report how the changed-path filters did on stderr")
+
+argsp.add_argument("commit",
+                   default=["HEAD"],
+                   nargs="*",
+                   help="Commits to start at, optionally followed by -- and paths to limit the history to.")
+
+argsp = subargparse.add_parser("commit-graphbab", help="Write or verify the commit-graph file.")
+
+argsp.add_argument("action",
+                   choices=["write", "verify"],
+                   help="write the graph of all commits reachable from the refs, or check it against the objects")
+
+argsp.add_argument("--changed-paths",
+                   dest="changed_paths",
+                   action="store_true",
+                   default=None,
+                   help="Also write changed-path Bloom filters for logbab -- <path>")
+
+argsp.add_argument("--no-changed-paths",
+                   dest="changed_paths",
+                   action="store_false",
+                   help="Drop the changed-path Bloom filters")
+
+argsp = subargparse.add_parser("multi-pack-indexbab", help="Write or verify the multi-pack-index.")
+
+argsp.add_argument("action",
+                   choices=["write", "verify"],
+                   help="write one index over the objects of every pack, or check it against the packs")
+
+argsp = subargparse.add_parser("rev-listbab", help="List the objects reachable from some commits.")
+
+argsp.add_argument("--objects",
+                   action="store_true",
+                   help="List trees, blobs and tags too, not only commits")
+
+argsp.add_argument("--count",
+                   action="store_true",
+                   help="Only print how many objects there are")
+
+argsp.add_argument("--no-bitmap",
+                   dest="use_bitmap",
+                   action="store_false",
+                   help="Walk the history even when there is a reachability bitmap")
+
+argsp.add_argument("commit",
+                   nargs="+",
+                   help="Commits to start at; ^<commit> excludes what it reaches.")
+
+argsp = subargparse.add_parser("repackbab", help="Pack loose objects into a packfile.")
+
+argsp.add_argument("-a",
+                   dest="all",
+                   action="store_true",
+                   help="Pack everything reachable from the refs into a single pack, with a reachability bitmap")
+
+argsp.add_argument("-d",
+                   dest="prune",
+                   action="store_true",
+                   help="Remove loose objects once they are packed, and with -a the packs replaced")
+
+argsp.add_argument("--window",
+                   type=int,
+                   default=10,
+                   help="Number of objects considered as delta bases")
+
+argsp.add_argument("--depth",
+                   type=int,
+                   default=50,
+                   help="Maximum delta chain length")
+
+argsp = subargparse.add_parser("gcbab", help="Repack everything reachable and prune old unreachable loose objects.")
+
+argsp.add_argument("--prune",
+                   metavar="date",
+                   default=None,
+                   help="Prune unreachable loose objects older than date (default: gc.pruneExpire, or 2 weeks ago)")
+
+argsp.add_argument("--window",
+                   type=int,
+                   default=10,
+                   help="Number of objects considered as delta bases")
+
+argsp.add_argument("--depth",
+                   type=int,
+                   default=50,
+                   help="Maximum delta chain length")
+
+argsp = subargparse.add_parser("fsmonitorbab", help="Run the filesystem monitor daemon used by statusbab and addbab.")
+
+argsp.add_argument("action",
+                   choices=["start", "run", "stop", "status"],
+                   help="start in the background, run in the foreground, stop, or check the daemon")
+
 def main(argv=sys.argv[1:]):
+    # argparse can't tell the paths after -- from the commits before it.
+    pathspec = list()
+    if argv and argv[0] == "logbab" and "--" in argv:
+        i = argv.index("--")
+        argv, pathspec = argv[:i], argv[i + 1:]
     args = parser.parse_args(argv)
+    args.pathspec = pathspec
     cmd = args.command
     if cmd == "initbab":
         initbab(args)
     elif cmd == "addbab":
         addbab(args)
-    elif cmd == "catbab-file":
+    elif cmd == "cat-file":
         catbab(args)
-    elif cmd == "checkout":
+    elif cmd == "checkoutbab":
         checkoutbab(args)
     elif cmd == "commitbab":
         commitbab(args)
@@ -139,6 +326,8 @@ def main(argv=sys.argv[1:]):
         ls_treebab(args)
     elif cmd == "show-refbab":
         show_refbab(args)
+    elif cmd == "pack-refsbab":
+        pack_refsbab(args)
     elif cmd == "tagbab":
         tagbab(args)
     elif cmd == "rev-parsebab":
@@ -149,14 +338,28 @@ def main(argv=sys.argv[1:]):
         check_ignorebab(args)
     elif cmd == "rmbab":
         rmbab(args)
+    elif cmd == "statusbab":
+        statusbab(args)
+    elif cmd == "fsmonitorbab":
+        fsmonitorbab(args)
+    elif cmd == "rev-listbab":
+        rev_listbab(args)
+    elif cmd == "repackbab":
+        repackbab(args)
+    elif cmd == "gcbab":
+        gcbab(args)
+    elif cmd == "commit-graphbab":
+        commit_graphbab(args)
+    elif cmd == "multi-pack-indexbab":
+        multi_pack_indexbab(args)
     
 
 def initbab(args):
-    GitbabRepo.repo_create(args.path)
+    GitbabRepo.repo_create(args.path, ref_format=args.ref_format)
 
 def catbab(args):
     repo = GitbabRepo.repo_find()
-    cat_file()
+    cat_file(repo, args.object, fmt=args.type.encode())
 
 def hashbab(args):
     if args.write:
@@ -170,11 +373,29 @@ def hashbab(args):
 
 def ls_filebab(args):
     repo = GitbabRepo.repo_find()
-    index = index_read(repo)
+    if args.stat:
+        return ls_files_stat(repo)
+
+    # Listing a few paths only needs to decode their entries.
+    index = index_read(repo, lazy=bool(args.path))
     if args.verbose:
-        print("Index file format v{}, containing {} entries.".format(index.version, len(index.entries)))
+        print("Index file format v{}, containing {} entries.".format(index.version, len(index)))
+
+    if args.path:
+        entries = list()
+        for path in args.path:
+            relpath = os.path.relpath(os.path.abspath(path), repo.worktree)
+            if relpath == ".":
+                relpath = ""
+            entry = index.find(relpath)
+            if entry:
+                entries.append(entry)
+            else:
+                entries.extend(index.directory_entries(relpath))
+    else:
+        entries = index.entries
 
-    for e in index.entries:
+    for e in entries:
         print(e.name)
         if args.verbose:
             print("  {} with perms: {:o}".format(
@@ -197,14 +418,186 @@ def ls_filebab(args):
             print("  flags: stage={} assume_valid={}".format(
                 e.flag_stage,
                 e.flag_assume_valid))
+
+def ls_files_stat(repo):
+    path = GitbabRepo.repo_file(repo, "index")
+    if not os.path.exists(path):
+        print("No index file.")
+        return
+
+    index = index_read(repo)
+    size = os.path.getsize(path)
+    names = sum(len(e.name.encode("utf8")) for e in index.entries)
+    print("Index file format v{}, {} entries, {} bytes on disk ({} bytes of paths).".format(
+        index.version, len(index), size, names))
+
+    if index.split_base:
+        name = "sharedindex." + index.split_base.sha.hex()
+        print("  split index, shared base {}: {} entries, {} bytes".format(
+            name, len(index.split_base), os.path.getsize(GitbabRepo.repo_file(repo, name))))
+    if index.cache_tree:
+        print("  extension TREE: {} bytes".format(len(index.cache_tree.serialize())))
+    for signature, data in index.ext.items():
+        print("  extension {}: {} bytes".format(signature.decode("ascii", "replace"), len(data)))
+
+    for version in INDEX_VERSIONS:
+        print("  as v{}: {} bytes".format(version, len(index_serialize(index, version))))
+
 def logbab(args):
     repo = GitbabRepo.repo_find()
+    tips = [object_find(repo, name, fmt=b"commit") for name in args.commit]
+
+    path_filter = None
+    if args.pathspec:
+        paths = list()
+        for path in args.pathspec:
+            relpath = os.path.relpath(os.path.abspath(path), repo.worktree)
+            if relpath.startswith(".."):
+                raise Exception("Path outside of worktree: {}".format(path))
+            paths.append(relpath.replace(os.sep, "/"))
+        path_filter = GitPathFilter(repo, paths)
+
+    try:
+        if args.graphviz:
+            log_graphviz(repo, tips)
+        else:
+            log_text(repo, tips, args, path_filter)
+    except BrokenPipeError:
+        # The reader (head, a pager...) went away: stop quietly.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+    if path_filter and args.bloom_stats:
+        log_bloom_stats(path_filter)
+    object_names_write(repo)
+
+def log_text(repo, tips, args, path_filter=None):
+    since = log_parse_date(args.since) if args.since else None
+    until = log_parse_date(args.until) if args.until else None
+    fmt = "%h %s" if args.oneline else args.format
+
+    # Short hashes are as long as they need to be to stay unambiguous.
+    names = object_names(repo)
+    length = object_abbrev_length(repo)
+    abbrev = lambda sha: names.abbrev(sha, length)
+
+    count = 0
+    simplify = path_filter.simplify if path_filter else None
+    for sha in commit_walk(repo, tips, topo=args.topo_order, since=since, simplify=simplify):
+        if args.max_count is not None and count >= args.max_count:
+            break
+
+        commit = object_read(repo, sha)
+        date = commit_date(commit)
+        if (since is not None and date < since) or (until is not None and date > until):
+            continue
+
+        if fmt is None:
+            if count:
+                sys.stdout.write("\n")
+            sys.stdout.write(log_format_medium(sha, commit, abbrev))
+        else:
+            sys.stdout.write(log_format(fmt, sha, commit, abbrev) + "\n")
+        # Each commit goes out as soon as it is found.
+        sys.stdout.flush()
+        count += 1
+
+def log_bloom_stats(path_filter):
+    for name, count in path_filter.stats.items():
+        sys.stderr.write("{}: {}\n".format(name, count))
+    sys.stderr.write("false positive rate: {:.2%}\n".format(path_filter.false_positive_rate()))
+
+def log_format_medium(sha, commit, abbrev=None):
+    ret = "commit {}\n".format(sha)
+    parents = commit.parents
+    if len(parents) > 1:
+        ret += "Merge: {}\n".format(" ".join(abbrev(p) if abbrev else p[:7] for p in parents))
+    ret += log_format("Author: %an <%ae>%nDate:   %ad%n%n", sha, commit)
+    message = bytes(commit.kvlm[None]).decode("utf8", "replace").rstrip("\n")
+    for line in message.split("\n"):
+        ret += ("    " + line).rstrip() + "\n"
+    return ret
+
+def log_format(fmt, sha, commit, abbrev=None):
+    ret = list()
+    i = 0
+    while i < len(fmt):
+        c = fmt[i]
+        if c != "%" or i + 1 == len(fmt):
+            ret.append(c)
+            i += 1
+            continue
+
+        key = fmt[i+1:i+3]
+        if key in ("an", "ae", "ad", "cn", "ce", "cd"):
+            header = commit.kvlm[b'author' if key[0] == "a" else b'committer']
+            ret.append(log_format_person(header, key[1]))
+            i += 3
+            continue
+
+        key = fmt[i+1]
+        message = bytes(commit.kvlm[None]).decode("utf8", "replace")
+        subject, _, body = message.partition("\n\n")
+        if key == "H":
+            ret.append(sha)
+        elif key == "h":
+            ret.append(abbrev(sha) if abbrev else sha[:7])
+        elif key == "T":
+            ret.append(commit.tree)
+        elif key == "P":
+            ret.append(" ".join(commit.parents))
+        elif key == "s":
+            ret.append(" ".join(subject.strip().split("\n")))
+        elif key == "b":
+            ret.append(body)
+        elif key == "n":
+            ret.append("\n")
+        elif key == "%":
+            ret.append("%")
+        else:
+            ret.append(fmt[i:i+2])
+        i += 2
+    return "".join(ret)
+
+def log_format_person(header, field):
+    # "Name <email> timestamp timezone"
+    person, timestamp, tz = header.decode("utf8", "replace").rsplit(" ", 2)
+    if field == "n":
+        return person[:person.find("<")].strip()
+    if field == "e":
+        return person[person.find("<") + 1:person.rfind(">")]
+
+    sign = -1 if tz[0] == "-" else 1
+    offset = timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5])) * sign
+    date = datetime.fromtimestamp(int(timestamp), timezone(offset))
+    return "{} {} {} {}".format(date.strftime("%a %b"), date.day, date.strftime("%H:%M:%S %Y"), tz)
+
+LOG_DATE_UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400,
+                  "week": 7 * 86400, "month": 30 * 86400, "year": 365 * 86400}
+
+def log_parse_date(text):
+    # Unix timestamps, ISO 8601 dates and "<n> <unit>(s) ago".
+    text = text.strip()
+    if text.isdigit():
+        return int(text)
+    if text == "now":
+        return int(time.time())
+
+    words = text.replace(".", " ").split()
+    if len(words) == 3 and words[2] == "ago" and words[0].isdigit():
+        unit = words[1][:-1] if words[1].endswith("s") else words[1]
+        if unit in LOG_DATE_UNITS:
+            return int(time.time()) - int(words[0]) * LOG_DATE_UNITS[unit]
+
+    try:
+        date = datetime.fromisoformat(text)
+    except ValueError:
+        raise Exception("Invalid date: {}".format(text))
+    if date.tzinfo is None:
+        date = date.astimezone()
+    return int(date.timestamp())
+
 
-    print("digraph wyaglog{")
-    print("  node[shape=rect]")
-    log_graphviz(repo, object_find(repo, args.commit), set())
-    print("}")
-    
 def ls_treebab(args):
     repo = GitbabRepo.repo_find()
     ls_treebab_helper(repo, args.tree, args.recursive)
@@ -240,14 +633,13 @@ def statusbab(args):
     cmd_status_branch(repo)
     cmd_status_head_index(repo, index)
     print()
-    cmd_status_index_worktree(repo, index)
+    cmd_status_index_worktree(repo, index, jobs=args.jobs, refresh=args.refresh)
 
 def branch_get_active(repo):
-    with open(GitbabRepo.repo_file(repo, "HEAD"), "r") as f:
-        head = f.read()
+    head = GitbabRepo.ref_read(repo, "HEAD")
 
-    if head.startswith("ref: refs/heads/"):
-        return(head[16:-1])
+    if head and head.startswith("ref: refs/heads/"):
+        return(head[16:])
     else:
         return False
 
@@ -289,52 +681,203 @@ def cmd_status_head_index(repo, index):
     for entry in head.keys():
         print("  deleted: ", entry)
 
-def cmd_status_index_worktree(repo, index):
+def cmd_status_index_worktree(repo, index, jobs=None, refresh=False):
     print("Changes not staged for commit:")
 
-    ignore = gitignore_read(repo)
-
-    gitdir_prefix = repo.gitdir + os.path.sep
-
-    all_files = list()
-    for (root, _, files) in os.walk(repo.worktree, True):
-        if root==repo.gitdir or root.startswith(gitdir_prefix):
-            continue
-        for f in files:
-            full_path = os.path.join(root, f)
-            rel_path = os.path.relpath(full_path, repo.worktree)
-            all_files.append(rel_path)
-    
-    for entry in index.entries:
-        full_path = os.path.join(repo.worktree, entry.name)
-
-
-        if not os.path.exists(full_path):
+    ignore = gitignore_read(repo, index)
+
+    # A file modified in the same instant the index was written can keep
+    # identical stat data ("racy git"), so entries at least as recent as
+    # the index can't be trusted on stat data alone.
+    index_file = GitbabRepo.repo_file(repo, "index")
+    index_mtime_ns = os.stat(index_file).st_mtime_ns if os.path.exists(index_file) else 0
+
+    # With a filesystem monitor, only the paths it reports as changed
+    # (and those that weren't clean last time) need looking at.
+    fsmonitor, dirty, changed_paths = fsmonitor_dirty(repo, index)
+
+    entries = index.entries
+    if dirty is not None:
+        entries = [e for e in entries if e.name in dirty]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        stats = list(pool.map(status_lstat, [os.path.join(repo.worktree, e.name) for e in entries]))
+
+        candidates = list()
+        for (entry, stat) in zip(entries, stats):
+            if stat is None:
+                continue
+            entry_mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
+            if not index_entry_stat_matches(entry, stat) or entry_mtime_ns >= index_mtime_ns:
+                candidates.append((entry, stat))
+
+        shas = pool.map(status_rehash, [(os.path.join(repo.worktree, e.name), stat) for (e, stat) in candidates])
+
+        modified = set()
+        refreshed = False
+        for ((entry, stat), sha) in zip(candidates, shas):
+            if entry.sha != sha:
+                modified.add(entry.name)
+            elif refresh:
+                index_entry_set_stat(entry, stat)
+                refreshed = True
+
+    unclean = set()
+    for (entry, stat) in zip(entries, stats):
+        if stat is None:
             print("  deleted: ", entry.name)
-        else:
-            stat = os.stat(full_path)
-            ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
-            mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
-            if (stat.st_ctime_ns != ctime_ns) or (stat.st_mtime_ns != mtime_ns):
+            unclean.add(entry.name)
+        elif entry.name in modified:
+            print("  modified:", entry.name)
+            unclean.add(entry.name)
 
-                with open(full_path, "rb") as fd:
-                    new_sha = object_hash(fd, b"blob", None)
-                    same = entry.sha == new_sha
+    untracked, cache_changed = status_untracked(repo, index, ignore, changed_paths)
 
-                    if not same:
-                        print("  modified:", entry.name)
+    fsmonitor_changed = False
+    if fsmonitor:
+        fsmonitor.unclean = unclean
+        fsmonitor_changed = fsmonitor_save(index, fsmonitor)
 
-        if entry.name in all_files:
-            all_files.remove(entry.name)
+    if refreshed or cache_changed or fsmonitor_changed:
+        index_write(repo, index)
 
     print()
     print("Untracked files:")
 
-    for f in all_files:
+    for f in untracked:
         # @TODO If a full directory is untracked, we should display
         # its name without its contents.
-        if not check_ignore(ignore, f):
-            print(" ", f)
+        print(" ", f)
+
+def status_untracked(repo, index, ignore, changed_paths=None):
+    # Walk the worktree for files that are neither tracked nor ignored.
+    # Ignored directories are never descended into.  With
+    # core.untrackedCache, each directory's (non-ignored) listing is kept
+    # in an index extension and only directories whose mtime changed are
+    # read again.  When a filesystem monitor reported changed_paths,
+    # directories with nothing changed in them aren't even stat'ed.
+    use_cache = repo.conf.getboolean("core", "untrackedCache", fallback=False)
+    ignore_hash = hashlib.sha1(repr((ignore.absolute, sorted(ignore.scoped.items()))).encode("utf8")).digest()
+
+    cache = None
+    if use_cache and INDEX_EXT_UNTRACKED in index.ext:
+        cache = GitUntrackedCache(index.ext[INDEX_EXT_UNTRACKED])
+        if cache.ignore_hash != ignore_hash:
+            cache = None
+
+    new_cache = GitUntrackedCache()
+    new_cache.ignore_hash = ignore_hash
+    new_cache.scan_time_ns = time.time_ns()
+
+    # The extension is only rewritten when a listing changed, or when one
+    # too recent to trust before is old enough now: its scan time must
+    # move forward for the listing to be used.
+    changed = cache is None
+
+    changed_dirs = None
+    if changed_paths is not None:
+        changed_dirs = set(changed_paths)
+        changed_dirs.update(os.path.dirname(p) for p in changed_paths)
+
+    untracked = list()
+    stack = [""]
+    while stack:
+        path = stack.pop()
+
+        if cache and changed_dirs is not None and not path in changed_dirs and path in cache.dirs:
+            listing = cache.dirs[path]
+        else:
+            try:
+                mtime_ns = os.stat(os.path.join(repo.worktree, path)).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            listing = cache.get(path, mtime_ns) if cache else None
+
+        if not listing:
+            files = list()
+            dirs = list()
+            with os.scandir(os.path.join(repo.worktree, path)) as it:
+                for e in it:
+                    rel_path = os.path.join(path, e.name)
+                    if rel_path == ".git" or check_ignore(ignore, rel_path):
+                        continue
+                    if e.is_dir(follow_symlinks=False):
+                        dirs.append(e.name)
+                    else:
+                        files.append(e.name)
+            listing = (mtime_ns, sorted(files), sorted(dirs))
+            if cache and not changed:
+                changed = listing != cache.dirs.get(path) or mtime_ns < new_cache.scan_time_ns - 10**9
+        new_cache.dirs[path] = listing
+
+        for f in listing[1]:
+            rel_path = os.path.join(path, f)
+            if not rel_path in index:
+                untracked.append(rel_path)
+        for d in reversed(listing[2]):
+            stack.append(os.path.join(path, d))
+
+    if not use_cache:
+        changed = False
+    elif changed or cache.dirs.keys() != new_cache.dirs.keys():
+        changed = True
+        index.ext[INDEX_EXT_UNTRACKED] = new_cache.serialize()
+
+    return sorted(untracked), changed
+
+def fsmonitor_dirty(repo, index):
+    # Returns (state, dirty, changed_paths).  state is the new fsmonitor
+    # state to save, or None without a daemon.  dirty is the set of index
+    # paths that may have changed and changed_paths what the daemon
+    # reported; both are None when everything must be scanned.
+    if not repo.conf.getboolean("core", "fsmonitor", fallback=False):
+        return None, None, None
+
+    old = None
+    if INDEX_EXT_FSMONITOR in index.ext:
+        old = GitFsmonitorState(index.ext[INDEX_EXT_FSMONITOR])
+
+    result = fsmonitor_query(repo, old.token if old else None)
+    if result is None:
+        # No daemon: any token we had is meaningless from now on.
+        index.ext.pop(INDEX_EXT_FSMONITOR, None)
+        return None, None, None
+
+    new_token, paths = result
+    state = GitFsmonitorState()
+    state.token = new_token
+    if paths is None or old is None:
+        return state, None, None
+
+    dirty = set(old.unclean)
+    for path in paths:
+        dirty.add(path)
+        # A changed directory (e.g. removed or renamed) affects all of
+        # its entries.
+        for e in index.directory_entries(path):
+            dirty.add(e.name)
+    return state, dirty, paths
+
+def fsmonitor_save(index, state):
+    data = state.serialize()
+    changed = index.ext.get(INDEX_EXT_FSMONITOR) != data
+    index.ext[INDEX_EXT_FSMONITOR] = data
+    return changed
+
+def status_lstat(path):
+    try:
+        return os.lstat(path)
+    except FileNotFoundError:
+        return None
+
+def status_rehash(args):
+    (path, stat) = args
+    if S_ISLNK(stat.st_mode):
+        data = os.fsencode(os.readlink(path))
+        return hashlib.sha1(b"blob " + str(len(data)).encode() + b"\x00" + data).hexdigest()
+    with open(path, "rb") as fd:
+        return object_hash(fd, b"blob", None)
+
 def rmbab(args):
     repo = GitbabRepo.repo_find()
     rm(repo, args.path)
@@ -352,69 +895,388 @@ def rm(repo, paths, delete=True, skip_missing=False):
         else:
             raise Exception("Cannot remove paths outside of worktree: {}".format(paths))
 
-    kept_entries = list()
-
     remove = list()
-    for e in index.entries:
-        full_path = os.path.join(repo.worktree, e.name)
-
-        if full_path in abspaths:
-            remove.append(full_path)
-            abspaths.remove(full_path)
+    missing = list()
+    for abspath in abspaths:
+        if os.path.relpath(abspath, repo.worktree) in index:
+            remove.append(abspath)
         else:
-            kept_entries.append(e) 
+            missing.append(abspath)
 
-    if len(abspaths) > 0 and not skip_missing:
-        raise Exception("Cannot remove paths not in the index: {}".format(abspaths))
+    if len(missing) > 0 and not skip_missing:
+        raise Exception("Cannot remove paths not in the index: {}".format(missing))
 
     if delete:
         for path in remove:
             os.unlink(path)
 
-    index.entries = kept_entries
+    index.remove(os.path.relpath(path, repo.worktree) for path in remove)
     index_write(repo, index)
 
 def addbab(args):
     repo = GitbabRepo.repo_find()
-    add(repo, args.path)
+    add(repo, args.path, jobs=args.jobs)
 
-def add(repo, paths, delete=True, skip_missing=False):
-    rm (repo, paths, delete=False, skip_missing=True)
+# Below this many files, starting a process pool costs more than it saves.
+ADD_PARALLEL_MIN = 64
 
+def add(repo, paths, jobs=None):
+    index = index_read(repo)
+    clean_paths = add_expand_paths(repo, paths, index)
+
+    # Files the filesystem monitor knows are unchanged since they were
+    # last added don't need hashing again.
+    fsmonitor, dirty, changed_paths = fsmonitor_dirty(repo, index)
+    if dirty is not None:
+        clean_paths = [(abspath, relpath) for (abspath, relpath) in clean_paths
+                       if relpath in dirty or not relpath in index]
+
+    # Hash and compress the files, in parallel when it is worth it.
+    # pool.map keeps results in input order, so the outcome doesn't depend
+    # on which worker finishes first.
+    args = [abspath for (abspath, relpath) in clean_paths]
+    if jobs == 1 or len(args) < ADD_PARALLEL_MIN:
+        results = [add_hash_file(abspath, repo) for abspath in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                    initializer=add_worker_init,
+                                                    initargs=(repo.worktree,)) as pool:
+            results = list(pool.map(add_hash_file, args, chunksize=32))
+
+    entries = list()
+    for ((abspath, relpath), (sha, stat)) in zip(clean_paths, results):
+        mode_type = stat_mode_type(stat.st_mode)
+        entry = GitIndexEntry(mode_type=mode_type, mode_perms=0 if mode_type == 0b1010 else 0o644, sha=sha,
+                              flag_assume_valid=False, flag_stage=False, name=relpath)
+        index_entry_set_stat(entry, stat)
+        entries.append(entry)
+
+    index.update(entries)
+
+    if fsmonitor and dirty is not None:
+        fsmonitor.unclean = dirty - set(relpath for (abspath, relpath) in clean_paths)
+        fsmonitor_save(index, fsmonitor)
+    else:
+        # We don't know which other paths changed, so the next status
+        # will have to scan everything.
+        index.ext.pop(INDEX_EXT_FSMONITOR, None)
+
+    index_write(repo, index)
+
+def add_expand_paths(repo, paths, index):
     worktree = repo.worktree + os.sep
-    clean_paths = list()
+    gitdir_prefix = repo.gitdir + os.sep
+    ignore = None
+    ret = dict()
+
     for path in paths:
-        abspath = os.path.abspath(path)
-        if not (abspath.startswith(worktree) and os.path.isfile(abspath)):
-            raise Exception("Not a file, or outside the worktree: {}".format(paths))
-        relpath = os.path.relpath(abspath, repo.worktree)
-        clean_paths.append((abspath,  relpath))
-
-        # Find and read the index.  It was modified by rm.  (This isn't
-        # optimal, good enough for wyag!)
-        #
-        # @FIXME, though: we could just move the index through
-        # commands instead of reading and writing it over again.
-        index = index_read(repo)
-
-        for (abspath, relpath) in clean_paths:
-            with open(abspath, "rb") as fd:
-                sha = object_hash(fd, b"blob", repo)
-
-            stat = os.stat(abspath)
-
-            ctime_s = int(stat.st_ctime)
-            ctime_ns = stat.st_ctime_ns % 10**9
-            mtime_s = int(stat.st_mtime)
-            mtime_ns = stat.st_mtime_ns % 10**9
-
-            entry = GitIndexEntry(ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns), dev=stat.st_dev, ino=stat.st_ino,
-                                  mode_type=0b1000, mode_perms=0o644, uid=stat.st_uid, gid=stat.st_gid,
-                                  fsize=stat.st_size, sha=sha, flag_assume_valid=False,
-                                  flag_stage=False, name=relpath)
-            index.entries.append(entry)
+        if glob.has_magic(path):
+            matches = glob.glob(path, recursive=True)
+            if not matches:
+                raise Exception("Pathspec did not match any files: {}".format(path))
+        else:
+            matches = [ path ]
+
+        for match in matches:
+            abspath = os.path.abspath(match)
+            inside = abspath == repo.worktree or abspath.startswith(worktree)
+            if not inside or abspath == repo.gitdir or abspath.startswith(gitdir_prefix):
+                raise Exception("Outside the worktree: {}".format(path))
+
+            if os.path.islink(abspath) or os.path.isfile(abspath):
+                ret[os.path.relpath(abspath, repo.worktree)] = abspath
+            elif os.path.isdir(abspath):
+                # Like git, adding a directory skips ignored files.
+                if ignore is None:
+                    ignore = gitignore_read(repo, index)
+                for (root, dirs, files) in os.walk(abspath):
+                    # Links to directories are added as links, not walked,
+                    # and .git and ignored directories aren't gone into.
+                    links = list()
+                    walk = list()
+                    for d in dirs:
+                        full_path = os.path.join(root, d)
+                        if os.path.islink(full_path):
+                            links.append(d)
+                        elif full_path != repo.gitdir and not check_ignore(ignore, os.path.relpath(full_path, repo.worktree)):
+                            walk.append(d)
+                    dirs[:] = walk
+                    for f in files + links:
+                        full_path = os.path.join(root, f)
+                        rel_path = os.path.relpath(full_path, repo.worktree)
+                        if not check_ignore(ignore, rel_path):
+                            ret[rel_path] = full_path
+            else:
+                raise Exception("Not a file, or outside the worktree: {}".format(path))
+
+    return [(ret[relpath], relpath) for relpath in sorted(ret)]
+
+add_worker_repo = None
+
+def add_worker_init(worktree):
+    global add_worker_repo
+    add_worker_repo = GitbabRepo.GitbabRepository(worktree)
+
+def add_hash_file(abspath, repo=None):
+    # Symbolic links are stored as a blob of their target, as status
+    # hashes them, not followed.
+    stat = os.lstat(abspath)
+    if S_ISLNK(stat.st_mode):
+        return object_write(GitBlob(os.fsencode(os.readlink(abspath))), repo or add_worker_repo), stat
+    with open(abspath, "rb") as fd:
+        sha = object_hash(fd, b"blob", repo or add_worker_repo)
+    return sha, stat
+
+def rev_listbab(args):
+    repo = GitbabRepo.repo_find()
+    tips = [object_find(repo, name) for name in args.commit if not name.startswith("^")]
+    exclude = [object_find(repo, name[1:]) for name in args.commit if name.startswith("^")]
+    reach = reachable_objects(repo, tips, exclude, use_bitmap=args.use_bitmap)
 
-        index_write(repo, index)
+    if args.count:
+        print(len(reach) if args.objects else reach.count(b'commit'))
+        return
+    for (sha, fmt) in reach.items():
+        if args.objects or fmt == b'commit':
+            print(sha)
+
+def repackbab(args):
+    repo = GitbabRepo.repo_find()
+    if args.all:
+        repack_all(repo, window=args.window, depth=args.depth, prune=args.prune)
+    else:
+        repack(repo, window=args.window, depth=args.depth, prune=args.prune)
+
+def gcbab(args):
+    repo = GitbabRepo.repo_find()
+    repack_all(repo, window=args.window, depth=args.depth, prune=True)
+    expire = args.prune or repo.conf.get("gc", "pruneExpire", fallback="2.weeks.ago")
+    if expire != "never":
+        prune_loose(repo, log_parse_date(expire))
+    # What is left loose, for the next lookups to start from.
+    object_names_refresh(repo)
+    object_names_write(repo)
+    if repo.conf.getboolean("gc", "writeCommitGraph", fallback=True):
+        commit_graph(repo)
+
+def commit_graphbab(args):
+    repo = GitbabRepo.repo_find()
+    if args.action == "write":
+        commit_graph(repo, changed_paths=args.changed_paths)
+    else:
+        errors = commit_graph_verify(repo)
+        for error in errors:
+            print(error)
+        if errors:
+            sys.exit(1)
+
+def multi_pack_indexbab(args):
+    repo = GitbabRepo.repo_find()
+    if args.action == "write":
+        start = time.time()
+        path, count, packs = pack_midx_write(repo)
+        if path is None:
+            print("No packs to index.")
+            return
+        print("Wrote multi-pack-index with {} objects from {} packs ({} bytes) in {:.2f}s.".format(
+            count, packs, os.path.getsize(path), time.time() - start))
+    else:
+        errors = pack_midx_verify(repo)
+        for error in errors:
+            print(error)
+        if errors:
+            sys.exit(1)
+
+def commit_graph(repo, changed_paths=None):
+    start = time.time()
+    path, count = commit_graph_write(repo, changed_paths=changed_paths)
+    print("Wrote commit-graph with {} commits ({} bytes) in {:.2f}s.".format(
+        count, os.path.getsize(path), time.time() - start))
+
+def repack(repo, window=10, depth=50, prune=False):
+    start = time.time()
+
+    objects = list()
+    paths = list()
+    names = dict()
+    loose_size = 0
+    for sha in object_loose_list(repo):
+        if pack_find(repo, sha):
+            continue
+        path = GitbabRepo.repo_file(repo, "objects", sha[:2], sha[2:])
+        fmt, data = object_read_raw(repo, sha)
+
+        # Trees give us a name for each object, which the delta search
+        # uses to put similar files next to each other.
+        if fmt == b'tree':
+            for leaf in tree_parse(data):
+                names.setdefault(leaf.sha, leaf.path)
+
+        objects.append((sha, fmt, len(data)))
+        paths.append(path)
+        loose_size += os.path.getsize(path)
+
+    if not objects:
+        print("Nothing to pack.")
+        return
+
+    objects = [(sha, fmt, size, pack_name_hash(names.get(sha))) for (sha, fmt, size) in objects]
+    pack, count, deltas = pack_write(repo, objects,
+                                     lambda sha: object_read_raw(repo, sha)[1],
+                                     window=window, depth=depth)
+
+    if prune:
+        for path in paths:
+            os.unlink(path)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+
+    elapsed = time.time() - start
+    pack_size = os.path.getsize(pack) + os.path.getsize(pack[:-len(".pack")] + ".idx")
+    print("Packed {} objects ({} deltas) into {}".format(count, deltas, os.path.basename(pack)))
+    print("{:.2f}s, {:.0f} objects/s".format(elapsed, count / elapsed if elapsed else count))
+    print("Loose: {} bytes, pack: {} bytes, saved: {} bytes".format(loose_size, pack_size, loose_size - pack_size))
+    repack_cache_stats(repo)
+
+def repack_all(repo, window=10, depth=50, prune=False):
+    start = time.time()
+    tips = commit_graph_tips(repo)
+    names = dict()
+    reach = reachable_objects(repo, tips, names=names)
+    counted = time.time() - start
+    print("Counted {} reachable objects in {:.2f}s{}.".format(
+        len(reach), counted, " using bitmaps" if reach.bitmap else ""))
+    if not len(reach):
+        print("Nothing to pack.")
+        return
+
+    # Name hashes group similar files for the delta search: from the trees
+    # the walk went through, or from the old bitmap's cache for the rest.
+    bitmap = reach.bitmap
+    hashes = dict()
+    objects = list()
+    for (sha, fmt) in reach.items():
+        pos = bitmap.position(sha) if bitmap and bitmap.hashes is not None else None
+        if sha in names:
+            hashes[sha] = pack_name_hash(names[sha])
+        elif pos is not None:
+            hashes[sha] = bitmap.hashes[pos]
+        objects.append((sha, fmt, object_size(repo, sha), hashes.get(sha, 0)))
+
+    old_packs = list(pack_list(repo))
+    pack, count, deltas = pack_write(repo, objects,
+                                     lambda sha: object_read_raw(repo, sha)[1],
+                                     window=window, depth=depth)
+    print("Packed {} objects ({} deltas) into {}".format(count, deltas, os.path.basename(pack)))
+
+    if repo.conf.getboolean("repack", "writeBitmaps", fallback=True):
+        new_pack = [p for p in pack_list(repo) if p.path == pack][0]
+        path, entries = bitmap_write(repo, new_pack, tips, hashes)
+        print("Wrote bitmaps for {} commits ({} bytes)".format(entries, os.path.getsize(path)))
+
+    if prune:
+        for old in old_packs:
+            if old.path == pack:
+                continue
+            # Unreachable objects of the old packs go loose, dated like
+            # their pack, for gcbab to prune once they expire.
+            mtime = os.path.getmtime(old.path)
+            for i in range(old.index.count):
+                sha = old.index.sha_at(i).hex()
+                if not sha in reach:
+                    if object_write_raw(repo, *old.read_at(old.index.offset_at(i)), mtime=mtime) != sha:
+                        raise Exception("Object {} is corrupt in pack {}".format(sha, old.path))
+            base = old.path[:-len(".pack")]
+            for ext in (".bitmap", ".rev", ".idx", ".pack"):
+                if os.path.exists(base + ext):
+                    os.unlink(base + ext)
+
+        # Everything is in one pack now: a multi-pack-index would only
+        # point at packs that are gone.
+        midx = pack_midx_path(repo)
+        if midx and os.path.exists(midx):
+            os.unlink(midx)
+
+        for sha in object_loose_list(repo):
+            if sha in reach:
+                object_loose_remove(repo, sha)
+
+    print("{:.2f}s".format(time.time() - start))
+    repack_cache_stats(repo)
+
+def repack_cache_stats(repo):
+    cache = repo.cache
+    print("Object cache: {} hits, {} misses, {} evictions, {} bytes used of {}".format(
+        cache.hits, cache.misses, cache.evictions, cache.used, cache.size))
+
+def prune_loose(repo, expire):
+    # Removes the loose objects older than expire that nothing reaches:
+    # not the refs, HEAD or the index.
+    candidates = list()
+    for sha in object_loose_list(repo):
+        if os.path.getmtime(GitbabRepo.repo_file(repo, "objects", sha[:2], sha[2:])) < expire:
+            candidates.append(sha)
+    if not candidates:
+        return
+
+    reach = reachable_objects(repo, commit_graph_tips(repo))
+    staged = set(entry.sha for entry in index_read(repo).entries)
+    pruned = 0
+    for sha in candidates:
+        if not sha in reach and not sha in staged:
+            object_loose_remove(repo, sha)
+            pruned += 1
+    print("Pruned {} unreachable loose objects.".format(pruned))
+
+def object_loose_remove(repo, sha):
+    path = GitbabRepo.repo_file(repo, "objects", sha[:2], sha[2:])
+    os.unlink(path)
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+def fsmonitorbab(args):
+    repo = GitbabRepo.repo_find()
+
+    if args.action == "run":
+        GitFsmonitorDaemon(repo).run()
+    elif args.action == "start":
+        if fsmonitor_request(repo, "query") is not None:
+            print("fsmonitor is already running.")
+            return
+        fsmonitor_start(repo)
+    elif args.action == "stop":
+        if not fsmonitor_stop(repo):
+            print("fsmonitor is not running.")
+    elif args.action == "status":
+        if fsmonitor_request(repo, "query") is not None:
+            print("fsmonitor is watching {}".format(repo.worktree))
+        else:
+            print("fsmonitor is not running.")
+
+def fsmonitor_start(repo):
+    pid = os.fork()
+    if pid == 0:
+        # Detach from the terminal and run the daemon.
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        try:
+            GitFsmonitorDaemon(repo).run()
+        finally:
+            os._exit(0)
+
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        if fsmonitor_request(repo, "query") is not None:
+            print("fsmonitor started (pid {}).".format(pid))
+            return
+        time.sleep(0.05)
+    raise Exception("fsmonitor failed to start")
 
 def gitconfig_read():
     xdg_config_home = os.environ["XDG_CONFIG_HOME"] if "XDG_CONFIG_HOME" in os.environ else "~/.config"
@@ -448,6 +1310,8 @@ def commit_create(repo, tree, parent, author, timestamp, message):
 
     commit.kvlm[b"author"] = author.encode("utf8")
     commit.kvlm[b"committer"] = author.encode("utf8")
+    if not message.endswith("\n"):
+        message += "\n"
     commit.kvlm[None] = message.encode("utf8")
 
     return object_write(commit, repo)
@@ -456,6 +1320,8 @@ def commitbab(args):
     repo = GitbabRepo.repo_find()
     index = index_read(repo)
     tree = tree_from_index(repo, index)
+    # Persist the cache tree so the next commit only rebuilds what changed.
+    index_write(repo, index)
     commit = commit_create(repo,
                            tree,
                            object_find(repo, "HEAD"),
@@ -464,14 +1330,19 @@ def commitbab(args):
                            args.message)
     active_branch = branch_get_active(repo)
     if active_branch: 
-        with open(GitbabRepo.repo_file(repo, os.path.join("refs/heads", active_branch)), "w") as fd:
-            fd.write(commit + "\n")
-        with open(GitbabRepo.repo_file(repo, "HEAD"), "w") as fd:
-            fd.write("\n")
+        GitbabRepo.ref_update(repo, "refs/heads/" + active_branch, commit)
+    else:
+        GitbabRepo.ref_update(repo, "HEAD", commit)
+
+    # Rewriting the graph reuses what it already holds, so only the new
+    # commit is read from the object store.
+    if repo.conf.getboolean("commitGraph", "writeOnCommit", fallback=False):
+        commit_graph_write(repo)
+
 def checkoutbab(args):
     repo = GitbabRepo.repo_find()
 
-    obj = object_read(repo, object_find(repo, args.commit))
+    obj = object_read(repo, object_find(repo, args.commitbab))
 
     if obj.fmt == b'commit':
         obj = object_read(repo, obj.kvlm[b'tree'].decode("ascii"))
@@ -488,8 +1359,77 @@ def checkoutbab(args):
 
 def show_refbab(args):
     repo = GitbabRepo.repo_find()
-    refs = GitbabRepo.ref_list(repo)
-    show_ref(repo, refs, prefix="refs")
+    if not args.pattern:
+        refs = GitbabRepo.ref_list(repo)
+        show_ref(repo, refs, prefix="refs")
+        return
+
+    # Full names only read the refs sharing the pattern's literal prefix;
+    # others match the end of any ref (master for refs/heads/master).
+    for pattern in args.pattern:
+        prefix = re.split(r"[*?\[]", pattern, 1)[0] if pattern.startswith("refs/") else "refs/"
+        for name, sha in GitbabRepo.ref_iterate(repo, prefix):
+            if fnmatch(name, pattern) or fnmatch(name, "*/" + pattern):
+                print("{} {}".format(sha, name))
+
+def pack_refsbab(args):
+    repo = GitbabRepo.repo_find()
+    if GitbabRepo.ref_store(repo).format == "reftable":
+        # Reftables are already binary and sorted: merge them into one.
+        print("Compacted {} tables.".format(GitbabRepo.ref_store(repo).pack()))
+        return
+    count = refs_pack(repo, all=args.all, prune=args.prune)
+    print("Packed {} refs.".format(count))
+
+def refs_pack(repo, all=False, prune=True):
+    # Without all, only tags and refs that already were packed move, as
+    # branches keep changing.  Tags are peeled once here so readers never
+    # need to open tag objects to find their commit.
+    snapshot = GitbabRepo.ref_store(repo)
+    refs = dict(snapshot.packed)
+    peeled = dict(snapshot.peeled)
+    moved = dict()
+    for name in snapshot.loose:
+        sha = snapshot.refs[name]
+        if sha.startswith("ref: "):
+            continue
+        if all or name.startswith("refs/tags/") or name in snapshot.packed:
+            refs[name] = moved[name] = sha
+            peeled.pop(name, None)
+            target = ref_peel(repo, sha)
+            if target:
+                peeled[name] = target
+
+    GitbabRepo.packed_refs_write(repo, refs, peeled)
+
+    if prune:
+        for (name, sha) in moved.items():
+            # Leave refs that changed since we read them.
+            if GitbabRepo.ref_read_loose(repo, name) != sha:
+                continue
+            path = GitbabRepo.repo_path(repo, *name.split("/"))
+            os.unlink(path)
+            # Drop emptied directories, but keep refs/heads and refs/tags.
+            parent = os.path.dirname(path)
+            while os.path.relpath(parent, repo.gitdir).count(os.sep) > 1:
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+    return len(moved)
+
+def ref_peel(repo, sha):
+    # The object an annotated tag ends at, or None if sha isn't a tag.
+    found = object_read_raw(repo, sha)
+    if not found or found[0] != b'tag':
+        return None
+    while True:
+        kvlm = kvlm_parse(found[1])
+        sha = kvlm[b'object'].decode("ascii")
+        if kvlm.get(b'type') != b'tag':
+            return sha
+        found = object_read_raw(repo, sha)
 
 def rev_parsebab(args):
     if args.type:
@@ -508,14 +1448,14 @@ def tagbab(args):
         tag_create(repo,
                    args.name,
                    args.object,
-                   type="object" if args.create_tag_object else "ref")
+                   create_tag_object=args.create_tag_object)
     else:
-        refs = GitbabRepo.ref_list(repo)
-        show_ref(repo, refs["tags"], with_hash=False)
+        refs = GitbabRepo.ref_list(repo, "refs/tags")
+        show_ref(repo, refs, with_hash=False)
 
 def check_ignorebab(args):
     repo = GitbabRepo.repo_find()
-    rules = gitignore_read(repo)
+    rules = gitignore_read(repo, paths=args.path)
     for path in args.path:
         if check_ignore(rules, path):
             print(path)
@@ -524,22 +1464,21 @@ def tag_create(repo, name, ref, create_tag_object=False):
 
     if create_tag_object:
  
-        tag = GitTag(repo)
+        tag = GitTag()
         tag.kvlm = collections.OrderedDict()
         tag.kvlm[b'object'] = sha.encode()
         tag.kvlm[b'type'] = b'commit'
         tag.kvlm[b'tag'] = name.encode()
         tag.kvlm[b'tagger'] = b'gitbab <gitbab@example.com>'
-        tag.kvlm[None] = b"A tag generated by gitbab"
-        tag_sha = object_write(tag)
-        ref_create(repo, "tags/" + name, tag_sha)
+        tag.kvlm[None] = b"A tag generated by gitbab\n"
+        tag_sha = object_write(tag, repo)
+        ref_create(repo, "tags/" + name, tag_sha, peeled=sha)
     else:
         
         ref_create(repo, "tags/" + name, sha)
 
-def ref_create(repo, ref_name, sha):
-    with open(GitbabRepo.repo_file(repo, "refs/" + ref_name), 'w') as fp:
-        fp.write(sha + "\n")
+def ref_create(repo, ref_name, sha, peeled=None):
+    GitbabRepo.ref_update(repo, "refs/" + ref_name, sha, peeled)
 
 def show_ref(repo, refs, with_hash=True, prefix=""):
     for k, v in refs.items():
@@ -551,40 +1490,31 @@ def show_ref(repo, refs, with_hash=True, prefix=""):
         else:
             show_ref(repo, v, with_hash=with_hash, prefix="{0}{1}{2}".format(prefix, "/" if prefix else "", k))
 
-def log_graphviz(repo, sha, seen):
-
-    if sha in seen:
-        return
-    seen.add(sha)
-
-    commit = object_read(repo, sha)
-    short_hash = sha[0:8]
-    message = commit.kvlm[None].decode("utf8").strip()
-    message = message.replace("\\", "\\\\")
-    message = message.replace("\"", "\\\"")
-
-    if "\n" in message: 
-        message = message[:message.index("\n")]
+def log_graphviz(repo, tips):
+    print("digraph wyaglog{")
+    print("  node[shape=rect]")
 
-    print("  c_{0} [label=\"{1}: {2}\"]".format(sha, sha[0:7], message))
-    assert commit.fmt==b'commit'
+    for sha in commit_walk(repo, tips):
+        commit = object_read(repo, sha)
+        message = bytes(commit.kvlm[None]).decode("utf8").strip()
+        message = message.replace("\\", "\\\\")
+        message = message.replace("\"", "\\\"")
 
-    if not b'parent' in commit.kvlm.keys():
-        return
+        if "\n" in message: 
+            message = message[:message.index("\n")]
 
-    parents = commit.kvlm[b'parent']
+        print("  c_{0} [label=\"{1}: {2}\"]".format(sha, sha[0:7], message))
+        assert commit.fmt==b'commit'
 
-    if type(parents) != list:
-        parents = [ parents ]
+        for p in commit.parents:
+            print ("  c_{0} -> c_{1};".format(sha, p))
 
-    for p in parents:
-        p = p.decode("ascii")
-        print ("  c_{0} -> c_{1};".format(sha, p))
-        log_graphviz(repo, p, seen)
+    print("}")
 
 def cat_file(repo, obj, fmt=None):
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
-    sys.stdout.buffer.write(obj.serialize())
+    with object_stream(repo, object_find(repo, obj, fmt=fmt)) as stream:
+        for chunk in stream:
+            sys.stdout.buffer.write(chunk)
 
 def gitignore_parse1(raw):
     raw = raw.strip()
@@ -608,7 +1538,7 @@ def gitignore_parse(lines):
 
     return ret
 
-def gitignore_read(repo):
+def gitignore_read(repo, index=None, paths=None):
     ret = GitIgnore(absolute=list(), scoped=dict())
 
     repo_file = os.path.join(repo.gitdir, "info/exclude")
@@ -626,10 +1556,26 @@ def gitignore_read(repo):
         with open(global_file, "r") as f:
             ret.absolute.append(gitignore_parse(f.readlines()))
 
-    index = index_read(repo)
+    if index is None:
+        index = index_read(repo, lazy=paths is not None)
 
-    for entry in index.entries:
-        if entry.name == ".gitignore" or entry.name.endswith("/.gitignore"):
+    if paths is None:
+        names = [name for name in index.names() if name == ".gitignore" or name.endswith("/.gitignore")]
+    else:
+        # Only the .gitignore files of the paths' parent directories can
+        # apply, so look those up instead of scanning the whole index.
+        names = set()
+        for path in paths:
+            parent = os.path.dirname(path)
+            while True:
+                names.add(os.path.join(parent, ".gitignore"))
+                if parent == "":
+                    break
+                parent = os.path.dirname(parent)
+
+    for name in names:
+        entry = index.find(name)
+        if entry:
             dir_name = os.path.dirname(entry.name)
             contents = object_read(repo, entry.sha)
             lines = contents.blobdata.decode("utf8").splitlines()